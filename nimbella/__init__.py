@@ -16,4 +16,7 @@
  */
 """
 
-from .nimbella import redis, storage, esql
+# Load the (lightweight) storage sub-package before binding the storage()
+# function, so lazily importing its plugin manager cannot shadow it.
+from . import storage as _storage_package
+from .nimbella import redis, redis_stats, storage, invalidate_storage, esql
@@ -0,0 +1,187 @@
+"""
+/**
+ * Copyright (c) 2020-present, Nimbella, Inc.
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+"""
+
+import os
+import asyncio
+import weakref
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from . import nimbella
+from .redisqlite import _decode
+
+# asyncio counterparts of the nimbella APIs. Redis uses the native asyncio
+# client when the installed redis package provides one (redis.asyncio),
+# everything else runs the blocking SDK calls on a shared thread pool.
+# The thread pool size bounds the number of blocking calls in flight.
+
+DEFAULT_CONCURRENCY = 32
+
+_concurrency = DEFAULT_CONCURRENCY
+_executor = None
+_executor_lock = threading.Lock()
+
+# Native asyncio connection pools per event loop: loop -> {(host, password): pool}
+_async_pools = weakref.WeakKeyDictionary()
+
+# Set maximum number of concurrent blocking calls (and native Redis connections).
+def set_concurrency(limit):
+    global _concurrency, _executor
+    if limit <= 0:
+        raise ValueError(f'Invalid concurrency limit: {limit}')
+    with _executor_lock:
+        _concurrency = limit
+        previous, _executor = _executor, None
+    if previous is not None:
+        previous.shutdown(wait=False)
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=_concurrency, thread_name_prefix='nimbella-aio')
+        return _executor
+
+# Run blocking function on the shared thread pool.
+async def run(fn, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_executor(), functools.partial(fn, *args, **kwargs))
+
+# Wraps an object so its methods become coroutines running on the thread pool.
+class AsyncProxy:
+    def __init__(self, target):
+        self._target = target
+
+    def __getattr__(self, name):
+        value = getattr(self._target, name)
+        if not callable(value):
+            return value
+
+        @functools.wraps(value)
+        async def method(*args, **kwargs):
+            return await run(value, *args, **kwargs)
+        return method
+
+# Returns async Redis client. Uses redis.asyncio with a per event loop
+# connection pool when available, otherwise the pooled blocking client
+# from nimbella.redis() with commands run on the thread pool. That pool is
+# sized for the thread pool, so each concurrent command gets a connection.
+# redis.asyncio pools do not reap idle connections, so idle_timeout is only
+# supported by the thread pool client.
+async def redis(max_connections=None, health_check_interval=None, idle_timeout=None):
+    try:
+        import redis.asyncio as aredis
+    except ImportError:
+        client = nimbella.redis(max_connections or _concurrency, health_check_interval, idle_timeout)
+        return AsyncProxy(client)
+    if idle_timeout is not None:
+        raise ValueError('idle_timeout is not supported with redis.asyncio')
+
+    redisIP = os.getenv('__NIM_REDIS_IP', "")
+    redisPassword = os.getenv('__NIM_REDIS_PASSWORD', "")
+    if len(redisIP) == 0:
+        raise Exception('Key-Value store is not available.')
+    elif len(redisPassword) == 0:
+        raise Exception('Key-Value store credentials are not available.')
+
+    pools = _async_pools.setdefault(asyncio.get_running_loop(), {})
+    pool = pools.get((redisIP, redisPassword))
+    if pool is None:
+        pool = aredis.BlockingConnectionPool(host=redisIP, port=6379, password=redisPassword,
+            max_connections=max_connections or _concurrency,
+            health_check_interval=30 if health_check_interval is None else health_check_interval)
+        pools[(redisIP, redisPassword)] = pool
+    return aredis.Redis(connection_pool=pool)
+
+async def esql():
+    # the in-process backend runs its (blocking) calls on the thread pool
+    if os.getenv('__NIM_ESQL_BACKEND', 'redis') == 'local':
+        return AsyncProxy(await run(nimbella.esql))
+    return AsyncRedisqlite(await redis())
+
+# Async Redisqlite client, for any Redis client with a coroutine execute_command.
+class AsyncRedisqlite:
+    def __init__(self, redis):
+        self.redis = redis
+
+    async def exec(self, *sql):
+        return await self.redis.execute_command("SQLEXEC", *sql)
+
+    async def prep(self, sql):
+        return await self.redis.execute_command("SQLPREP", sql)
+
+    async def map(self, *args, **kwargs):
+        limit = kwargs.get("limit",0)
+        return _decode(await self.redis.execute_command("SQLMAP", limit, *args))
+
+    async def arr(self, *args, **kwargs):
+        limit = kwargs.get("limit",0)
+        return _decode(await self.redis.execute_command("SQLARR", limit, *args))
+
+async def storage(web=False):
+    return AsyncStoragePlugin(await run(nimbella.storage, web))
+
+# Async wrapper around a storage plugin, blocking provider calls run on the thread pool.
+class AsyncStoragePlugin(AsyncProxy):
+    # Storage file handles are created locally, without a provider call
+    def file(self, destination) -> 'AsyncStorageFile':
+        return AsyncStorageFile(self._target.file(destination))
+
+    async def getFiles(self, *args, **kwargs) -> list:
+        files = await run(self._target.getFiles, *args, **kwargs)
+        return [AsyncStorageFile(f) for f in files]
+
+    # Async iterator over storage files, each page is fetched on the thread pool.
+    async def iterFiles(self, *args, **kwargs):
+        files = self._target.iterFiles(*args, **kwargs)
+        done = object()
+        while True:
+            f = await run(next, files, done)
+            if f is done:
+                return
+            yield AsyncStorageFile(f)
+
+# Async wrapper around a storage file, blocking provider calls run on the thread pool.
+class AsyncStorageFile(AsyncProxy):
+    # Reading metadata is a provider request, which would block the event loop
+    @property
+    def metadata(self):
+        raise TypeError('Use await file.get_metadata() and await file.set_metadata(metadata)')
+
+    @metadata.setter
+    def metadata(self, metadata):
+        raise TypeError('Use await file.get_metadata() and await file.set_metadata(metadata)')
+
+    async def get_metadata(self) -> dict:
+        return await run(lambda: self._target.metadata)
+
+    async def set_metadata(self, metadata: dict):
+        def update():
+            self._target.metadata = metadata
+        await run(update)
+
+    # Async iterator over file contents in chunks
+    async def iter_chunks(self, *args, **kwargs):
+        chunks = self._target.iter_chunks(*args, **kwargs)
+        done = object()
+        while True:
+            chunk = await run(next, chunks, done)
+            if chunk is done:
+                return
+            yield chunk
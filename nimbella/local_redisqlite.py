@@ -0,0 +1,212 @@
+"""
+/**
+ * Copyright (c) 2020-present, Nimbella, Inc.
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+"""
+
+import os
+import time
+import logging
+import sqlite3
+import tempfile
+import threading
+
+from .redisqlite import Redisqlite
+
+# Redisqlite API (exec, prep, map, arr, batch and the helpers built on them)
+# running against an in-process sqlite3 database instead of the Redisqlite
+# server module. The database is either a local file or in-memory, optionally
+# hydrated from a SQLite database snapshot stored in the bucket at snapshot.
+# With refresh_interval, the snapshot is reloaded (with a conditional
+# download, so only when it changed) by the first call after that many
+# seconds; local changes to a snapshot database are discarded on reload.
+# SQL errors are raised as sqlite3.Error.
+class LocalRedisqlite(Redisqlite):
+    def __init__(self, database=':memory:', snapshot=None, storage=None, refresh_interval=None):
+        super().__init__(None, prep_cache_size=0)
+        self.database = ':memory:' if snapshot else database
+        self.snapshot = snapshot
+        self.storage = storage
+        self.refresh_interval = refresh_interval
+        self._lock = threading.RLock()
+        self._statements = {}
+        self._next_handle = 1
+        self._validator = None
+        self._loaded_at = None
+        self.connection = self._connect()
+        if snapshot:
+            self.refresh()
+
+    # Returns batch running queued statements in order when executed, within
+    # BEGIN/COMMIT when transaction is set.
+    def batch(self, transaction=False):
+        return LocalRedisqliteBatch(self, transaction)
+
+    pipeline = batch
+
+    def exec(self, *sql):
+        return self._run(sql, lambda cursor: [cursor.lastrowid or 0, max(cursor.rowcount, 0)])
+
+    # Prepared statements are kept as SQL text, sqlite3 caches compiled
+    # statements per connection. Running prep with a handle closes it.
+    def prep(self, sql):
+        with self._lock:
+            if sql == "clean_prep_cache":
+                self._statements.clear()
+                return b'OK'
+            if isinstance(sql, int):
+                if self._statements.pop(sql, None) is None:
+                    raise sqlite3.ProgrammingError('invalid prepared statement index')
+                return b'OK'
+            handle = self._next_handle
+            self._next_handle += 1
+            self._statements[handle] = sql
+            return handle
+
+    def map(self, *args, **kwargs):
+        limit = kwargs.get("limit",0)
+        def records(cursor):
+            names = [d[0] for d in cursor.description or []]
+            return [dict(zip(names, row)) for row in self._fetch(cursor, limit)]
+        return self._run(args, records)
+
+    def arr(self, *args, **kwargs):
+        limit = kwargs.get("limit",0)
+        return self._run(args, lambda cursor: [list(row) for row in self._fetch(cursor, limit)])
+
+    # Reload the snapshot from the bucket if it changed since it was loaded.
+    # Returns True when a new snapshot was loaded.
+    def refresh(self) -> bool:
+        storage = self.storage
+        if storage is None:
+            from .nimbella import storage as default_storage
+            storage = default_storage()
+        result = storage.file(self.snapshot)._download_if_changed(self._validator)
+        self._loaded_at = time.monotonic()
+        if result is None:
+            return False
+        data, validator = result
+
+        fd, path = tempfile.mkstemp(suffix='.db')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            source = sqlite3.connect(path)
+            try:
+                connection = self._connect()
+                source.backup(connection)
+            finally:
+                source.close()
+        finally:
+            os.remove(path)
+
+        with self._lock:
+            previous, self.connection = self.connection, connection
+            self._validator = validator
+            previous.close()
+        return True
+
+    def close(self):
+        with self._lock:
+            self.connection.close()
+
+    def _connect(self):
+        # autocommit, so BEGIN/COMMIT statements behave as with the server
+        return sqlite3.connect(self.database, check_same_thread=False, isolation_level=None)
+
+    # Run statement (SQL text or prepared handle) & arguments, returning
+    # result(cursor). The connection is shared, so results are read holding the lock.
+    def _run(self, statement, result):
+        self._refresh_if_due()
+        sql, args = statement[0], statement[1:]
+        with self._lock:
+            if isinstance(sql, int):
+                if sql not in self._statements:
+                    raise sqlite3.ProgrammingError('invalid prepared statement index')
+                sql = self._statements[sql]
+            return result(self.connection.execute(sql, args))
+
+    # Only the first caller after the interval reloads the snapshot, others
+    # keep using the loaded snapshot meanwhile.
+    def _refresh_if_due(self):
+        if self.refresh_interval is None or self._loaded_at is None:
+            return
+        with self._lock:
+            if time.monotonic() - self._loaded_at < self.refresh_interval or self.connection.in_transaction:
+                return
+            self._loaded_at = time.monotonic()
+        try:
+            self.refresh()
+        except Exception as e:
+            # keep serving the loaded snapshot, retrying after the next interval
+            logging.warning(f'Unable to refresh esql snapshot {self.snapshot}: {e}')
+
+    @staticmethod
+    def _fetch(cursor, limit):
+        return cursor.fetchmany(limit) if limit else cursor.fetchall()
+
+# Queued LocalRedisqlite statements, run in order by execute().
+class LocalRedisqliteBatch:
+    def __init__(self, sql, transaction=False):
+        self.sql = sql
+        self.transaction = transaction
+        self.calls = []
+        self.results = None
+
+    def __len__(self):
+        return len(self.calls)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.execute()
+        else:
+            self.reset()
+
+    def exec(self, *sql):
+        return self._queue(self.sql.exec, sql, {})
+
+    def prep(self, sql):
+        return self._queue(self.sql.prep, (sql,), {})
+
+    def map(self, *args, **kwargs):
+        return self._queue(self.sql.map, args, kwargs)
+
+    def arr(self, *args, **kwargs):
+        return self._queue(self.sql.arr, args, kwargs)
+
+    def execute(self) -> list:
+        calls, self.calls = self.calls, []
+        with self.sql._lock:
+            if not self.transaction:
+                self.results = [fn(*args, **kwargs) for fn, args, kwargs in calls]
+                return self.results
+            self.sql.exec("begin")
+            try:
+                self.results = [fn(*args, **kwargs) for fn, args, kwargs in calls]
+            except:
+                self.sql.exec("rollback")
+                raise
+            self.sql.exec("commit")
+            return self.results
+
+    def reset(self):
+        self.calls = []
+
+    def _queue(self, fn, args, kwargs):
+        self.calls.append((fn, args, kwargs))
+        return self
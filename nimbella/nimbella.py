@@ -18,14 +18,18 @@
 
 import os
 import json
+import threading
 
-import redis as kv
-from google.cloud import storage as gstorage
-from google.oauth2 import service_account
-from .storage import plugin_manager
 from .redisqlite import Redisqlite
 
-def redis():
+# Heavy client libraries (redis, boto3, google-cloud-storage) and the storage
+# plugin manager are imported on first use, keeping `import nimbella` cheap
+# for the action cold start.
+
+# Returns Redis client backed by a process-wide connection pool, so warm
+# containers reuse open (and authenticated) connections across invocations.
+# When all connections are in use, commands wait up to timeout seconds for one.
+def redis(max_connections=None, health_check_interval=None, idle_timeout=None, timeout=None):
     redisIP = os.getenv('__NIM_REDIS_IP', "")
     redisPassword = os.getenv('__NIM_REDIS_PASSWORD', "")
     if len(redisIP) == 0:
@@ -33,10 +37,65 @@ def redis():
     elif len(redisPassword) == 0:
         raise Exception('Key-Value store credentials are not available.')
     else:
-        return kv.Redis(host=redisIP, port=6379, password=redisPassword)
+        import redis as kv
+        from . import redis_pool
+        pool = redis_pool.get_pool(redisIP, redisPassword,
+            max_connections=max_connections,
+            health_check_interval=health_check_interval,
+            idle_timeout=idle_timeout,
+            timeout=timeout)
+        return kv.Redis(connection_pool=pool)
+
+# Connection statistics for the pooled Redis connections, keyed by (host, password digest).
+def redis_stats():
+    from . import redis_pool
+    return redis_pool.pool_stats()
+
+# Redisqlite clients per connection pool (or local database configuration),
+# so the prepared statement cache is reused across invocations in a warm container.
+_ESQL_CACHE = {}
+_ESQL_CACHE_LOCK = threading.Lock()
 
+# Returns embedded SQL client. The backend is selected with __NIM_ESQL_BACKEND:
+# "redis" (default) uses the Redisqlite module of the Key-Value store, "local"
+# an in-process sqlite3 database (__NIM_ESQL_DATABASE, in-memory by default),
+# optionally loaded from the bucket object __NIM_ESQL_SNAPSHOT and reloaded
+# when changed every __NIM_ESQL_REFRESH seconds.
 def esql():
-    return Redisqlite(redis())
+    backend = os.getenv('__NIM_ESQL_BACKEND', 'redis')
+    if backend == 'local':
+        return _local_esql()
+    elif backend != 'redis':
+        raise Exception(f'Unknown embedded SQL backend: {backend}')
+
+    client = redis()
+    sql = _ESQL_CACHE.get(client.connection_pool)
+    if sql is None:
+        sql = _ESQL_CACHE.setdefault(client.connection_pool, Redisqlite(client))
+    return sql
+
+def _local_esql():
+    database = os.getenv('__NIM_ESQL_DATABASE', ':memory:')
+    snapshot = os.getenv('__NIM_ESQL_SNAPSHOT') or None
+    refresh = os.getenv('__NIM_ESQL_REFRESH') or None
+    key = ('local', database, snapshot, refresh)
+    sql = _ESQL_CACHE.get(key)
+    if sql is not None:
+        return sql
+
+    with _ESQL_CACHE_LOCK:
+        sql = _ESQL_CACHE.get(key)
+        if sql is None:
+            from .local_redisqlite import LocalRedisqlite
+            sql = LocalRedisqlite(database, snapshot, refresh_interval=float(refresh) if refresh else None)
+            _ESQL_CACHE[key] = sql
+        return sql
+
+# Storage plugin instances keyed on (namespace, apiHost, web, credentials digest).
+# Warm containers reuse instances rather than re-parsing credentials and
+# constructing new provider clients on every invocation.
+_STORAGE_CACHE = {}
+_STORAGE_CACHE_LOCK = threading.Lock()
 
 def storage(web=False):
     namespace = os.getenv('__OW_NAMESPACE', "")
@@ -49,6 +108,28 @@ def storage(web=False):
 
     if len(creds) == 0:
         raise Exception('Object store credentials are not available.')
+
+    import hashlib
+    key = (namespace, apiHost, bool(web), hashlib.sha256(creds.encode('utf-8')).hexdigest())
+    instance = _STORAGE_CACHE.get(key)
+    if instance is not None:
+        return instance
+
+    with _STORAGE_CACHE_LOCK:
+        instance = _STORAGE_CACHE.get(key)
+        if instance is None:
+            instance = _create_storage(namespace, apiHost, web, creds)
+            _STORAGE_CACHE[key] = instance
+        return instance
+
+# Drop memoized storage instances, forcing the next storage() call
+# to rebuild credentials & provider clients.
+def invalidate_storage():
+    with _STORAGE_CACHE_LOCK:
+        _STORAGE_CACHE.clear()
+
+def _create_storage(namespace, apiHost, web, creds):
+    from .storage import plugin_manager
     try:
         creds = json.loads(creds)
     except:
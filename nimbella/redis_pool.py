@@ -0,0 +1,137 @@
+"""
+/**
+ * Copyright (c) 2020-present, Nimbella, Inc.
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+"""
+
+import time
+import threading
+
+import redis as kv
+
+DEFAULT_PORT = 6379
+DEFAULT_MAX_CONNECTIONS = 16
+DEFAULT_HEALTH_CHECK_INTERVAL = 30
+DEFAULT_IDLE_TIMEOUT = 300
+# Seconds a command waits for a free connection when all are in use
+DEFAULT_TIMEOUT = 20
+
+# Process-wide pool registry: (host, password) -> ReapingConnectionPool.
+# Warm action containers keep the module loaded between invocations,
+# so connections (and their AUTH handshake) outlive a single activation.
+_POOLS = {}
+_POOLS_LOCK = threading.Lock()
+
+# Blocking connection pool which disconnects connections that have sat
+# unused in the pool for longer than `idle_timeout` seconds. When all
+# max_connections are in use, commands wait up to `timeout` seconds for a
+# connection to be released rather than failing immediately.
+class ReapingConnectionPool(kv.BlockingConnectionPool):
+    def __init__(self, idle_timeout=DEFAULT_IDLE_TIMEOUT, **kwargs):
+        super().__init__(**kwargs)
+        self.idle_timeout = idle_timeout
+        self.reaped_connections = 0
+
+    def get_connection(self, command_name, *keys, **options):
+        self.reap()
+        return super().get_connection(command_name, *keys, **options)
+
+    def release(self, connection):
+        connection.last_released = time.monotonic()
+        super().release(connection)
+
+    # Disconnect & forget idle connections, replacing them in the LIFO queue
+    # with empty slots. Empty slots go to the bottom of the queue, so live
+    # connections are still handed out before new ones are made.
+    def reap(self):
+        if not self.idle_timeout:
+            return
+        self._checkpid()
+        cutoff = time.monotonic() - self.idle_timeout
+        with self.pool.mutex:
+            queue = self.pool.queue
+            idle = [c for c in queue if c is not None and getattr(c, 'last_released', cutoff) < cutoff]
+            if idle:
+                live = [c for c in queue if c is not None and c not in idle]
+                queue[:] = [None] * (len(queue) - len(live)) + live
+                self._connections = [c for c in self._connections if c not in idle]
+                self.reaped_connections += len(idle)
+        for connection in idle:
+            connection.disconnect()
+
+    # Raise max_connections to at least max_connections, adding empty slots
+    # for the new connections and waking up commands waiting for one.
+    def grow(self, max_connections):
+        self._checkpid()
+        with self.pool.mutex:
+            added = max_connections - self.max_connections
+            if added <= 0:
+                return
+            self.pool.queue[:0] = [None] * added
+            self.pool.maxsize = self.max_connections = max_connections
+            self.pool.not_empty.notify(added)
+
+    def stats(self) -> dict:
+        with self.pool.mutex:
+            created = len(self._connections)
+            available = sum(1 for c in self.pool.queue if c is not None)
+            return {
+                'max_connections': self.max_connections,
+                'created': created,
+                'available': available,
+                'in_use': created - available,
+                'reaped': self.reaped_connections,
+            }
+
+# Return shared connection pool for host & password, creating it on first use.
+# Pool options are only applied when the pool is first created, except that a
+# larger max_connections grows an existing pool.
+def get_pool(host, password, max_connections=None, health_check_interval=None, idle_timeout=None, timeout=None):
+    key = (host, password)
+    pool = _POOLS.get(key)
+    if pool is not None:
+        if max_connections:
+            pool.grow(max_connections)
+        return pool
+    with _POOLS_LOCK:
+        pool = _POOLS.get(key)
+        if pool is None:
+            pool = ReapingConnectionPool(
+                host=host,
+                port=DEFAULT_PORT,
+                password=password,
+                max_connections=max_connections or DEFAULT_MAX_CONNECTIONS,
+                timeout=DEFAULT_TIMEOUT if timeout is None else timeout,
+                health_check_interval=DEFAULT_HEALTH_CHECK_INTERVAL if health_check_interval is None else health_check_interval,
+                idle_timeout=DEFAULT_IDLE_TIMEOUT if idle_timeout is None else idle_timeout)
+            _POOLS[key] = pool
+        return pool
+
+# Connection statistics for every registered pool, keyed by (host, password
+# digest) so pools for the same host with different credentials are distinct.
+def pool_stats() -> dict:
+    import hashlib
+    with _POOLS_LOCK:
+        pools = list(_POOLS.items())
+    return {(host, hashlib.sha256(password.encode('utf-8')).hexdigest()[:12]): pool.stats()
+        for (host, password), pool in pools}
+
+# Disconnect and drop all registered pools.
+def reset_pools():
+    with _POOLS_LOCK:
+        pools = list(_POOLS.values())
+        _POOLS.clear()
+    for pool in pools:
+        pool.disconnect()
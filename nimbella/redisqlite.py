@@ -16,25 +16,511 @@
  */
 """
 
+import re
 import json
+import time
+import array
+import itertools
+import threading
+from collections import OrderedDict
 
+# Default number of prepared statements cached per client
+DEFAULT_PREP_CACHE_SIZE = 64
+# Default number of rows fetched per cursor page
+DEFAULT_PAGE_SIZE = 1000
+# Default lifetime (seconds) of cached query results
+DEFAULT_RESULT_CACHE_TTL = 60
+# Maximum number of parameters in an SQLite statement (SQLITE_MAX_VARIABLE_NUMBER)
+MAX_SQL_VARIABLES = 999
+# Default number of insert statements sent per round trip by insert_many
+DEFAULT_INSERT_PIPELINE = 50
+# Server error message for an unknown prepared statement handle
+_INVALID_HANDLE = 'invalid prepared statement'
+
+# JSON parser for results: orjson when installed, resolved on first use
+_loads = None
+
+def _json_loads():
+    global _loads
+    if _loads is None:
+        try:
+            import orjson
+            _loads = orjson.loads
+        except ImportError:
+            _loads = json.loads
+    return _loads
+
+# Decode the JSON encoded rows of a result with a single parse of the
+# joined rows, rather than one parse per row.
 def _decode(a):
-    return [ json.loads(x.decode('utf-8')) for x in a]
+    if not a:
+        return []
+    return _json_loads()(b'[' + b','.join(a) + b']')
+
+# Column values as an array.array when all values are numeric ('q' for
+# integers, 'd' otherwise), or as a numpy array, else unchanged.
+def _numeric_column(values, numeric):
+    if numeric == 'numpy':
+        import numpy
+        return numpy.array(values)
+    if values and all(type(v) is int for v in values):
+        return array.array('q', values)
+    if values and all(type(v) in (int, float) for v in values):
+        return array.array('d', values)
+    return values
+
+# Transpose rows (arrays) into a dict of column name -> values
+def _columns(names, rows, numeric=None):
+    values = [list(c) for c in zip(*rows)] if rows else [[] for _ in names]
+    if numeric:
+        values = [_numeric_column(v, numeric) for v in values]
+    return dict(zip(names, values))
+
+# Quote SQL identifier
+def _quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+# Table name, optionally quoted and qualified by a schema name
+_IDENT = r'(?:(?:"[^"]+"|`[^`]+`|\[[^\]]+\]|\w+)\s*\.\s*)?(?:"[^"]+"|`[^`]+`|\[[^\]]+\]|\w+)'
+
+# Compiled (read clause, read table, write table, no write) patterns, compiled
+# on first use of the result cache to keep them out of the import time
+_patterns = None
+
+def _table_patterns():
+    global _patterns
+    if _patterns is None:
+        _patterns = (
+            # Tables read by a query (FROM/JOIN clauses, including comma separated lists)
+            re.compile(r'\b(?:from|join)\s+', re.I),
+            re.compile(r'(' + _IDENT + r')(?:\s+(?:as\s+)?(?!(?:where|join|on|using|group|order|limit|union|natural|left|right|inner|outer|cross)\b)\w+)?\s*(,\s*)?', re.I),
+            # Table written by a statement
+            re.compile(
+                r'^\s*(?:with\b.*?\)\s*)?(?:(?:insert|replace)(?:\s+or\s+\w+)?\s+into|update(?:\s+or\s+\w+)?|delete\s+from|'
+                r'(?:create|drop|alter)\s+(?:temp(?:orary)?\s+)?table(?:\s+if\s+(?:not\s+)?exists)?)\s+(' + _IDENT + ')', re.I | re.S),
+            # Statements which do not write tables
+            re.compile(r'^\s*(?:select|begin|commit|end|rollback|savepoint|release|explain)\b', re.I),
+        )
+    return _patterns
+
+def _table_name(name):
+    return name.split('.')[-1].strip().strip('"`[]').lower()
+
+def _read_tables(sql):
+    read_clause, read_table, _, _ = _table_patterns()
+    tables = set()
+    for clause in read_clause.finditer(sql):
+        position = clause.end()
+        while True:
+            match = read_table.match(sql, position)
+            if match is None:
+                break
+            tables.add(_table_name(match.group(1)))
+            if not match.group(2):
+                break
+            position = match.end()
+    return frozenset(tables)
+
+# Tables written by statement: an empty set for reads & transaction control,
+# None when the statement may write but its table cannot be determined.
+def _write_tables(sql):
+    if not isinstance(sql, str):
+        return None
+    _, _, write_table, no_write = _table_patterns()
+    if no_write.match(sql):
+        return frozenset()
+    match = write_table.match(sql)
+    return frozenset([_table_name(match.group(1))]) if match else None
+
+# Size bounded LRU cache of raw query results, expiring after ttl seconds and
+# invalidated by writes to the tables the cached queries read. Results whose
+# tables are unknown (None) are invalidated by any write. generation counts
+# invalidations, so results computed before a concurrent write are not cached.
+class ResultCache:
+    def __init__(self, size, ttl=DEFAULT_RESULT_CACHE_TTL):
+        if size <= 0 or ttl <= 0:
+            raise ValueError('Result cache size and ttl must be positive')
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.generation = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[2]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    # Cache result unless the cache was invalidated since generation was read
+    def put(self, key, tables, result, generation=None):
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._entries[key] = (time.monotonic() + self.ttl, tables, result)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    # Drop results reading any of tables, or all results when tables is None
+    def invalidate(self, tables=None):
+        with self._lock:
+            self.generation += 1
+            if tables is None:
+                stale = list(self._entries)
+            else:
+                stale = [k for k, e in self._entries.items() if e[1] is None or e[1] & tables]
+            for key in stale:
+                del self._entries[key]
+            self.invalidations += len(stale)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'invalidations': self.invalidations,
+                'size': len(self._entries),
+                'capacity': self.size,
+            }
 
 class Redisqlite:
-    def __init__(self, redis):
+    # Parameterized statements passed as SQL text to exec, map & arr are
+    # prepared on the server once and executed through their cached handle.
+    # prep_cache_size=0 disables the cache.
+    # result_cache_size > 0 enables the query result cache (see enable_result_cache).
+    def __init__(self, redis, prep_cache_size=DEFAULT_PREP_CACHE_SIZE, result_cache_size=0,
+            result_cache_ttl=DEFAULT_RESULT_CACHE_TTL):
         self.redis = redis
+        self.prep_cache_size = prep_cache_size
+        self.prep_hits = 0
+        self.prep_misses = 0
+        self._prepared = OrderedDict()
+        self._prepared_lock = threading.Lock()
+        self.result_cache = None
+        if result_cache_size > 0:
+            self.enable_result_cache(result_cache_size, result_cache_ttl)
+
+    # Cache results of map & arr queries given as SQL text, keyed on the
+    # query, arguments and limit, for up to ttl seconds. Statements run with
+    # exec (or in a batch) by this client invalidate the results reading the
+    # tables they write; writes by other clients are only seen after ttl.
+    # Enabling the cache again with the same settings keeps cached results.
+    def enable_result_cache(self, size=256, ttl=DEFAULT_RESULT_CACHE_TTL):
+        cache = self.result_cache
+        if cache is None or cache.size != size or cache.ttl != ttl:
+            self.result_cache = ResultCache(size, ttl)
+
+    def disable_result_cache(self):
+        self.result_cache = None
+
+    # Result cache statistics, or None when the cache is disabled
+    def result_cache_stats(self) -> dict:
+        cache = self.result_cache
+        return cache.stats() if cache is not None else None
+
+    # Returns batch which queues statements and sends them in one pipeline,
+    # optionally wrapped in MULTI/EXEC, when executed or the `with` block exits.
+    def batch(self, transaction=False):
+        return RedisqliteBatch(self.redis, transaction, self._invalidate)
+
+    pipeline = batch
     
     def exec(self, *sql):
-        return self.redis.execute_command("SQLEXEC", *sql)
+        try:
+            return self._execute("SQLEXEC", (), sql)
+        finally:
+            self._invalidate(sql[0] if sql else None)
 
     def prep(self, sql):
         return self.redis.execute_command("SQLPREP", sql)
 
     def map(self, *args, **kwargs):
         limit = kwargs.get("limit",0)
-        return _decode(self.redis.execute_command("SQLMAP", limit, *args))
+        return _decode(self._query("SQLMAP", limit, args))
 
     def arr(self, *args, **kwargs):
         limit = kwargs.get("limit",0)
-        return _decode(self.redis.execute_command("SQLARR", limit, *args))
+        return _decode(self._query("SQLARR", limit, args))
+
+    # Insert rows (sequences of values in columns order, or dicts keyed by
+    # column) into table with multi-row parameterized INSERT statements of up
+    # to chunk_size rows, kept under the SQLite limit of MAX_SQL_VARIABLES
+    # parameters. Statements are pipelined, pipeline_size per round trip, and
+    # rows may be any iterable (e.g. a generator), consumed as they are sent.
+    # With transaction=True all inserts run in a single BEGIN/COMMIT, rolled
+    # back on error. Returns the number of inserted rows.
+    def insert_many(self, table, columns, rows, chunk_size=None, transaction=False,
+            pipeline_size=DEFAULT_INSERT_PIPELINE) -> int:
+        columns = list(columns)
+        if not columns or len(columns) > MAX_SQL_VARIABLES:
+            raise ValueError(f'Invalid number of columns: {len(columns)}')
+        max_rows = MAX_SQL_VARIABLES // len(columns)
+        chunk_size = min(chunk_size or max_rows, max_rows)
+        if chunk_size <= 0 or pipeline_size <= 0:
+            raise ValueError('Chunk and pipeline sizes must be positive')
+
+        prefix = f'insert into {_quote(table)}({",".join(_quote(c) for c in columns)}) values'
+        placeholders = '(' + ','.join('?' * len(columns)) + ')'
+        statements = {}
+
+        def values(chunk):
+            for row in chunk:
+                row = [row[c] for c in columns] if isinstance(row, dict) else row
+                if len(row) != len(columns):
+                    raise ValueError(f'Expected {len(columns)} values, got {len(row)}: {row}')
+                yield from row
+
+        inserted = 0
+        if transaction:
+            self.exec("begin")
+        try:
+            batch = self.batch()
+            rows = iter(rows)
+            while True:
+                chunk = list(itertools.islice(rows, chunk_size))
+                if not chunk:
+                    break
+                sql = statements.get(len(chunk))
+                if sql is None:
+                    sql = statements[len(chunk)] = prefix + ','.join([placeholders] * len(chunk))
+                batch.exec(sql, *values(chunk))
+                if len(batch) >= pipeline_size:
+                    inserted += sum(r[1] for r in batch.execute())
+            if len(batch):
+                inserted += sum(r[1] for r in batch.execute())
+            if transaction:
+                self.exec("commit")
+        except BaseException:
+            if transaction:
+                try:
+                    self.exec("rollback")
+                except Exception:
+                    pass
+            raise
+        return inserted
+
+    # Returns the result of a query as a dict of column name -> list of values.
+    # With columns (the names of the selected columns, in order) rows are
+    # fetched as arrays, without repeating the names in every row. numeric
+    # ('array' or 'numpy') stores numeric columns in array.array or numpy arrays.
+    def arr_columns(self, *args, limit=0, columns=None, numeric=None):
+        if numeric not in (None, 'array', 'numpy'):
+            raise ValueError(f'Invalid numeric column type: {numeric}')
+        if columns is not None:
+            return _columns(columns, self.arr(*args, limit=limit), numeric)
+        rows = self.map(*args, limit=limit)
+        names = list(rows[0]) if rows else []
+        return _columns(names, [list(r.values()) for r in rows], numeric)
+
+    # Generator over the rows of a query, fetched page_size rows at a time so
+    # memory stays bounded and stopping early skips the remaining pages.
+    # Rows are dictionaries, or arrays with arr=True. Pages use LIMIT/OFFSET
+    # over the query (which should have a deterministic ORDER BY) unless key
+    # names a unique, non-null column: then each page continues after the last
+    # key seen (keyset pagination), which stays fast for deep pages.
+    def cursor(self, sql, *args, page_size=DEFAULT_PAGE_SIZE, key=None, arr=False):
+        if not isinstance(sql, str):
+            raise ValueError('Cursor requires an SQL query string')
+        if page_size <= 0:
+            raise ValueError(f'Invalid page size: {page_size}')
+        query = sql.strip().rstrip(';')
+        fetch = self.arr if arr else self.map
+
+        if key is None:
+            page_sql = f'select * from ({query}) limit ? offset ?'
+            offset = 0
+            while True:
+                rows = fetch(page_sql, *args, page_size, offset)
+                yield from rows
+                if len(rows) < page_size:
+                    return
+                offset += page_size
+
+        column = _quote(key)
+        # Array rows carry the key as an extra trailing value
+        select = f'q.*, q.{column}' if arr else 'q.*'
+        first_sql = f'select {select} from ({query}) q order by q.{column} limit ?'
+        next_sql = f'select {select} from ({query}) q where q.{column} > ? order by q.{column} limit ?'
+        rows = fetch(first_sql, *args, page_size)
+        while True:
+            for row in rows:
+                last = row.pop() if arr else row[key]
+                yield row
+            if len(rows) < page_size:
+                return
+            rows = fetch(next_sql, *args, last, page_size)
+
+    # Prepared statement cache statistics
+    def prep_cache_stats(self) -> dict:
+        with self._prepared_lock:
+            return {
+                'hits': self.prep_hits,
+                'misses': self.prep_misses,
+                'size': len(self._prepared),
+                'capacity': self.prep_cache_size,
+            }
+
+    # Close & forget all cached prepared statements
+    def clear_prep_cache(self):
+        with self._prepared_lock:
+            handles = list(self._prepared.values())
+            self._prepared.clear()
+        for handle in handles:
+            self._close(handle)
+
+    # Raw query result, from the result cache when enabled
+    def _query(self, command, limit, statement):
+        cache = self.result_cache
+        if cache is None or not statement or not isinstance(statement[0], str):
+            return self._execute(command, (limit,), statement)
+        key = (command, limit) + tuple(statement)
+        try:
+            result = cache.get(key)
+        except TypeError:
+            return self._execute(command, (limit,), statement)
+        if result is None:
+            generation = cache.generation
+            result = self._execute(command, (limit,), statement)
+            # queries without recognized tables are invalidated by any write
+            cache.put(key, _read_tables(statement[0]) or None, result, generation)
+        return result
+
+    # Invalidate cached results after running sql
+    def _invalidate(self, sql):
+        cache = self.result_cache
+        if cache is not None:
+            tables = _write_tables(sql)
+            if tables is None or tables:
+                cache.invalidate(tables)
+
+    # Run command for statement & arguments, using a cached prepared handle
+    # for parameterized SQL text. If the server no longer knows the handle
+    # (e.g. after prep("clean_prep_cache")), the statement is prepared again
+    # and the command retried once. On any other error the handle is closed
+    # and dropped from the cache before the error is raised.
+    # Handles are numbered by the server for all clients, so after another
+    # client ran clean_prep_cache a cached handle may already refer to a
+    # statement prepared since; clear_prep_cache() in every client using it.
+    def _execute(self, command, options, statement):
+        sql, args = statement[0], statement[1:]
+        if not args or not isinstance(sql, str) or self.prep_cache_size <= 0:
+            return self.redis.execute_command(command, *options, *statement)
+
+        handle = self._prepared_handle(sql)
+        try:
+            return self.redis.execute_command(command, *options, handle, *args)
+        except Exception as e:
+            from redis.exceptions import ResponseError
+            if not isinstance(e, ResponseError):
+                raise
+            evicted = self._evict(sql, handle)
+            if _INVALID_HANDLE not in str(e):
+                if evicted:
+                    self._close(handle)
+                raise
+        handle = self._prepared_handle(sql)
+        return self.redis.execute_command(command, *options, handle, *args)
+
+    def _prepared_handle(self, sql):
+        with self._prepared_lock:
+            handle = self._prepared.get(sql)
+            if handle is not None:
+                self._prepared.move_to_end(sql)
+                self.prep_hits += 1
+                return handle
+            self.prep_misses += 1
+
+        handle = self.prep(sql)
+        evicted = []
+        with self._prepared_lock:
+            self._prepared[sql] = handle
+            self._prepared.move_to_end(sql)
+            while len(self._prepared) > self.prep_cache_size:
+                evicted.append(self._prepared.popitem(last=False)[1])
+        for old in evicted:
+            self._close(old)
+        return handle
+
+    # Drop handle from the cache, returns False when it was no longer cached
+    def _evict(self, sql, handle) -> bool:
+        with self._prepared_lock:
+            if self._prepared.get(sql) != handle:
+                return False
+            del self._prepared[sql]
+            return True
+
+    # Running prep with a prepared statement handle closes it on the server
+    def _close(self, handle):
+        try:
+            self.prep(handle)
+        except Exception:
+            pass
+
+# Queued Redisqlite statements, sent in a single round trip by execute().
+# Results are returned in order, decoded as for the equivalent Redisqlite method.
+class RedisqliteBatch:
+    def __init__(self, redis, transaction=False, invalidate=None):
+        self.pipeline = redis.pipeline(transaction=transaction)
+        self.decoders = []
+        self.results = None
+        self.invalidate = invalidate
+        self.writes = []
+
+    def __len__(self):
+        return len(self.decoders)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.execute()
+        else:
+            self.reset()
+
+    def exec(self, *sql):
+        self.writes.append(sql[0] if sql else None)
+        return self._queue(None, "SQLEXEC", *sql)
+
+    def prep(self, sql):
+        return self._queue(None, "SQLPREP", sql)
+
+    def map(self, *args, **kwargs):
+        limit = kwargs.get("limit",0)
+        return self._queue(_decode, "SQLMAP", limit, *args)
+
+    def arr(self, *args, **kwargs):
+        limit = kwargs.get("limit",0)
+        return self._queue(_decode, "SQLARR", limit, *args)
+
+    def execute(self) -> list:
+        try:
+            responses = self.pipeline.execute()
+        finally:
+            decoders, self.decoders = self.decoders, []
+            writes, self.writes = self.writes, []
+            if self.invalidate is not None:
+                for sql in writes:
+                    self.invalidate(sql)
+        self.results = [decode(r) if decode else r for decode, r in zip(decoders, responses)]
+        return self.results
+
+    def reset(self):
+        self.pipeline.reset()
+        self.decoders = []
+        self.writes = []
+
+    def _queue(self, decode, *command):
+        self.pipeline.execute_command(*command)
+        self.decoders.append(decode)
+        return self
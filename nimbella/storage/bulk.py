@@ -0,0 +1,60 @@
+import itertools
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# Default number of concurrent batches for bulk operations
+DEFAULT_WORKERS = 8
+
+# Outcome of a bulk operation: names that succeeded and failed names -> error message.
+class BulkResult:
+    def __init__(self, succeeded=None, failed=None):
+        self.succeeded = succeeded if succeeded is not None else []
+        self.failed = failed if failed is not None else {}
+
+    # True when no item failed
+    @property
+    def ok(self) -> bool:
+        return not self.failed
+
+    def __len__(self):
+        return len(self.succeeded) + len(self.failed)
+
+    def __repr__(self):
+        return f'BulkResult(succeeded={len(self.succeeded)}, failed={len(self.failed)})'
+
+# Split iterable into lists of at most size items, consuming it lazily.
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+# Run fn(chunk) for each chunk using a bounded pool of worker threads.
+# fn returns (succeeded, failed) for its chunk, where failed maps names to
+# errors. A chunk raising an exception marks all its items as failed, using
+# key(item) as the name, without aborting the remaining chunks. At most
+# 2 * workers chunks are in flight, so the input is consumed as a stream.
+def run_batches(chunks, fn, workers=DEFAULT_WORKERS, key=lambda item: item) -> BulkResult:
+    result = BulkResult()
+
+    def collect(future, chunk):
+        try:
+            succeeded, failed = future.result()
+        except Exception as e:
+            succeeded, failed = [], {key(item): str(e) for item in chunk}
+        result.succeeded.extend(succeeded)
+        result.failed.update(failed)
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        pending = {}
+        for chunk in chunks:
+            if len(pending) >= 2 * max(1, workers):
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    collect(future, pending.pop(future))
+            pending[executor.submit(fn, chunk)] = chunk
+        for future in list(pending):
+            collect(future, pending.pop(future))
+
+    return result
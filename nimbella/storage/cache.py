@@ -0,0 +1,356 @@
+import io
+import os
+import json
+import time
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Iterator
+
+from .streams import BufferReader, DEFAULT_BUFFER_SIZE
+
+# Default location, total size (bytes) & revalidation interval (seconds) of disk caches
+DEFAULT_CACHE_DIRECTORY = os.path.join(tempfile.gettempdir(), 'nimbella-storage-cache')
+DEFAULT_CACHE_SIZE = 512 * 1024 * 1024
+DEFAULT_CACHE_TTL = 60
+# Temporary files older than this (seconds) were left by crashed writers
+STALE_TEMP_FILE_AGE = 60 * 60
+
+# Read-only mmap of path (b'' for empty files, which cannot be mapped)
+def _map(path, size):
+    if size == 0:
+        return b''
+    import mmap
+    with open(path, 'rb') as f:
+        return mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+
+# Write data to path atomically, so readers never see partial contents
+def _write(directory, path, data):
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except:
+        os.remove(tmp)
+        raise
+
+class _Entry:
+    def __init__(self, path, size, validator, validated_at=None):
+        self.path = path
+        self.size = size
+        self.validator = validator
+        # time.monotonic() of the last fetch or revalidation, None when loaded from disk
+        self.validated_at = validated_at
+
+# Size bounded on-disk LRU cache of object contents, keyed by object name.
+# Each object is stored with its validator (ETag or generation) in a JSON
+# sidecar, so entries left by a previous process are reused after they are
+# revalidated. Entries validated less than ttl seconds ago are served without
+# contacting the provider.
+class DiskCache:
+    def __init__(self, directory=DEFAULT_CACHE_DIRECTORY, max_bytes=DEFAULT_CACHE_SIZE, ttl=DEFAULT_CACHE_TTL):
+        if max_bytes <= 0 or ttl < 0:
+            raise ValueError('Cache size must be positive and ttl not negative')
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.evictions = 0
+        self.bytes_saved = 0
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    # Contents of object name, as a read-only mmap for cached objects (or
+    # bytes). fetch(validator) downloads the object when it changed since
+    # validator (or unconditionally for None), returning (data, validator),
+    # or None when unchanged. With fill=False, objects not cached yet are not
+    # fetched and None is returned.
+    def get(self, name, fetch, fill=True):
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is not None:
+                self._entries.move_to_end(name)
+        if entry is None and not fill:
+            return None
+
+        if entry is not None:
+            if entry.validated_at is not None and time.monotonic() - entry.validated_at < self.ttl:
+                contents = self._hit(name, entry)
+                if contents is not None:
+                    return contents
+                entry = None
+            else:
+                result = fetch(entry.validator)
+                if result is None:
+                    entry.validated_at = time.monotonic()
+                    with self._lock:
+                        self.revalidations += 1
+                    contents = self._hit(name, entry)
+                    if contents is not None:
+                        return contents
+                    entry = None
+                else:
+                    return self._miss(name, *result)
+
+        return self._miss(name, *fetch(None))
+
+    def _hit(self, name, entry):
+        try:
+            contents = _map(entry.path, entry.size)
+        except (FileNotFoundError, ValueError):
+            # removed or truncated outside the cache
+            self.invalidate(name)
+            return None
+        with self._lock:
+            self.hits += 1
+            self.bytes_saved += entry.size
+        return contents
+
+    def _miss(self, name, data, validator):
+        with self._lock:
+            self.misses += 1
+        if len(data) > self.max_bytes or validator is None:
+            self.invalidate(name)
+            return data
+
+        path = self._path(name)
+        _write(self.directory, path, data)
+        _write(self.directory, path + '.json', json.dumps({'name': name, 'validator': validator}).encode('utf-8'))
+        evicted = []
+        with self._lock:
+            previous = self._entries.pop(name, None)
+            if previous is not None:
+                self.size -= previous.size
+            self._entries[name] = _Entry(path, len(data), validator, time.monotonic())
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                _, old = self._entries.popitem(last=False)
+                self.size -= old.size
+                self.evictions += 1
+                evicted.append(old.path)
+        for old_path in evicted:
+            self._remove(old_path)
+        return data
+
+    # Remove cached object
+    def invalidate(self, name):
+        with self._lock:
+            entry = self._entries.pop(name, None)
+            if entry is not None:
+                self.size -= entry.size
+        if entry is not None:
+            self._remove(entry.path)
+
+    # Remove cached objects whose name starts with prefix
+    def invalidate_prefix(self, prefix=''):
+        with self._lock:
+            names = [n for n in self._entries if n.startswith(prefix or '')]
+        for name in names:
+            self.invalidate(name)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'revalidations': self.revalidations,
+                'evictions': self.evictions,
+                'bytes_saved': self.bytes_saved,
+                'size': self.size,
+                'capacity': self.max_bytes,
+                'objects': len(self._entries),
+            }
+
+    def _path(self, name):
+        return os.path.join(self.directory, hashlib.sha256(name.encode('utf-8')).hexdigest())
+
+    @staticmethod
+    def _remove(path):
+        for p in (path, path + '.json'):
+            try:
+                os.remove(p)
+            except FileNotFoundError:
+                pass
+
+    # Index objects cached by previous processes, least recently used first.
+    # Temporary files may be in-flight writes of other processes sharing the
+    # directory, so only stale ones are removed.
+    def _load(self):
+        found = []
+        stale = time.time() - STALE_TEMP_FILE_AGE
+        for filename in os.listdir(self.directory):
+            path = os.path.join(self.directory, filename)
+            if filename.endswith('.tmp'):
+                try:
+                    if os.stat(path).st_mtime < stale:
+                        os.remove(path)
+                except FileNotFoundError:
+                    pass
+                continue
+            if not filename.endswith('.json'):
+                continue
+            data_path = path[:-len('.json')]
+            try:
+                with open(path, 'rb') as f:
+                    info = json.loads(f.read())
+                stat = os.stat(data_path)
+                found.append((stat.st_mtime, info['name'], _Entry(data_path, stat.st_size, info['validator'])))
+            except (OSError, ValueError, KeyError):
+                self._remove(data_path)
+        for _, name, entry in sorted(found, key=lambda f: f[0]):
+            self._entries[name] = entry
+            self.size += entry.size
+        while self.size > self.max_bytes:
+            _, old = self._entries.popitem(last=False)
+            self.size -= old.size
+            self._remove(old.path)
+
+# Storage file read through a DiskCache, other operations are delegated to
+# the provider file. Changes made through this file invalidate its cached copy.
+class CachedStorageFile:
+    def __init__(self, file, cache: DiskCache):
+        self._file = file
+        self._cache = cache
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+    @property
+    def name(self) -> str:
+        return self._file.name
+
+    @property
+    def metadata(self) -> dict:
+        return self._file.metadata
+
+    @metadata.setter
+    def metadata(self, metadata: dict):
+        self._file.metadata = metadata
+
+    # Read-only mmap (or bytes) of the file contents, from the cache
+    def mmap(self):
+        return self._cache.get(self.name, self._file._download_if_changed)
+
+    # Full downloads go through the cache, ranges are served from the cache
+    # when the file is cached and fetched from the provider otherwise.
+    def download(self, start: int = None, end: int = None) -> bytes:
+        if start is None and end is None:
+            return bytes(self.mmap())
+        contents = self._cache.get(self.name, self._file._download_if_changed, fill=False)
+        if contents is None:
+            return self._file.download(start, end)
+        start = start or 0
+        if start < 0:
+            return bytes(contents[max(len(contents) + start, 0):])
+        return bytes(contents[start:None if end is None else end + 1])
+
+    def read_range(self, offset: int, length: int) -> bytes:
+        if length <= 0:
+            return b''
+        if offset < 0:
+            return self.download(start=offset)[:length]
+        return self.download(offset, offset + length - 1)
+
+    # Streams read cached files from disk, other files from the provider
+    def open(self, mode: str = 'rb', buffer_size: int = DEFAULT_BUFFER_SIZE) -> io.BufferedReader:
+        contents = self._cache.get(self.name, self._file._download_if_changed, fill=False) if mode == 'rb' else None
+        if contents is None:
+            return self._file.open(mode, buffer_size)
+        return io.BufferedReader(BufferReader(contents), buffer_size)
+
+    def iter_chunks(self, chunk_size: int = DEFAULT_BUFFER_SIZE) -> Iterator[bytes]:
+        with self.open(buffer_size=chunk_size) as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    return
+                yield chunk
+
+    # Cached files are copied from disk, others are downloaded from the
+    # provider without filling the cache.
+    def download_to_path(self, path: str, *args, mmap: bool = False, **kwargs):
+        contents = self._cache.get(self.name, self._file._download_if_changed, fill=False)
+        if contents is None:
+            return self._file.download_to_path(path, *args, mmap=mmap, **kwargs)
+        with open(path, 'wb') as f:
+            f.write(contents)
+        if not mmap:
+            return path
+        return _map(path, len(contents))
+
+    def save(self, *args, **kwargs):
+        self._cache.invalidate(self.name)
+        return self._file.save(*args, **kwargs)
+
+    def delete(self):
+        self._cache.invalidate(self.name)
+        return self._file.delete()
+
+# Provider file iterator yielding CachedStorageFiles, other attributes
+# (continuation_token, prefixes) are read from the provider iterator.
+class CachedFileIterator:
+    def __init__(self, files, cache: DiskCache):
+        self._files = files
+        self._cache = cache
+
+    def __getattr__(self, name):
+        return getattr(self._files, name)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> CachedStorageFile:
+        return CachedStorageFile(next(self._files), self._cache)
+
+# Wraps a storage plugin so file downloads are cached on local disk, see
+# DiskCache. Cached copies are revalidated with conditional downloads (ETag
+# on S3, generation on GCS) once older than ttl seconds, so warm containers
+# skip transfers of unchanged objects. Each bucket gets its own
+# subdirectory of directory.
+class CachedStoragePlugin:
+    def __init__(self, plugin, directory=DEFAULT_CACHE_DIRECTORY, max_bytes=DEFAULT_CACHE_SIZE, ttl=DEFAULT_CACHE_TTL):
+        self.plugin = plugin
+        bucket = getattr(plugin, 'bucket_key', None) or f'{plugin.namespace}-{plugin.web}'
+        subdirectory = hashlib.sha256(f'{plugin.id()}:{bucket}'.encode('utf-8')).hexdigest()[:16]
+        self.cache = DiskCache(os.path.join(directory, subdirectory), max_bytes, ttl)
+
+    def __getattr__(self, name):
+        return getattr(self.plugin, name)
+
+    def file(self, destination) -> CachedStorageFile:
+        return CachedStorageFile(self.plugin.file(destination), self.cache)
+
+    def getFiles(self, *args, **kwargs) -> list:
+        return [CachedStorageFile(f, self.cache) for f in self.plugin.getFiles(*args, **kwargs)]
+
+    def iterFiles(self, *args, **kwargs) -> 'CachedFileIterator':
+        return CachedFileIterator(self.plugin.iterFiles(*args, **kwargs), self.cache)
+
+    def upload(self, path, destination, *args, **kwargs):
+        self.cache.invalidate(destination)
+        return self.plugin.upload(path, destination, *args, **kwargs)
+
+    def uploadDirectory(self, local_dir, prefix = '', *args, **kwargs):
+        result = self.plugin.uploadDirectory(local_dir, prefix, *args, **kwargs)
+        self.cache.invalidate_prefix(prefix)
+        return result
+
+    def deleteFiles(self, prefix = '', *args, **kwargs):
+        result = self.plugin.deleteFiles(prefix, *args, **kwargs)
+        self.cache.invalidate_prefix(prefix)
+        return result
+
+    # Cache hits, misses, revalidations (unchanged objects), evictions,
+    # bytes_saved (bytes served from disk), size, capacity & objects
+    def cacheStats(self) -> dict:
+        return self.cache.stats()
+
+    def clearCache(self):
+        self.cache.invalidate_prefix('')
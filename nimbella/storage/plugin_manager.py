@@ -1,35 +1,71 @@
-from .plugins.abstract_storage_plugin import AbstractStoragePlugin
-import sys
 import logging
 import importlib
-from importlib import resources
 
-# Plugin lookup table: Plugin Provider Id -> Plugin Class
-PLUGINS = {}
+# Entry point group for storage plugins distributed outside this package, e.g.
+# setup(entry_points={'nimbella.storage.plugins': ['@acme/storage-x = acme.storage:Plugin']})
+ENTRY_POINT_GROUP = 'nimbella.storage.plugins'
+
+# Built-in plugins: Plugin Provider Id -> "module:Class"
+BUILTIN_PLUGINS = {
+    '@nimbella/storage-gcs': 'nimbella.storage.plugins.gcs_storage_plugin:GoogleCloudStoragePlugin',
+    '@nimbella/storage-s3': 'nimbella.storage.plugins.aws_storage_plugin:AWSStoragePlugin',
+}
+
+# Plugin lookup table: Plugin Provider Id -> Plugin Class or "module:Class".
+# Entries are resolved to classes (importing only that module) on first lookup.
+PLUGINS = dict(BUILTIN_PLUGINS)
+
+# Installed entry points: Plugin Provider Id -> EntryPoint, scanned once on demand.
+_entry_points = None
 
 # Return plugin class from provider identifier.
-# Loads all local plugins before searching for provider plugin.
+# Only the module providing the requested plugin is imported.
 def find_plugin(id):
-    if not PLUGINS:
-        import_plugins()
-        register_plugins()
-
     logging.debug(f'Looking for plugin from identifier: {id}')
-    return PLUGINS.get(id)
-
-# Find & import all potential Python plugins under the storage/plugins directory 
-def import_plugins(package = "nimbella.storage.plugins"):
-    files = resources.contents(package)
-    plugins = [f[:-3] for f in files if f.endswith(".py") and f[0] != "_"]
-    logging.debug(f'Discovered files in the {package} directory: {plugins}')
-    for plugin in plugins:
-        importlib.import_module(f"{package}.{plugin}")
-        logging.debug(f'Importing potential plugin file: {package}.{plugin}')
-
-# Use registered sub-classes of the abstract plugin class
-# to build lookup table from plugin ids to classes.
-def register_plugins():
-    for sc in AbstractStoragePlugin.__subclasses__():
-        plugin_name = sc.id()
-        logging.debug(f'Found plugin with provider id: {plugin_name}')
-        PLUGINS[plugin_name] = sc
+    plugin = PLUGINS.get(id)
+    if plugin is None:
+        entry_point = discover_entry_points().get(id)
+        if entry_point is None:
+            return None
+        logging.debug(f'Loading plugin {id} from entry point: {entry_point.value}')
+        plugin = entry_point.load()
+    elif isinstance(plugin, str):
+        plugin = load_plugin(plugin)
+
+    PLUGINS[id] = plugin
+    return plugin
+
+# Register plugin class (or "module:Class" reference) for provider identifier.
+def register_plugin(id, plugin):
+    logging.debug(f'Registering plugin with provider id: {id}')
+    PLUGINS[id] = plugin
+
+# Import module from "module:Class" reference & return class.
+def load_plugin(reference):
+    module_name, _, class_name = reference.partition(':')
+    logging.debug(f'Importing plugin module: {module_name}')
+    module = importlib.import_module(module_name)
+    return getattr(module, class_name)
+
+# Map of provider identifiers to installed package entry points.
+def discover_entry_points():
+    global _entry_points
+    if _entry_points is None:
+        try:
+            from importlib import metadata
+        except ImportError:
+            try:
+                import importlib_metadata as metadata
+            except ImportError:
+                metadata = None
+
+        entry_points = []
+        if metadata is not None:
+            eps = metadata.entry_points()
+            if hasattr(eps, 'select'):
+                entry_points = eps.select(group=ENTRY_POINT_GROUP)
+            else:
+                entry_points = eps.get(ENTRY_POINT_GROUP, [])
+        _entry_points = {ep.name: ep for ep in entry_points}
+        logging.debug(f'Discovered plugin entry points: {list(_entry_points)}')
+    return _entry_points
@@ -1,6 +1,33 @@
 import abc
+import io
+import os
+import types
 import typing
-from typing import Union
+import datetime
+from typing import Union, Iterator, NamedTuple, Optional
+
+from ..bulk import BulkResult, DEFAULT_WORKERS, chunked, run_batches
+from ..streams import RangeReader, DEFAULT_BUFFER_SIZE, DEFAULT_COALESCE_GAP, coalesce_ranges
+from ..transfer import DEFAULT_PART_SIZE, TransferConfig, parallel_download, verify_checksum
+from ..signing import SignedUrlCache, expires_in
+
+# Cache-Control header used by uploadDirectory() for HTML pages (which should be
+# revalidated so new deployments are visible) and for all other assets.
+PAGE_CACHE_CONTROL = 'no-cache'
+ASSET_CACHE_CONTROL = 'public, max-age=3600'
+
+# Immutable snapshot of a bucket file's attributes, read with a single
+# provider request. md5 is the base64 digest of the contents when known,
+# metadata is a read-only mapping of the user metadata.
+class FileStat(NamedTuple):
+    name: str
+    size: int
+    etag: Optional[str]
+    md5: Optional[str]
+    content_type: Optional[str]
+    cache_control: Optional[str]
+    updated: Optional[datetime.datetime]
+    metadata: typing.Mapping[str, str]
 
 # Abstract Bucket File Interface.
 # Hides provider implementation bucket file class instances
@@ -32,21 +59,183 @@ class AbstractStorageFile(abc.ABC):
     def delete(self) -> None:
         pass
 
-    # update file contents from string or bytes with content-type
+    # return FileStat with the file attributes, raising FileNotFoundError when
+    # the file does not exist. The result is cached on this file handle until
+    # the file is changed through it, refresh forces a new request.
+    def stat(self, refresh: bool = False) -> FileStat:
+        cached = getattr(self, '_stat', None)
+        if cached is None or refresh:
+            cached = self._stat = self._fetch_stat()
+        return cached
+
+    # update file contents with content-type from string, bytes-like buffer,
+    # readable file-like object or iterable of byte chunks, using optional
+    # transfer config for large contents
     @abc.abstractmethod
-    def save(self, data: Union[str, bytes], contentType: str) -> None:
+    def save(self, data: Union[str, bytes, bytearray, memoryview, typing.BinaryIO, typing.Iterable[bytes]],
+            contentType: str, config: TransferConfig = None) -> None:
         pass
 
-    # return file contents as bytes
+    # return file contents as bytes, optionally only bytes from start to end
+    # (inclusive). A negative start returns the last -start bytes.
     @abc.abstractmethod
-    def download(self) -> bytes:
+    def download(self, start: int = None, end: int = None) -> bytes:
         pass
 
+    # return (at most) length bytes from offset, where a negative offset
+    # is relative to the end of the file
+    def read_range(self, offset: int, length: int) -> bytes:
+        if length <= 0:
+            return b''
+        if offset < 0:
+            return self.download(start=offset)[:length]
+        return self.download(offset, offset + length - 1)
+
+    # return bytes for each (offset, length) range, in order. Ranges separated
+    # by at most max_gap bytes are coalesced and fetched with a single request,
+    # with independent requests made concurrently.
+    def read_ranges(self, ranges: list, max_gap: int = DEFAULT_COALESCE_GAP, workers: int = DEFAULT_WORKERS) -> list:
+        from concurrent.futures import ThreadPoolExecutor
+
+        if any(offset < 0 for offset, _ in ranges):
+            size = self._content_length()
+            ranges = [(offset + size if offset < 0 else offset, length) for offset, length in ranges]
+
+        merged = coalesce_ranges([r for r in ranges if r[1] > 0], max_gap)
+        fetch = lambda r: self.download(r[0], r[1])
+        if len(merged) > 1 and workers > 1:
+            with ThreadPoolExecutor(max_workers=min(workers, len(merged))) as executor:
+                blocks = list(executor.map(fetch, merged))
+        else:
+            blocks = list(map(fetch, merged))
+
+        nonempty = [i for i, r in enumerate(ranges) if r[1] > 0]
+        results = [b''] * len(ranges)
+        for (start, _, indexes), block in zip(merged, blocks):
+            for index in indexes:
+                offset, length = ranges[nonempty[index]]
+                results[nonempty[index]] = block[offset - start:offset - start + length]
+        return results
+
     # return pre-signed url from file for external access
     @abc.abstractmethod
     def signed_url(self, version: str, action: str, expires: int, contentType: str) -> str:
         pass
 
+    # return buffered, seekable, read-only stream of file contents
+    def open(self, mode: str = 'rb', buffer_size: int = DEFAULT_BUFFER_SIZE) -> io.BufferedReader:
+        if mode != 'rb':
+            raise ValueError(f'Unsupported file mode: {mode}')
+        return io.BufferedReader(RangeReader(self, buffer_size), buffer_size)
+
+    # iterate over file contents in chunks of (at most) chunk_size bytes
+    def iter_chunks(self, chunk_size: int = DEFAULT_BUFFER_SIZE) -> Iterator[bytes]:
+        with self.open(buffer_size=chunk_size) as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    return
+                yield chunk
+
+    # download file contents to local path, fetching part_size byte ranges
+    # concurrently from the same version of the file (a concurrent overwrite
+    # makes the download fail rather than mix versions). When verify is set,
+    # the local file is checked against the provider checksum (if available).
+    # A failed download removes the partial file. Returns path, or a
+    # read-only mmap of the downloaded file when mmap is set.
+    def download_to_path(self, path: str, part_size: int = DEFAULT_PART_SIZE, workers: int = DEFAULT_WORKERS,
+            verify: bool = True, mmap: bool = False):
+        size = self._content_length()
+        try:
+            parallel_download(self, path, size, part_size, workers, self._version())
+            checksum = self._checksum() if verify else None
+            if checksum is not None:
+                verify_checksum(path, *checksum)
+        except:
+            if os.path.exists(path):
+                os.remove(path)
+            raise
+
+        if not mmap:
+            return path
+        if size == 0:
+            return b''
+        import mmap as mm
+        with open(path, 'rb') as f:
+            return mm.mmap(f.fileno(), size, access=mm.ACCESS_READ)
+
+    # size of the file contents in bytes
+    @abc.abstractmethod
+    def _content_length(self) -> int:
+        pass
+
+    # identifier (ETag, generation) of the version of the contents measured by
+    # _content_length, or None when the provider cannot pin reads to it
+    def _version(self) -> Optional[str]:
+        return None
+
+    # download bytes start to end (inclusive) of the contents, failing when the
+    # file no longer has the given version
+    def _download_version(self, start: int, end: int, version: str) -> bytes:
+        return self.download(start, end)
+
+    # read file attributes from the provider. Plugins should override this
+    # with a single request, the default combines the generic accessors.
+    def _fetch_stat(self) -> FileStat:
+        if not self.exists():
+            raise FileNotFoundError(self.name)
+        checksum = self._checksum()
+        return FileStat(self.name, self._content_length(), None, checksum[1] if checksum and checksum[0] == 'md5' else None,
+            None, None, None, types.MappingProxyType(dict(self.metadata or {})))
+
+    # return (contents, validator) when the file changed since the version
+    # identified by validator (any version when validator is None), or None
+    # when unchanged. Plugins should override this with a conditional download,
+    # the default compares the stat() etag before downloading.
+    def _download_if_changed(self, validator):
+        etag = self.stat(refresh=True).etag
+        if validator is not None and etag == validator:
+            return None
+        return self.download(), etag
+
+    # forget cached file attributes after changing the file
+    def _invalidate_stat(self):
+        self._stat = None
+
+    # provider checksum of the file contents, as (algorithm, base64 digest)
+    # tuple with 'md5' or 'crc32c' algorithm, or None if not available
+    def _checksum(self):
+        return None
+
+    # return readable stream of file contents from start, or None when
+    # the provider can only serve ranges with download(start, end)
+    def _open_stream(self, start: int):
+        return None
+
+# Iterator over bucket files, fetched page by page from the provider listing.
+# Pages are generated lazily from (files, prefixes) tuples, so memory use does
+# not grow with the bucket size. continuation_token is the name of the last
+# file returned; pass it as start_after to iterFiles() to resume the listing.
+class StorageFileIterator:
+    def __init__(self, pages, start_after=None):
+        self.continuation_token = start_after
+        # common prefixes ("directories") seen so far when listing with a delimiter
+        self.prefixes = set()
+        self._files = self._iterate(pages)
+
+    def _iterate(self, pages):
+        for files, prefixes in pages:
+            self.prefixes.update(prefixes)
+            for f in files:
+                self.continuation_token = f.name
+                yield f
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> AbstractStorageFile:
+        return next(self._files)
+
 # Abstract interface for a storage provider.
 class AbstractStoragePlugin(abc.ABC):
     def __init__(self, client, namespace, apiHost, web, credentials):
@@ -89,22 +278,127 @@ class AbstractStoragePlugin(abc.ABC):
     def setWebsite(self, mainPageSuffix, notFoundPage):
         pass
 
-    # Remove all files from the bucket (using optional prefix)
+    # Remove all files from the bucket (using optional prefix), deleting
+    # batches of files concurrently. Returns a BulkResult with failed names.
     @abc.abstractmethod
-    def deleteFiles(self, force, prefix):
+    def deleteFiles(self, prefix, workers):
         pass
 
-    # Upload new file from path to bucket destination.
+    # Upload new file from path to bucket destination,
+    # using optional transfer config for large files.
     @abc.abstractmethod
-    def upload(self, path, destination, contentType, cacheControl):
+    def upload(self, path, destination, contentType, cacheControl, config: TransferConfig = None):
         pass
 
+    # Upload all files under local_dir to the bucket (under the optional prefix)
+    # using a pool of worker threads. Content type is inferred from the file
+    # extension. cacheControl may be a string or a function from local path to
+    # header value, by default HTML pages use no-cache. Returns a BulkResult
+    # with uploaded destinations and failed destinations -> error message.
+    def uploadDirectory(self, local_dir, prefix = '', workers = DEFAULT_WORKERS, cacheControl = None,
+            config: TransferConfig = None) -> BulkResult:
+        import mimetypes
+
+        def uploads():
+            for root, _, filenames in os.walk(local_dir):
+                for filename in sorted(filenames):
+                    path = os.path.join(root, filename)
+                    relpath = os.path.relpath(path, local_dir).replace(os.sep, '/')
+                    yield path, f'{prefix}{relpath}'
+
+        def upload(chunk):
+            path, destination = chunk[0]
+            contentType = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+            if callable(cacheControl):
+                fileCacheControl = cacheControl(path)
+            elif cacheControl is not None:
+                fileCacheControl = cacheControl
+            else:
+                fileCacheControl = PAGE_CACHE_CONTROL if contentType == 'text/html' else ASSET_CACHE_CONTROL
+            self.upload(path, destination, contentType, fileCacheControl, config)
+            return [destination], {}
+
+        return run_batches(chunked(uploads(), 1), upload, workers, key=lambda item: item[1])
+
     # Return storage file instance from bucket
     @abc.abstractmethod
     def file(self, destination) -> AbstractStorageFile:
         pass
 
+    # Return name -> FileStat (None for missing files) for each name, reading
+    # the file attributes with concurrent requests.
+    def statMany(self, names, workers = DEFAULT_WORKERS) -> dict:
+        from concurrent.futures import ThreadPoolExecutor
+
+        def stat(name):
+            try:
+                return self.file(name).stat()
+            except FileNotFoundError:
+                return None
+
+        names = list(names)
+        if len(names) > 1 and workers > 1:
+            with ThreadPoolExecutor(max_workers=min(workers, len(names))) as executor:
+                stats = list(executor.map(stat, names))
+        else:
+            stats = list(map(stat, names))
+        return dict(zip(names, stats))
+
+    # Replace user metadata of many files from a name -> metadata dict (or
+    # iterable of pairs), updating files concurrently. Returns a BulkResult
+    # with updated names and failed names -> error message.
+    def setMetadataMany(self, metadata, workers = DEFAULT_WORKERS) -> BulkResult:
+        items = metadata.items() if hasattr(metadata, 'items') else metadata
+
+        def update(chunk):
+            name, fileMetadata = chunk[0]
+            self.file(name).metadata = fileMetadata
+            return [name], {}
+
+        return run_batches(chunked(items, 1), update, workers, key=lambda item: item[0])
+
+    # Return name -> pre-signed url for each name, signing locally (without
+    # provider requests) with one signer for all names. cache may be True, to
+    # use the plugin's SignedUrlCache, or a SignedUrlCache: cached urls are
+    # reused while enough of their lifetime remains.
+    def signedUrls(self, names, action = 'GET', expires = 3600, contentType = None, version = 'v4',
+            cache = None) -> dict:
+        if cache is True:
+            if getattr(self, 'signedUrlCache', None) is None:
+                self.signedUrlCache = SignedUrlCache()
+            cache = self.signedUrlCache
+        sign = self._signer(version, action, expires, contentType)
+        if not cache:
+            return {name: sign(name) for name in names}
+
+        lifetime = self._url_lifetime(version, expires)
+        scope = (self.id(), getattr(self, 'bucket_key', None), action.upper(), str(expires), contentType, version)
+        urls = {}
+        for name in names:
+            key = scope + (name,)
+            url = cache.get(key)
+            if url is None:
+                url = sign(name)
+                cache.put(key, url, lifetime)
+            urls[name] = url
+        return urls
+
+    # Return function signing a url for a file name, plugins should override
+    # this to share signing state between urls.
+    def _signer(self, version, action, expires, contentType):
+        return lambda name: self.file(name).signed_url(version, action, expires, contentType)
+
+    # Seconds until urls signed with expires are no longer valid
+    def _url_lifetime(self, version, expires) -> float:
+        return expires_in(expires)
+
     # Return all storage files (with optional prefix) instance from bucket
     @abc.abstractmethod
     def getFiles(self, prefix) -> list:
         pass
+
+    # Lazily iterate storage files (with optional prefix), fetching page_size
+    # files per request and starting after the (exclusive) start_after name.
+    @abc.abstractmethod
+    def iterFiles(self, prefix, page_size, start_after, delimiter) -> StorageFileIterator:
+        pass
@@ -1,10 +1,42 @@
-from .abstract_storage_plugin import AbstractStoragePlugin, AbstractStorageFile
+from .abstract_storage_plugin import AbstractStoragePlugin, AbstractStorageFile, StorageFileIterator, FileStat
+from ..bulk import BulkResult, DEFAULT_WORKERS, chunked, run_batches
+from ..streams import range_header, as_stream
+from ..transfer import TransferConfig, DEFAULT_TRANSFER_CONFIG
 
-from typing import Union
+import base64
+import types
+import typing
+from typing import Union, TYPE_CHECKING
 from urllib.parse import urlparse
 
-import boto3
-import botocore
+# boto3 & botocore are imported on first use to keep plugin lookup cheap.
+if TYPE_CHECKING:
+    import boto3
+    import botocore.config
+
+# Convert provider-neutral transfer config to boto3 transfer config
+def boto_transfer_config(config: TransferConfig) -> 'boto3.s3.transfer.TransferConfig':
+    from boto3.s3.transfer import TransferConfig as BotoTransferConfig
+    return BotoTransferConfig(
+        multipart_threshold=config.multipart_threshold,
+        multipart_chunksize=config.part_size,
+        max_concurrency=config.max_concurrency,
+        num_download_attempts=config.max_retries + 1)
+
+# Single part uploads use the MD5 of the contents as ETag, except for objects
+# encrypted with SSE-KMS or SSE-C (customer keys). Multipart ETags
+# ("<md5>-<parts>") cannot be verified without the part sizes.
+# Returns the base64 MD5 digest, or None.
+def etag_md5(etag, server_side_encryption=None, sse_customer_algorithm=None):
+    if server_side_encryption == 'aws:kms' or sse_customer_algorithm:
+        return None
+    etag = (etag or '').strip('"')
+    if len(etag) != 32 or '-' in etag:
+        return None
+    try:
+        return base64.b64encode(bytes.fromhex(etag)).decode('ascii')
+    except ValueError:
+        return None
 
 # Simple wrapper around AWS S3 Object class to provide
 # generic "storage file" for this provider
@@ -13,6 +45,7 @@ class S3StorageFile(AbstractStorageFile):
         self.file = file
         self.web = web
         self.client = client
+        self._stat = None
 
     @property
     def acl(self) -> str:
@@ -24,18 +57,36 @@ class S3StorageFile(AbstractStorageFile):
 
     @property
     def metadata(self) -> dict:
-        if self.exists():
-            return self.file.metadata
-        else:
+        try:
+            return dict(self.stat().metadata)
+        except FileNotFoundError:
             return {}
 
+    # Metadata is replaced by copying the object onto itself, which also
+    # replaces its headers, so content type & cache control are carried over.
     @metadata.setter
     def metadata(self, metadata: dict):
-        self.file.copy_from(CopySource={'Bucket':self.file.bucket_name, 'Key':self.file.key}, Metadata=metadata, MetadataDirective='REPLACE', ACL=self.acl)
+        stat = self.stat()
+        params = {
+            'Bucket': self.file.bucket_name,
+            'Key': self.name,
+            'CopySource': {'Bucket': self.file.bucket_name, 'Key': self.name},
+            'Metadata': metadata,
+            'MetadataDirective': 'REPLACE',
+        }
+        if stat.content_type:
+            params['ContentType'] = stat.content_type
+        if stat.cache_control:
+            params['CacheControl'] = stat.cache_control
+        if self.acl:
+            params['ACL'] = self.acl
+        self._invalidate_stat()
+        self.client.copy_object(**params)
 
     # This is convoluted but AWS SDK does not have a simple
     # exists() method, see: https://stackoverflow.com/questions/33842944
     def exists(self) -> bool:
+        import botocore.exceptions
         try:
             self.file.load()
         except botocore.exceptions.ClientError as e:
@@ -47,16 +98,76 @@ class S3StorageFile(AbstractStorageFile):
             return True
 
     def delete(self) -> None:
+        self._invalidate_stat()
         self.file.delete()
 
-    def save(self, data: Union[str, bytes], contentType: str) -> None:
-        body = bytes(data, 'utf-8') if isinstance(data, str) else data
-        self.file.put(Body=data, ContentType=contentType, ACL=self.acl)
+    # Buffers & file-like objects are streamed without intermediate copies,
+    # data of unknown size is sent as a multipart upload.
+    def save(self, data: Union[str, bytes, bytearray, memoryview, typing.BinaryIO, typing.Iterable[bytes]],
+            contentType: str, config: TransferConfig = None) -> None:
+        config = config or DEFAULT_TRANSFER_CONFIG
+        self._invalidate_stat()
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        stream, size = as_stream(data)
+        if size is not None and size < config.multipart_threshold:
+            body = data if isinstance(data, bytes) else stream
+            self.file.put(Body=body, ContentType=contentType, ACL=self.acl)
+        else:
+            extraArgs = {"ContentType": contentType}
+            if self.acl:
+                extraArgs["ACL"] = self.acl
+            self.file.upload_fileobj(stream, ExtraArgs=extraArgs, Config=boto_transfer_config(config))
 
-    def download(self) -> bytes:
-        response = self.file.get()
+    def download(self, start: int = None, end: int = None) -> bytes:
+        if start is None and end is None:
+            response = self.file.get()
+        else:
+            response = self.file.get(Range=range_header(start, end))
         return response['Body'].read()
 
+    def _content_length(self) -> int:
+        return self.file.content_length
+
+    def _version(self):
+        return self.file.e_tag
+
+    # S3 answers 412 Precondition Failed when the ETag no longer matches
+    def _download_version(self, start: int, end: int, version: str) -> bytes:
+        return self.file.get(Range=range_header(start, end), IfMatch=version)['Body'].read()
+
+    # Conditional GET on the ETag, S3 answers 304 Not Modified when unchanged
+    def _download_if_changed(self, validator):
+        import botocore.exceptions
+        try:
+            response = self.file.get(IfNoneMatch=validator) if validator else self.file.get()
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] in ("304", "NotModified"):
+                return None
+            raise
+        return response['Body'].read(), response.get('ETag')
+
+    def _checksum(self):
+        md5 = etag_md5(self.file.e_tag, self.file.server_side_encryption, self.file.sse_customer_algorithm)
+        return ('md5', md5) if md5 else None
+
+    # Single HEAD request with the shared (thread-safe) client
+    def _fetch_stat(self) -> FileStat:
+        import botocore.exceptions
+        try:
+            head = self.client.head_object(Bucket=self.file.bucket_name, Key=self.name)
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] in ("404", "NoSuchKey", "NotFound"):
+                raise FileNotFoundError(self.name) from e
+            raise
+        md5 = etag_md5(head.get('ETag'), head.get('ServerSideEncryption'), head.get('SSECustomerAlgorithm'))
+        return FileStat(self.name, head.get('ContentLength'), head.get('ETag'), md5,
+            head.get('ContentType'), head.get('CacheControl'), head.get('LastModified'),
+            types.MappingProxyType(head.get('Metadata', {})))
+
+    def _open_stream(self, start: int):
+        return self.file.get(Range=range_header(start))['Body']
+
     def signed_url(self, version: str, action: str, expires: int, contentType: str) -> str:
         method = f'{action.lower()}_object'
         contentTypeKey = "ResponseContentType" if action.lower() == 'get' else 'ContentType'
@@ -70,9 +181,25 @@ class S3StorageFile(AbstractStorageFile):
 # Simple wrapper around GoogleCloudStorage bucket class to provide
 # generic bucket storage service for this provider
 class AWSStoragePlugin(AbstractStoragePlugin):
-    def __init__(self, client, namespace, apiHost, web, credentials):
+    # Size of the HTTP connection pool shared by all requests to the bucket
+    max_pool_connections = 32
+    # Enable TCP keep-alive on pooled connections (where supported by botocore)
+    tcp_keepalive = True
+    # Attempts for each request (including multipart upload parts) on transient failures
+    max_attempts = 5
+
+    def __init__(self, client, namespace, apiHost, web, credentials, max_pool_connections=None, tcp_keepalive=None):
         super().__init__(client, namespace, apiHost, web, credentials)
-        self.bucket = self.client.resource('s3', endpoint_url=credentials.get('endpoint')).Bucket(self.bucket_key)
+        if max_pool_connections is not None:
+            self.max_pool_connections = max_pool_connections
+        if tcp_keepalive is not None:
+            self.tcp_keepalive = tcp_keepalive
+
+        self.resource = self.client.resource('s3', endpoint_url=credentials.get('endpoint'), config=self.client_config())
+        # Low-level client used by the resource, shared by every S3StorageFile.
+        # botocore clients are thread-safe, unlike resource instances.
+        self.s3 = self.resource.meta.client
+        self.bucket = self.resource.Bucket(self.bucket_key)
 
     @staticmethod
     def id() -> str:
@@ -88,13 +215,24 @@ class AWSStoragePlugin(AbstractStoragePlugin):
         return creds
 
     @staticmethod
-    def create_client(credentials: dict) ->  botocore.client.BaseClient:
+    def create_client(credentials: dict) -> 'boto3.Session':
+        import boto3
         session = boto3.Session(
             region_name=credentials['region'],
             aws_access_key_id=credentials['accessKeyId'],
             aws_secret_access_key=credentials['secretAccessKey'])
         return session
 
+    def client_config(self) -> 'botocore.config.Config':
+        from botocore.config import Config
+        options = {
+            'max_pool_connections': self.max_pool_connections,
+            'retries': {'max_attempts': self.max_attempts, 'mode': 'standard'},
+        }
+        if 'tcp_keepalive' in Config.OPTION_DEFAULTS:
+            options['tcp_keepalive'] = self.tcp_keepalive
+        return Config(**options)
+
     @property
     def url(self) -> Union[str, None]:
         if self.web:
@@ -105,20 +243,29 @@ class AWSStoragePlugin(AbstractStoragePlugin):
                 return f"http://{self.bucket_key}.{hostname}"
 
     def file(self, destination) -> S3StorageFile:
-        return S3StorageFile(self.bucket.Object(destination), self.web, self.client.client('s3', endpoint_url=self.credentials.get('endpoint')))
+        return S3StorageFile(self.bucket.Object(destination), self.web, self.s3)
 
-    def deleteFiles(self, prefix='') -> None:
-        objects = self.bucket.objects.filter(Prefix=prefix)
-        keys = list(map(lambda o: {"Key": o.key}, objects))
-        if keys:
-            self.bucket.delete_objects(Delete={ "Objects": keys })
+    # Maximum number of keys per DeleteObjects request
+    DELETE_BATCH_SIZE = 1000
+
+    def deleteFiles(self, prefix='', workers=DEFAULT_WORKERS) -> BulkResult:
+        keys = (key for page in self._list(prefix) for key in self._page_keys(page))
+        return run_batches(chunked(keys, self.DELETE_BATCH_SIZE), self._delete_batch, workers)
 
-    def upload(self, path, destination, contentType, cacheControl):
+    def _delete_batch(self, keys):
+        response = self.s3.delete_objects(Bucket=self.bucket_key,
+            Delete={"Objects": [{"Key": k} for k in keys], "Quiet": True})
+        failed = {e["Key"]: e.get("Message", e.get("Code")) for e in response.get("Errors", [])}
+        return [k for k in keys if k not in failed], failed
+
+    # Files above the multipart threshold are uploaded in concurrent parts,
+    # each part request is retried by the client on transient failures.
+    def upload(self, path, destination, contentType, cacheControl, config: TransferConfig = None):
         extraArgs = {
             "ContentType": contentType,
             "CacheControl": cacheControl
         }
-        self.bucket.upload_file(path, destination, ExtraArgs=extraArgs)
+        self.bucket.upload_file(path, destination, ExtraArgs=extraArgs, Config=boto_transfer_config(config or DEFAULT_TRANSFER_CONFIG))
 
     def setWebsite(self, mainPageSuffix = None, notFoundPage = None):
         bucket_website = self.bucket.Website()
@@ -128,9 +275,43 @@ class AWSStoragePlugin(AbstractStoragePlugin):
         }
         bucket_website.put(WebsiteConfiguration=website_configuration)
 
+    # Parameters are built once, each url is signed locally by the shared client
+    def _signer(self, version, action, expires, contentType):
+        method = f'{action.lower()}_object'
+        contentTypeKey = "ResponseContentType" if action.lower() == 'get' else 'ContentType'
+        params = {"Bucket": self.bucket_key}
+        if contentType is not None:
+            params[contentTypeKey] = contentType
+        sign = self.s3.generate_presigned_url
+        return lambda name: sign(method, Params={**params, "Key": name}, ExpiresIn=expires)
+
     def getFiles(self, prefix = '') -> list:
         objects = self.bucket.objects.filter(Prefix=prefix)
-        return list(map(lambda o: S3StorageFile(self.bucket.Object(o.key), self.web, self.client.client('s3')), objects))
+        return list(map(lambda o: S3StorageFile(self.bucket.Object(o.key), self.web, self.s3), objects))
+
+    def iterFiles(self, prefix = '', page_size = 1000, start_after = None, delimiter = None) -> StorageFileIterator:
+        return StorageFileIterator(self._list_pages(prefix, page_size, start_after, delimiter), start_after)
+
+    def _list_pages(self, prefix, page_size, start_after, delimiter):
+        for page in self._list(prefix, page_size, start_after, delimiter):
+            files = [S3StorageFile(self.bucket.Object(key), self.web, self.s3) for key in self._page_keys(page)]
+            prefixes = [p["Prefix"] for p in page.get("CommonPrefixes", [])]
+            yield files, prefixes
+
+    # Raw list_objects_v2 response pages
+    def _list(self, prefix, page_size=1000, start_after=None, delimiter=None):
+        params = {"Bucket": self.bucket_key, "Prefix": prefix or ''}
+        if start_after:
+            params["StartAfter"] = start_after
+        if delimiter:
+            params["Delimiter"] = delimiter
+
+        paginator = self.s3.get_paginator('list_objects_v2')
+        return paginator.paginate(**params, PaginationConfig={"PageSize": page_size})
+
+    @staticmethod
+    def _page_keys(page):
+        return [o["Key"] for o in page.get("Contents", [])]
 
     @property
     def bucket_key(self):
@@ -1,17 +1,64 @@
-from .abstract_storage_plugin import AbstractStoragePlugin, AbstractStorageFile
+from .abstract_storage_plugin import AbstractStoragePlugin, AbstractStorageFile, StorageFileIterator, FileStat
+from ..bulk import BulkResult, DEFAULT_WORKERS, chunked, run_batches
+from ..transfer import TransferConfig, DEFAULT_TRANSFER_CONFIG
+from ..streams import as_stream
 
-from google.cloud import storage as gstorage
-from google.cloud.storage.blob import Blob
-from google.oauth2 import service_account
-
-from typing import Union
+import os
+import time
+import types
+import typing
+from typing import Union, TYPE_CHECKING
 from urllib.parse import urlparse
 
+# The Google Cloud SDK is imported on first use to keep plugin lookup cheap.
+if TYPE_CHECKING:
+    from google.cloud import storage as gstorage
+    from google.cloud.storage.blob import Blob
+    from google.oauth2 import service_account
+
+# Whether the installed google-cloud-storage takes a retry policy for uploads
+_UPLOAD_RETRY_POLICY = None
+
+# Retry arguments for Blob.upload_from_file from the transfer config. Releases
+# taking a retry policy (2.x and later) retry with the library's default policy,
+# disabled by max_retries=0. Older releases (as pinned by the runtime) take the
+# number of retries for each resumable chunk instead.
+def upload_retry_args(config: TransferConfig) -> dict:
+    global _UPLOAD_RETRY_POLICY
+    if _UPLOAD_RETRY_POLICY is None:
+        import inspect
+        from google.cloud.storage.blob import Blob
+        _UPLOAD_RETRY_POLICY = 'retry' in inspect.signature(Blob.upload_from_file).parameters
+    if not _UPLOAD_RETRY_POLICY:
+        return {'num_retries': config.max_retries}
+    from google.cloud.storage.retry import DEFAULT_RETRY
+    return {'retry': DEFAULT_RETRY if config.max_retries > 0 else None}
+
+# Endpoint of signed urls when the client does not define one
+GCS_API_ENDPOINT = 'https://storage.googleapis.com'
+
+# Signed url argument for contentType: the response type of downloads, the
+# content type uploads (PUT) must be sent with otherwise
+def signed_url_content_type(action, contentType) -> dict:
+    if contentType is None:
+        return {}
+    if action.upper() == 'GET':
+        return {'response_type': contentType}
+    return {'content_type': contentType}
+
+# Replace the user metadata of a loaded blob. GCS merges patched metadata
+# keys, so current keys missing from metadata are patched to None (removed).
+# The patch only applies to the metadata read, a concurrent change fails it.
+def _replace_metadata(blob: 'Blob', metadata: dict):
+    blob.metadata = {**dict.fromkeys(blob.metadata or {}), **metadata}
+    blob.patch(if_metageneration_match=blob.metageneration)
+
 # Simple wrapper around GoogleCloudStorage Blob class to provide
 # generic "storage file" for this provider
 class GoogleCloudStorageFile(AbstractStorageFile):
-    def __init__(self, blob: Blob):
+    def __init__(self, blob: 'Blob'):
         self.blob = blob
+        self._stat = None
 
     @property
     def name(self) -> str:
@@ -19,44 +66,113 @@ class GoogleCloudStorageFile(AbstractStorageFile):
 
     @property
     def metadata(self) -> dict:
-        return self.blob.metadata
+        try:
+            return dict(self.stat().metadata)
+        except FileNotFoundError:
+            return {}
 
     @metadata.setter
     def metadata(self, metadata: dict):
-        self.blob.metadata = metadata
+        self._invalidate_stat()
+        self.blob.reload()
+        _replace_metadata(self.blob, metadata)
 
     def exists(self) -> bool:
         return self.blob.exists()
 
     def delete(self) -> None:
+        self._invalidate_stat()
         self.blob.delete()
 
-    def save(self, data: Union[str, bytes], contentType: str) -> None:
-        self.blob.upload_from_string(data=data, content_type=contentType)
+    # Buffers & file-like objects are streamed without intermediate copies,
+    # data of unknown size is sent as a chunked resumable upload.
+    def save(self, data: Union[str, bytes, bytearray, memoryview, typing.BinaryIO, typing.Iterable[bytes]],
+            contentType: str, config: TransferConfig = None) -> None:
+        config = config or DEFAULT_TRANSFER_CONFIG
+        self._invalidate_stat()
+        stream, size = as_stream(data)
+        resumable = size is None or size >= config.multipart_threshold
+        self.blob.chunk_size = config.resumable_chunk_size if resumable else None
+        self.blob.upload_from_file(stream, size=size, content_type=contentType, **upload_retry_args(config))
+
+    def download(self, start: int = None, end: int = None) -> bytes:
+        if start is None and end is None:
+            return self.blob.download_as_bytes()
+        return self.blob.download_as_bytes(start=start or 0, end=end)
+
+    def _content_length(self) -> int:
+        if self.blob.size is None:
+            self.blob.reload()
+        return self.blob.size
+
+    def _version(self):
+        generation = self.blob.generation
+        return str(generation) if generation is not None else None
+
+    # GCS answers 412 Precondition Failed once the generation was replaced
+    def _download_version(self, start: int, end: int, version: str) -> bytes:
+        return self.blob.download_as_bytes(start=start, end=end, if_generation_match=int(version))
+
+    # Conditional download on the object generation, which the download
+    # response headers set on the blob. Downloads use a fresh blob handle, as
+    # one with a generation (or media link) from an earlier download, reload
+    # or listing would keep reading that generation after an overwrite.
+    def _download_if_changed(self, validator):
+        from google.api_core.exceptions import NotModified
+        blob = self.blob.bucket.blob(self.name)
+        try:
+            if validator:
+                data = blob.download_as_bytes(if_generation_not_match=int(validator))
+            else:
+                data = blob.download_as_bytes()
+        except NotModified:
+            return None
+        generation = blob.generation
+        return data, str(generation) if generation is not None else None
 
-    def download(self) -> bytes:
-        return self.blob.download_as_bytes()
+    # Composite objects have no MD5 hash, only CRC32C
+    def _checksum(self):
+        if self.blob.md5_hash:
+            return 'md5', self.blob.md5_hash
+        if self.blob.crc32c:
+            return 'crc32c', self.blob.crc32c
+        return None
+
+    # Single object metadata request, which also refreshes the blob properties
+    def _fetch_stat(self) -> FileStat:
+        from google.cloud.exceptions import NotFound
+        try:
+            self.blob.reload()
+        except NotFound as e:
+            raise FileNotFoundError(self.name) from e
+        blob = self.blob
+        return FileStat(self.name, blob.size, blob.etag, blob.md5_hash, blob.content_type, blob.cache_control,
+            blob.updated, types.MappingProxyType(dict(blob.metadata or {})))
 
     def signed_url(self, version: str, action: str, expires: int, contentType: str) -> str:
-        return self.blob.generate_signed_url(expiration=expires, version=version, method=action, response_type=contentType)
+        return self.blob.generate_signed_url(expiration=expires, version=version, method=action,
+            **signed_url_content_type(action, contentType))
 
 # Simple wrapper around GoogleCloudStorage bucket class to provide
 # generic bucket storage service for this provider
 class GoogleCloudStoragePlugin(AbstractStoragePlugin):
     def __init__(self, client, namespace, apiHost, web, credentials):
         super().__init__(client, namespace, apiHost, web, credentials)
-        self.bucket = self.client.get_bucket(self.bucket_key)
+        # Local bucket handle, no metadata request is made until the first operation.
+        self.bucket = self.client.bucket(self.bucket_key)
 
     @staticmethod
     def id() -> str:
         return "@nimbella/storage-gcs"
 
     @staticmethod
-    def prepare_creds(credentials: dict) -> service_account.Credentials:
+    def prepare_creds(credentials: dict) -> 'service_account.Credentials':
+        from google.oauth2 import service_account
         return service_account.Credentials.from_service_account_info(credentials)
 
     @staticmethod
-    def create_client(credentials: service_account.Credentials) -> gstorage.Client:
+    def create_client(credentials: 'service_account.Credentials') -> 'gstorage.Client':
+        from google.cloud import storage as gstorage
         return gstorage.Client(credentials=credentials)
 
     @property
@@ -68,24 +184,140 @@ class GoogleCloudStoragePlugin(AbstractStoragePlugin):
     def file(self, destination) -> GoogleCloudStorageFile:
         return GoogleCloudStorageFile(self.bucket.blob(destination))
 
-    def deleteFiles(self, prefix=None):
-        blobs_to_delete = list(self.client.list_blobs(self.bucket, prefix=prefix))
-        self.bucket.delete_blobs(blobs_to_delete)
+    # Maximum number of calls per JSON API batch request
+    DELETE_BATCH_SIZE = 100
+    PATCH_BATCH_SIZE = 100
+
+    def deleteFiles(self, prefix=None, workers=DEFAULT_WORKERS) -> BulkResult:
+        blobs = self.client.list_blobs(self.bucket, prefix=prefix, fields='items(name),nextPageToken')
+        names = (b.name for b in blobs)
+        return run_batches(chunked(names, self.DELETE_BATCH_SIZE), self._delete_batch, workers)
+
+    # Delete blobs in a single batch request. The batch only reports its first
+    # error, so on failure fall back to individual deletes to find failed names.
+    def _delete_batch(self, names):
+        from google.cloud.exceptions import NotFound
+        try:
+            with self.client.batch():
+                for name in names:
+                    self.bucket.delete_blob(name)
+            return names, {}
+        except Exception:
+            pass
+
+        succeeded, failed = [], {}
+        for name in names:
+            try:
+                self.bucket.delete_blob(name)
+            except NotFound:
+                succeeded.append(name)
+            except Exception as e:
+                failed[name] = str(e)
+            else:
+                succeeded.append(name)
+        return succeeded, failed
+
+    # Metadata is replaced with batch requests of PATCH_BATCH_SIZE files, sent
+    # concurrently: one batch reads the current metadata, a second one patches it.
+    def setMetadataMany(self, metadata, workers=DEFAULT_WORKERS) -> BulkResult:
+        items = metadata.items() if hasattr(metadata, 'items') else metadata
+        return run_batches(chunked(items, self.PATCH_BATCH_SIZE), self._patch_batch, workers, key=lambda item: item[0])
+
+    # Replace metadata of blobs with two batch requests, falling back to
+    # individual requests to find the failed names when a batch fails.
+    def _patch_batch(self, items):
+        blobs = [(name, self.bucket.blob(name), metadata) for name, metadata in items]
+        try:
+            with self.client.batch():
+                for _, blob, _ in blobs:
+                    blob.reload()
+            with self.client.batch():
+                for _, blob, metadata in blobs:
+                    _replace_metadata(blob, metadata)
+            return [name for name, _, _ in blobs], {}
+        except Exception:
+            pass
 
-    def upload(self, path, destination, contentType, cacheControl):
+        succeeded, failed = [], {}
+        for name, _, metadata in blobs:
+            try:
+                blob = self.bucket.blob(name)
+                blob.reload()
+                _replace_metadata(blob, metadata)
+            except Exception as e:
+                failed[name] = str(e)
+            else:
+                succeeded.append(name)
+        return succeeded, failed
+
+    # Files above the multipart threshold use a chunked resumable upload,
+    # so a transient failure resumes from the last chunk sent.
+    def upload(self, path, destination, contentType, cacheControl, config: TransferConfig = None):
+        config = config or DEFAULT_TRANSFER_CONFIG
         blob = self.bucket.blob(destination)
         blob.cache_control = cacheControl
+        if os.path.getsize(path) >= config.multipart_threshold:
+            blob.chunk_size = config.resumable_chunk_size
         with open(path, "rb") as f:
-            blob.upload_from_file(file_obj=f, content_type=contentType)
+            blob.upload_from_file(file_obj=f, content_type=contentType, **upload_retry_args(config))
 
     def setWebsite(self, mainPageSuffix = None, notFoundPage = None):
         self.bucket.configure_website(mainPageSuffix, notFoundPage)
-        self.bucket.update()
+        # patch (rather than update) as the lazy bucket handle has no other properties loaded
+        self.bucket.patch()
+
+    # Credentials, signer email, endpoint & expiration are resolved once, then
+    # each url is signed locally with the client's service account credentials.
+    def _signer(self, version, action, expires, contentType):
+        from urllib.parse import quote
+        from google.cloud.storage import _signing
+        if version == 'v2':
+            helper, expiration = _signing.generate_signed_url_v2, _signing.get_expiration_seconds_v2(expires)
+        elif version == 'v4':
+            helper, expiration = _signing.generate_signed_url_v4, _signing.get_expiration_seconds_v4(expires)
+        else:
+            raise ValueError(f'Unsupported signed url version: {version}')
+        credentials = self.client._credentials
+        _signing.ensure_signed_credentials(credentials)
+        options = {
+            'expiration': expiration,
+            'api_access_endpoint': getattr(self.client, 'api_endpoint', None) or GCS_API_ENDPOINT,
+            'method': action.upper(),
+            'service_account_email': credentials.signer_email,
+            **signed_url_content_type(action, contentType),
+        }
+        # only newer google-cloud-storage releases sign for a universe domain
+        universe_domain = getattr(self.client, 'universe_domain', None)
+        if universe_domain is not None:
+            options['universe_domain'] = universe_domain
+        bucket = self.bucket.name
+        return lambda name: helper(credentials, resource=f'/{bucket}/{quote(name, safe="/~")}', **options)
+
+    # V2 signed urls take integer expiration as an absolute timestamp
+    def _url_lifetime(self, version, expires) -> float:
+        if version == 'v2' and isinstance(expires, int):
+            return expires - time.time()
+        return super()._url_lifetime(version, expires)
 
     def getFiles(self, prefix = None) -> list:
         all_blobs = list(self.client.list_blobs(self.bucket, prefix=prefix))
         return list(map(lambda b: GoogleCloudStorageFile(b), all_blobs))
 
+    def iterFiles(self, prefix = None, page_size = 1000, start_after = None, delimiter = None) -> StorageFileIterator:
+        return StorageFileIterator(self._list_pages(prefix, page_size, start_after, delimiter), start_after)
+
+    def _list_pages(self, prefix, page_size, start_after, delimiter):
+        blobs = self.client.list_blobs(self.bucket, prefix=prefix, delimiter=delimiter,
+            start_offset=start_after)
+        # list_blobs only accepts page_size in newer google-cloud-storage releases,
+        # the iterator's extra query parameters set the page size on all of them
+        if page_size:
+            blobs.extra_params['maxResults'] = page_size
+        for page in blobs.pages:
+            # start_offset is inclusive, start_after is not
+            files = [GoogleCloudStorageFile(b) for b in page if b.name != start_after]
+            yield files, page.prefixes
+
     @property
     def bucket_key(self):
         hostpart = '-'.join(self.apiHost.replace('https://', '').split('.'))
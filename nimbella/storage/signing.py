@@ -0,0 +1,74 @@
+import time
+import datetime
+import threading
+from collections import OrderedDict
+
+# Default maximum number of URLs kept by a SignedUrlCache
+DEFAULT_SIGNED_URL_CACHE_SIZE = 10000
+# Cached URLs are reused while more than this fraction of their lifetime remains
+DEFAULT_MIN_REMAINING = 0.5
+
+# Seconds from now until a signed URL expires, for expires given as a number
+# of seconds, a timedelta or an absolute datetime (naive datetimes are UTC).
+def expires_in(expires) -> float:
+    if isinstance(expires, datetime.timedelta):
+        return expires.total_seconds()
+    if isinstance(expires, datetime.datetime):
+        if expires.tzinfo is None:
+            expires = expires.replace(tzinfo=datetime.timezone.utc)
+        return (expires - datetime.datetime.now(datetime.timezone.utc)).total_seconds()
+    return float(expires)
+
+# In-process LRU cache of signed URLs. A URL is returned while more than
+# min_remaining of its lifetime (from signing to expiry) is left, so callers
+# always get a URL valid for a reasonable fraction of the requested time.
+class SignedUrlCache:
+    def __init__(self, size=DEFAULT_SIGNED_URL_CACHE_SIZE, min_remaining=DEFAULT_MIN_REMAINING):
+        if size <= 0:
+            raise ValueError(f'Invalid cache size: {size}')
+        if not 0 <= min_remaining < 1:
+            raise ValueError(f'Invalid minimum remaining lifetime fraction: {min_remaining}')
+        self.size = size
+        self.min_remaining = min_remaining
+        self.hits = 0
+        self.misses = 0
+        self._urls = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._urls.get(key)
+            if entry is not None:
+                url, reuse_until = entry
+                if now < reuse_until:
+                    self._urls.move_to_end(key)
+                    self.hits += 1
+                    return url
+                del self._urls[key]
+            self.misses += 1
+            return None
+
+    # Cache url signed now, expiring in lifetime seconds
+    def put(self, key, url, lifetime):
+        if lifetime <= 0:
+            return
+        now = time.time()
+        with self._lock:
+            self._urls[key] = (url, now + lifetime * (1 - self.min_remaining))
+            self._urls.move_to_end(key)
+            while len(self._urls) > self.size:
+                self._urls.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._urls.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self._urls),
+                'capacity': self.size,
+            }
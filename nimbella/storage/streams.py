@@ -0,0 +1,233 @@
+import io
+
+# Default read buffer size for storage file streams
+DEFAULT_BUFFER_SIZE = 1024 * 1024
+
+# Ranges separated by at most this many bytes are fetched with a single request
+DEFAULT_COALESCE_GAP = 64 * 1024
+
+# HTTP Range header value for bytes start to end (inclusive). A negative
+# start without end selects the last -start bytes of the object.
+def range_header(start=None, end=None) -> str:
+    start = start or 0
+    if start < 0:
+        if end is not None:
+            raise ValueError('Range end cannot be combined with a negative start')
+        return f'bytes={start}'
+    return f'bytes={start}-{"" if end is None else end}'
+
+# Merge sorted (offset, length) ranges which overlap or are separated by at
+# most max_gap bytes. Returns (start, end, indexes) tuples, where end is
+# inclusive and indexes are positions of the merged ranges in the input.
+def coalesce_ranges(ranges, max_gap=DEFAULT_COALESCE_GAP) -> list:
+    merged = []
+    for index in sorted(range(len(ranges)), key=lambda i: ranges[i][0]):
+        offset, length = ranges[index]
+        if offset < 0 or length < 0:
+            raise ValueError(f'Invalid range: {ranges[index]}')
+        end = offset + length - 1
+        if merged and offset <= merged[-1][1] + 1 + max_gap:
+            merged[-1][1] = max(merged[-1][1], end)
+            merged[-1][2].append(index)
+        else:
+            merged.append([offset, end, [index]])
+    return [tuple(r) for r in merged]
+
+# Raw, read-only & seekable stream over the contents of a storage file.
+# Sequential reads are served from a single streaming response when the
+# provider supports it (file._open_stream), otherwise reads fetch byte ranges
+# with file.download(start, end) of at least min_fetch bytes, keeping the
+# unread part for the following reads. Seeking closes any open response,
+# which is re-opened from the new position on the next read.
+class RangeReader(io.RawIOBase):
+    def __init__(self, file, min_fetch=DEFAULT_BUFFER_SIZE):
+        self._file = file
+        self._size = None
+        self._position = 0
+        self._stream = None
+        self._min_fetch = min_fetch
+        # last fetched range: contents & offset of its first byte
+        self._fetched = b''
+        self._fetched_start = 0
+
+    @property
+    def name(self) -> str:
+        return self._file.name
+
+    @property
+    def size(self) -> int:
+        if self._size is None:
+            self._size = self._file._content_length()
+        return self._size
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self._position + offset
+        elif whence == io.SEEK_END:
+            position = self.size + offset
+        else:
+            raise ValueError(f'Invalid whence value: {whence}')
+        if position < 0:
+            raise ValueError(f'Negative seek position: {position}')
+        if position != self._position:
+            self._close_stream()
+            self._position = position
+        return self._position
+
+    def readinto(self, b) -> int:
+        remaining = self.size - self._position
+        if remaining <= 0 or len(b) == 0:
+            return 0
+        length = min(len(b), remaining)
+
+        if self._stream is None:
+            self._stream = self._file._open_stream(self._position)
+        if self._stream is not None:
+            data = self._stream.read(length)
+        else:
+            offset = self._position - self._fetched_start
+            if not 0 <= offset < len(self._fetched):
+                fetch = min(max(length, self._min_fetch), remaining)
+                self._fetched = memoryview(self._file.download(self._position, self._position + fetch - 1))
+                self._fetched_start, offset = self._position, 0
+            data = self._fetched[offset:offset + length]
+
+        n = len(data)
+        b[:n] = data
+        self._position += n
+        return n
+
+    # Read the rest of the file with a single request (or response read)
+    def readall(self) -> bytes:
+        result = bytearray(max(self.size - self._position, 0))
+        view = memoryview(result)
+        n = 0
+        while n < len(result):
+            read = self.readinto(view[n:])
+            if not read:
+                break
+            n += read
+        view.release()
+        return bytes(result[:n])
+
+    def close(self):
+        self._close_stream()
+        self._fetched = b''
+        super().close()
+
+    def _close_stream(self):
+        if self._stream is not None:
+            self._stream.close()
+            self._stream = None
+
+# Raw, read-only & seekable stream over a bytes-like buffer (bytes,
+# bytearray, memoryview, ...), reading slices without copying it first.
+class BufferReader(io.RawIOBase):
+    def __init__(self, buffer):
+        self._view = memoryview(buffer).cast('B')
+        self._position = 0
+
+    def __len__(self):
+        return len(self._view)
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self._position + offset
+        elif whence == io.SEEK_END:
+            position = len(self._view) + offset
+        else:
+            raise ValueError(f'Invalid whence value: {whence}')
+        if position < 0:
+            raise ValueError(f'Negative seek position: {position}')
+        self._position = position
+        return position
+
+    def readinto(self, b) -> int:
+        data = self._view[self._position:self._position + len(b)]
+        n = len(data)
+        b[:n] = data
+        self._position += n
+        return n
+
+# Raw, read-only stream over an iterable of chunks (bytes-like or str).
+# Reads block until the requested size is available or the chunks are
+# exhausted, so short reads only happen at the end of the stream.
+class IterReader(io.RawIOBase):
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._pending = memoryview(b'')
+        self._position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._position
+
+    # Only "seeking" to the current position is supported
+    def seek(self, offset, whence=io.SEEK_SET) -> int:
+        if (whence == io.SEEK_SET and offset == self._position) or (whence == io.SEEK_CUR and offset == 0):
+            return self._position
+        raise io.UnsupportedOperation('IterReader streams are not seekable')
+
+    def readinto(self, b) -> int:
+        view = memoryview(b).cast('B')
+        n = 0
+        while n < len(view):
+            if not self._pending:
+                try:
+                    chunk = next(self._chunks)
+                except StopIteration:
+                    break
+                if isinstance(chunk, str):
+                    chunk = chunk.encode('utf-8')
+                self._pending = memoryview(chunk).cast('B')
+                continue
+            size = min(len(view) - n, len(self._pending))
+            view[n:n + size] = self._pending[:size]
+            self._pending = self._pending[size:]
+            n += size
+        self._position += n
+        return n
+
+# Return (stream, size) for data to upload: str, bytes-like buffers, readable
+# file-like objects or iterables of chunks. size is the number of bytes left
+# in the stream, or None when unknown (non-seekable streams & iterables).
+def as_stream(data):
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        reader = BufferReader(data)
+        return reader, len(reader)
+    if hasattr(data, 'read'):
+        if hasattr(data, 'seekable') and data.seekable():
+            position = data.tell()
+            size = data.seek(0, io.SEEK_END) - position
+            data.seek(position)
+            return data, size
+        return data, None
+    if hasattr(data, '__iter__'):
+        return IterReader(data), None
+    raise TypeError(f'Unsupported data type: {type(data).__name__}')
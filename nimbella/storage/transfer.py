@@ -0,0 +1,108 @@
+import os
+import base64
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Default part size for parallel ranged downloads
+DEFAULT_PART_SIZE = 8 * 1024 * 1024
+# Read size when computing checksums of local files
+CHECKSUM_BLOCK_SIZE = 1024 * 1024
+
+# GCS resumable upload chunks must be a multiple of 256KB
+RESUMABLE_CHUNK_MULTIPLE = 256 * 1024
+
+# Provider-neutral tuning for uploads:
+# - part_size: size of each part of S3 multipart uploads
+# - max_concurrency: number of parts uploaded concurrently (S3)
+# - multipart_threshold: files at least this size use multipart (S3) or
+#   resumable (GCS) uploads instead of a single request
+# - resumable_chunk_size: size of each chunk of GCS resumable uploads,
+#   rounded up to a multiple of 256KB
+# - max_retries: retries for a failed GCS resumable upload chunk (with
+#   google-cloud-storage releases taking a retry policy instead, 0 disables
+#   the default policy) and for S3 downloads. S3 upload requests, including
+#   each multipart part, are retried by the client (AWSStoragePlugin.max_attempts)
+class TransferConfig:
+    def __init__(self, part_size=DEFAULT_PART_SIZE, max_concurrency=10, multipart_threshold=DEFAULT_PART_SIZE,
+            resumable_chunk_size=DEFAULT_PART_SIZE, max_retries=3):
+        if part_size <= 0 or max_concurrency <= 0 or multipart_threshold <= 0 or resumable_chunk_size <= 0:
+            raise ValueError('Transfer sizes and concurrency must be positive')
+        self.part_size = part_size
+        self.max_concurrency = max_concurrency
+        self.multipart_threshold = multipart_threshold
+        self.resumable_chunk_size = -(-resumable_chunk_size // RESUMABLE_CHUNK_MULTIPLE) * RESUMABLE_CHUNK_MULTIPLE
+        self.max_retries = max_retries
+
+    def __repr__(self):
+        return (f'TransferConfig(part_size={self.part_size}, max_concurrency={self.max_concurrency}, '
+            f'multipart_threshold={self.multipart_threshold}, resumable_chunk_size={self.resumable_chunk_size}, '
+            f'max_retries={self.max_retries})')
+
+DEFAULT_TRANSFER_CONFIG = TransferConfig()
+
+# Write data at offset of file descriptor, without moving a shared file position.
+def _pwrite(fd, data, offset, lock):
+    view = memoryview(data)
+    if hasattr(os, 'pwrite'):
+        while view:
+            written = os.pwrite(fd, view, offset)
+            view = view[written:]
+            offset += written
+    else:
+        with lock:
+            os.lseek(fd, offset, os.SEEK_SET)
+            while view:
+                view = view[os.write(fd, view):]
+
+# Download size bytes of file into the local path, fetching part_size byte
+# ranges concurrently and writing each part at its offset in the
+# preallocated destination file. With version, every range is read from that
+# version of the file (see AbstractStorageFile._download_version).
+def parallel_download(file, path, size, part_size=DEFAULT_PART_SIZE, workers=8, version=None):
+    if part_size <= 0:
+        raise ValueError(f'Invalid part size: {part_size}')
+    lock = threading.Lock()
+    fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.ftruncate(fd, size)
+
+        def fetch(start):
+            end = min(start + part_size, size) - 1
+            if version is None:
+                data = file.download(start, end)
+            else:
+                data = file._download_version(start, end, version)
+            if len(data) != end - start + 1:
+                raise Exception(f'Short read for {file.name} bytes {start}-{end}: {len(data)} bytes')
+            _pwrite(fd, data, start, lock)
+
+        offsets = range(0, size, part_size)
+        if len(offsets) > 1 and workers > 1:
+            with ThreadPoolExecutor(max_workers=min(workers, len(offsets))) as executor:
+                list(executor.map(fetch, offsets))
+        else:
+            list(map(fetch, offsets))
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+# Checksum object for algorithm ('md5' or 'crc32c').
+def _checksum_object(algorithm):
+    if algorithm == 'md5':
+        return hashlib.md5()
+    if algorithm == 'crc32c':
+        import google_crc32c
+        return google_crc32c.Checksum()
+    raise ValueError(f'Unsupported checksum algorithm: {algorithm}')
+
+# Raise exception when local file contents do not match the expected
+# (base64 encoded) provider checksum.
+def verify_checksum(path, algorithm, expected):
+    checksum = _checksum_object(algorithm)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(CHECKSUM_BLOCK_SIZE), b''):
+            checksum.update(block)
+    actual = base64.b64encode(checksum.digest()).decode('ascii')
+    if actual != expected:
+        raise Exception(f'Checksum mismatch for {path}: expected {algorithm} {expected}, got {actual}')
@@ -0,0 +1,111 @@
+from nimbella import aio, redis_pool
+
+import os
+import sys
+import asyncio
+import threading
+import unittest
+from unittest.mock import MagicMock, patch
+
+class TestAio(unittest.TestCase):
+    def tearDown(self):
+        aio.set_concurrency(aio.DEFAULT_CONCURRENCY)
+        redis_pool.reset_pools()
+
+    def test_async_proxy_runs_on_thread_pool(self):
+        target = MagicMock()
+        target.name = 'file.txt'
+        target.download.side_effect = lambda: threading.current_thread().name
+        proxy = aio.AsyncProxy(target)
+
+        self.assertEqual(proxy.name, 'file.txt')
+        thread = asyncio.run(proxy.download())
+        self.assertTrue(thread.startswith('nimbella-aio'))
+
+    def test_concurrency_limit(self):
+        aio.set_concurrency(2)
+        lock = threading.Lock()
+        active = [0, 0]
+        def work():
+            with lock:
+                active[0] += 1
+                active[1] = max(active[1], active[0])
+            threading.Event().wait(0.01)
+            with lock:
+                active[0] -= 1
+
+        async def main():
+            await asyncio.gather(*[aio.run(work) for _ in range(8)])
+        asyncio.run(main())
+        self.assertEqual(active[1], 2)
+
+        with self.assertRaises(ValueError):
+            aio.set_concurrency(0)
+
+    @patch.dict(os.environ, {'__NIM_REDIS_IP': '10.0.0.1', '__NIM_REDIS_PASSWORD': 'secret'})
+    @patch.dict(sys.modules, {'redis.asyncio': None})
+    def test_fallback_redis_pool_sized_for_thread_pool(self):
+        aio.set_concurrency(24)
+        client = asyncio.run(aio.redis())
+        self.assertIsInstance(client, aio.AsyncProxy)
+        pool = client._target.connection_pool
+        self.assertIsInstance(pool, redis_pool.ReapingConnectionPool)
+        self.assertEqual(pool.max_connections, 24)
+
+    @patch.dict(os.environ, {'__NIM_REDIS_IP': '10.0.0.1', '__NIM_REDIS_PASSWORD': 'secret'})
+    @patch.dict(sys.modules, {'redis.asyncio': MagicMock()})
+    def test_native_redis_rejects_idle_timeout(self):
+        with self.assertRaises(ValueError):
+            asyncio.run(aio.redis(idle_timeout=60))
+
+    def test_file_metadata_attribute_is_not_blocking(self):
+        f = aio.AsyncStorageFile(MagicMock())
+        with self.assertRaises(TypeError):
+            f.metadata
+        with self.assertRaises(TypeError):
+            f.metadata = {'a': '1'}
+
+    @patch.dict(os.environ, {'__NIM_REDIS_IP': '10.0.0.1', '__NIM_REDIS_PASSWORD': 'secret'})
+    def test_esql(self):
+        async def main():
+            sql = await aio.esql()
+            self.assertIsInstance(sql, aio.AsyncRedisqlite)
+            return sql
+        sql = asyncio.run(main())
+        self.assertIsNotNone(sql.redis.execute_command)
+
+    def test_async_redisqlite(self):
+        responses = [[b'{"i":1}', b'{"i":2}'], [3, 3]]
+        async def execute_command(*args):
+            return responses.pop(0)
+        sql = aio.AsyncRedisqlite(MagicMock(execute_command=execute_command))
+
+        async def main():
+            return await sql.map("select * from t where i>?", 0, limit=2), await sql.exec("insert into t(i) values(?)", 3)
+        self.assertEqual(asyncio.run(main()), ([{"i": 1}, {"i": 2}], [3, 3]))
+
+    def test_storage_wrappers(self):
+        plugin = MagicMock()
+        plugin.url = 'https://bucket'
+        plugin.file.return_value.download.return_value = b'data'
+        plugin.file.return_value.metadata = {'a': '1'}
+        plugin.iterFiles.return_value = iter([MagicMock(), MagicMock()])
+        plugin.file.return_value.iter_chunks.return_value = iter([b'da', b'ta'])
+
+        with patch('nimbella.nimbella.storage', return_value=plugin):
+            async def main():
+                bucket = await aio.storage(web=True)
+                f = bucket.file('file.txt')
+                files = [f async for f in bucket.iterFiles('prefix/')]
+                chunks = [c async for c in f.iter_chunks(2)]
+                await f.set_metadata({'b': '2'})
+                return bucket.url, await f.download(), await f.get_metadata(), files, chunks
+            url, data, metadata, files, chunks = asyncio.run(main())
+
+        self.assertEqual(url, 'https://bucket')
+        self.assertEqual(data, b'data')
+        self.assertEqual(metadata, {'b': '2'})
+        self.assertEqual(len(files), 2)
+        self.assertTrue(all(isinstance(f, aio.AsyncStorageFile) for f in files))
+        self.assertEqual(chunks, [b'da', b'ta'])
+        plugin.iterFiles.assert_called_with('prefix/')
@@ -1,8 +1,12 @@
 from nimbella.storage.plugins.aws_storage_plugin import AWSStoragePlugin, S3StorageFile
+from nimbella.storage.transfer import TransferConfig
 
 
+import io
+import os
+import tempfile
 import unittest
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, ANY
 from unittest.mock import patch, mock_open
 from types import SimpleNamespace
 
@@ -15,7 +19,7 @@ class TestAWSStoragePlugin(unittest.TestCase):
         client = MagicMock()
         client.resource = MagicMock(return_value=MagicMock())
         aws = AWSStoragePlugin(client, '', '', '', {})
-        client.resource.assert_called_with('s3', endpoint_url=None)
+        client.resource.assert_called_with('s3', endpoint_url=None, config=ANY)
         client.resource().Bucket.assert_called_with(aws.bucket_key)
 
     def test_constructor_with_endpoint(self):
@@ -23,9 +27,26 @@ class TestAWSStoragePlugin(unittest.TestCase):
         client.resource = MagicMock(return_value=MagicMock())
         endpoint = "https://some.host.com"
         aws = AWSStoragePlugin(client, '', '', '', { "endpoint": endpoint })
-        client.resource.assert_called_with('s3', endpoint_url=endpoint)
+        client.resource.assert_called_with('s3', endpoint_url=endpoint, config=ANY)
         client.resource().Bucket.assert_called_with(aws.bucket_key)
 
+    def test_client_config(self):
+        client = MagicMock()
+        aws = AWSStoragePlugin(client, '', '', '', {}, max_pool_connections=64)
+        config = client.resource.call_args[1]['config']
+        self.assertEqual(config.max_pool_connections, 64)
+        self.assertIs(aws.s3, client.resource().meta.client)
+
+    def test_files_share_client(self):
+        client = MagicMock()
+        files = [SimpleNamespace(key="a-file"), SimpleNamespace(key="b-file")]
+        aws = AWSStoragePlugin(client, '', '', True, {})
+        aws.bucket.objects.filter = MagicMock(return_value=files)
+
+        clients = [f.client for f in aws.getFiles()] + [aws.file("c-file").client]
+        self.assertTrue(all(c is aws.s3 for c in clients))
+        client.client.assert_not_called()
+
     def test_bucket_key_property(self):
         client = MagicMock()
         namespace = 'this-is-a-namespace'
@@ -66,26 +87,26 @@ class TestAWSStoragePlugin(unittest.TestCase):
 
     def test_bucket_delete_files(self):
         prefix = "folder/"
-        files = [
-            SimpleNamespace(key="folder/a-file"),
-            SimpleNamespace(key="folder/b-file"),
-            SimpleNamespace(key="folder/c-file"),
-        ]
-        keys = list(map(lambda f: f.key, files))
-
+        keys = [f"folder/{i}-file" for i in range(2500)]
         client = MagicMock()
 
         aws = AWSStoragePlugin(client, '', '', True, {})
-        aws.bucket.delete_objects = MagicMock()
-        aws.bucket.objects.filter = MagicMock(return_value=files)
-        aws.bucket.Object = MagicMock(side_effect=lambda key: SimpleNamespace(key=key))
+        paginator = aws.s3.get_paginator.return_value
+        paginator.paginate.return_value = [
+            {"Contents": [{"Key": k} for k in keys[:1500]]},
+            {"Contents": [{"Key": k} for k in keys[1500:]]},
+        ]
+        aws.s3.delete_objects = MagicMock(side_effect=lambda **kwargs: {
+            "Errors": [{"Key": "folder/7-file", "Code": "AccessDenied", "Message": "Access Denied"}]
+        } if kwargs["Delete"]["Objects"][0]["Key"] == "folder/0-file" else {})
 
-        aws.deleteFiles(prefix)
+        result = aws.deleteFiles(prefix, workers=2)
 
-        aws.bucket.delete_objects.assert_called_with(Delete={
-            "Objects": list(map(lambda o: {"Key": o.key}, files))
-        })
-        aws.bucket.objects.filter.assert_called_with(Prefix=prefix)
+        self.assertEqual(result.failed, {"folder/7-file": "Access Denied"})
+        self.assertEqual(sorted(result.succeeded), sorted(k for k in keys if k != "folder/7-file"))
+        batches = [c[1]["Delete"]["Objects"] for c in aws.s3.delete_objects.call_args_list]
+        self.assertEqual(sorted(len(b) for b in batches), [500, 1000, 1000])
+        paginator.paginate.assert_called_with(Bucket=aws.bucket_key, Prefix=prefix, PaginationConfig={"PageSize": 1000})
 
     def test_bucket_get_files(self):
         client = MagicMock()
@@ -106,6 +127,29 @@ class TestAWSStoragePlugin(unittest.TestCase):
         self.assertEqual(files_keys, keys)
         aws.bucket.objects.filter.assert_called_with(Prefix=prefix)
 
+    def test_bucket_iter_files(self):
+        client = MagicMock()
+        aws = AWSStoragePlugin(client, '', '', True, {})
+        aws.bucket.Object = MagicMock(side_effect=lambda key: SimpleNamespace(key=key))
+        pages = [
+            {"Contents": [{"Key": "folder/a-file"}, {"Key": "folder/b-file"}], "CommonPrefixes": [{"Prefix": "folder/sub/"}]},
+            {"Contents": [{"Key": "folder/c-file"}]},
+        ]
+        paginator = aws.s3.get_paginator.return_value
+        paginator.paginate.return_value = iter(pages)
+
+        files = aws.iterFiles("folder/", page_size=2, start_after="folder/0", delimiter="/")
+        paginator.paginate.assert_not_called()
+
+        self.assertEqual(next(files).name, "folder/a-file")
+        self.assertEqual(files.continuation_token, "folder/a-file")
+        self.assertEqual([f.name for f in files], ["folder/b-file", "folder/c-file"])
+        self.assertEqual(files.continuation_token, "folder/c-file")
+        self.assertEqual(files.prefixes, {"folder/sub/"})
+        aws.s3.get_paginator.assert_called_with('list_objects_v2')
+        paginator.paginate.assert_called_with(Bucket=aws.bucket_key, Prefix="folder/",
+            StartAfter="folder/0", Delimiter="/", PaginationConfig={"PageSize": 2})
+
     def test_bucket_get_file(self):
         client = MagicMock()
         destination = 'folder/file.txt'
@@ -145,7 +189,63 @@ class TestAWSStoragePlugin(unittest.TestCase):
         aws.bucket.upload_file = MagicMock()
 
         aws.upload(path, destination, contentType, cacheControl)
-        aws.bucket.upload_file.assert_called_with(path, destination, ExtraArgs=extraArgs)
+        aws.bucket.upload_file.assert_called_with(path, destination, ExtraArgs=extraArgs, Config=ANY)
+
+        config = TransferConfig(part_size=16 * 1024 * 1024, max_concurrency=4, multipart_threshold=64 * 1024 * 1024)
+        aws.upload(path, destination, contentType, cacheControl, config)
+        boto_config = aws.bucket.upload_file.call_args[1]['Config']
+        self.assertEqual(boto_config.multipart_chunksize, 16 * 1024 * 1024)
+        self.assertEqual(boto_config.multipart_threshold, 64 * 1024 * 1024)
+        self.assertEqual(boto_config.max_concurrency, 4)
+
+    def test_file_save(self):
+        s3_file = MagicMock(key='file.txt')
+        file = S3StorageFile(s3_file, True, MagicMock())
+        config = TransferConfig(multipart_threshold=10)
+
+        file.save('small', 'text/plain', config)
+        s3_file.put.assert_called_with(Body=b'small', ContentType='text/plain', ACL='public-read')
+
+        file.save(b'large contents', 'text/plain', config)
+        s3_file.upload_fileobj.assert_called_with(ANY, ExtraArgs={'ContentType': 'text/plain', 'ACL': 'public-read'}, Config=ANY)
+        self.assertEqual(s3_file.upload_fileobj.call_args[0][0].read(), b'large contents')
+
+        buffer = bytearray(b'buffer')
+        file.save(memoryview(buffer), 'text/plain', config)
+        body = s3_file.put.call_args[1]['Body']
+        self.assertEqual(body.read(), b'buffer')
+        buffer[0:1] = b'B'
+        body.seek(0)
+        self.assertEqual(body.read(), b'Buffer')
+
+        file.save((c for c in [b'gen', b'erated']), 'text/plain', config)
+        self.assertEqual(s3_file.upload_fileobj.call_args[0][0].read(), b'generated')
+
+    def test_bucket_upload_directory(self):
+        client = MagicMock()
+        aws = AWSStoragePlugin(client, '', '', True, {})
+        def upload(path, *args):
+            if path.endswith('.bin'):
+                raise Exception('failed')
+        aws.upload = MagicMock(side_effect=upload)
+
+        with tempfile.TemporaryDirectory() as local_dir:
+            os.makedirs(os.path.join(local_dir, 'css'))
+            for name in ['index.html', 'css/site.css', 'blob.bin']:
+                with open(os.path.join(local_dir, name), 'w') as f:
+                    f.write(name)
+
+            result = aws.uploadDirectory(local_dir, 'site/', workers=2)
+
+            self.assertEqual(sorted(result.succeeded), ['site/css/site.css', 'site/index.html'])
+            self.assertEqual(result.failed, {'site/blob.bin': 'failed'})
+            aws.upload.assert_any_call(os.path.join(local_dir, 'index.html'), 'site/index.html', 'text/html', 'no-cache', None)
+            aws.upload.assert_any_call(os.path.join(local_dir, 'css', 'site.css'), 'site/css/site.css', 'text/css', 'public, max-age=3600', None)
+            aws.upload.assert_any_call(os.path.join(local_dir, 'blob.bin'), 'site/blob.bin', 'application/octet-stream', 'public, max-age=3600', None)
+
+            aws.upload.reset_mock()
+            aws.uploadDirectory(os.path.join(local_dir, 'css'), cacheControl=lambda path: 'max-age=60')
+            aws.upload.assert_called_once_with(os.path.join(local_dir, 'css', 'site.css'), 'site.css', 'text/css', 'max-age=60', None)
 
     def test_file_signedurl_get(self):
         presigned_url = "https://some-url.com/"
@@ -183,3 +283,150 @@ class TestAWSStoragePlugin(unittest.TestCase):
         self.assertEqual(url, presigned_url)
         client.generate_presigned_url.assert_called_with('put_object', Params={'Bucket': bucket, 
             'Key': destination, 'ContentType': contentType}, ExpiresIn=expires)
+
+    def test_file_open(self):
+        contents = b'Hello World!'
+        s3_file = MagicMock(key='file.txt', content_length=len(contents))
+        s3_file.get.side_effect = lambda Range: {'Body': io.BytesIO(contents[int(Range[6:-1]):])}
+        file = S3StorageFile(s3_file, False, MagicMock())
+
+        with file.open() as f:
+            f.seek(6)
+            self.assertEqual(f.read(), b'World!')
+        s3_file.get.assert_called_once_with(Range='bytes=6-')
+
+        self.assertEqual(list(file.iter_chunks(5)), [b'Hello', b' Worl', b'd!'])
+
+    def test_file_open_invalid_mode(self):
+        file = S3StorageFile(MagicMock(), False, MagicMock())
+        with self.assertRaises(ValueError):
+            file.open('wb')
+
+    def test_file_download_range(self):
+        s3_file = MagicMock(key='file.txt')
+        s3_file.get.return_value = {'Body': io.BytesIO(b'data')}
+        file = S3StorageFile(s3_file, False, MagicMock())
+
+        self.assertEqual(file.download(), b'data')
+        s3_file.get.assert_called_with()
+        file.download(10, 19)
+        s3_file.get.assert_called_with(Range='bytes=10-19')
+        file.read_range(-100, 100)
+        s3_file.get.assert_called_with(Range='bytes=-100')
+
+    def test_file_download_to_path_pinned_to_etag(self):
+        s3_file = MagicMock(key='file.txt', content_length=4, e_tag='"abc"')
+        s3_file.get.return_value = {'Body': io.BytesIO(b'data')}
+        file = S3StorageFile(s3_file, False, MagicMock())
+        with tempfile.TemporaryDirectory() as directory:
+            file.download_to_path(os.path.join(directory, 'file.txt'), verify=False)
+        s3_file.get.assert_called_once_with(Range='bytes=0-3', IfMatch='"abc"')
+
+    def test_file_checksum(self):
+        s3_file = MagicMock(key='file.txt', e_tag='"5d41402abc4b2a76b9719d911017c592"',
+            server_side_encryption=None, sse_customer_algorithm=None)
+        file = S3StorageFile(s3_file, False, MagicMock())
+        self.assertEqual(file._checksum(), ('md5', 'XUFAKrxLKna5cZ2REBfFkg=='))
+
+        s3_file.e_tag = '"5d41402abc4b2a76b9719d911017c592-4"'
+        self.assertIsNone(file._checksum())
+
+    def test_file_checksum_encrypted(self):
+        s3_file = MagicMock(key='file.txt', e_tag='"5d41402abc4b2a76b9719d911017c592"',
+            server_side_encryption='aws:kms', sse_customer_algorithm=None)
+        file = S3StorageFile(s3_file, False, MagicMock())
+        self.assertIsNone(file._checksum())
+        s3_file.server_side_encryption = 'AES256'
+        self.assertEqual(file._checksum(), ('md5', 'XUFAKrxLKna5cZ2REBfFkg=='))
+        s3_file.sse_customer_algorithm = 'AES256'
+        self.assertIsNone(file._checksum())
+
+        client = MagicMock()
+        client.head_object.return_value = {'ContentLength': 5, 'ETag': '"5d41402abc4b2a76b9719d911017c592"',
+            'ServerSideEncryption': 'aws:kms'}
+        self.assertIsNone(S3StorageFile(MagicMock(key='file.txt'), False, client).stat().md5)
+
+    def test_file_stat(self):
+        import datetime
+        import botocore.exceptions
+        client = MagicMock()
+        client.head_object.return_value = {'ContentLength': 5, 'ETag': '"5d41402abc4b2a76b9719d911017c592"',
+            'ContentType': 'text/plain', 'CacheControl': 'no-cache', 'Metadata': {'a': '1'},
+            'LastModified': datetime.datetime(2020, 1, 1)}
+        file = S3StorageFile(MagicMock(key='file.txt', bucket_name='bucket'), False, client)
+
+        stat = file.stat()
+        self.assertEqual((stat.name, stat.size, stat.md5, stat.content_type, stat.cache_control),
+            ('file.txt', 5, 'XUFAKrxLKna5cZ2REBfFkg==', 'text/plain', 'no-cache'))
+        self.assertEqual(file.metadata, {'a': '1'})
+        with self.assertRaises(TypeError):
+            stat.metadata['b'] = '2'
+        client.head_object.assert_called_once_with(Bucket='bucket', Key='file.txt')
+
+        file.stat(refresh=True)
+        self.assertEqual(client.head_object.call_count, 2)
+
+        client.head_object.side_effect = botocore.exceptions.ClientError({'Error': {'Code': '404'}}, 'HeadObject')
+        file.delete()
+        with self.assertRaises(FileNotFoundError):
+            file.stat()
+        self.assertEqual(file.metadata, {})
+
+    def test_bucket_stat_many(self):
+        import botocore.exceptions
+        client = MagicMock()
+        aws = AWSStoragePlugin(client, '', '', False, {})
+        aws.bucket.Object.side_effect = lambda key: MagicMock(key=key, bucket_name='bucket')
+        def head_object(Bucket, Key):
+            if Key == 'missing':
+                raise botocore.exceptions.ClientError({'Error': {'Code': '404'}}, 'HeadObject')
+            return {'ContentLength': len(Key)}
+        aws.s3.head_object.side_effect = head_object
+
+        stats = aws.statMany(['a', 'missing', 'abc'])
+        self.assertEqual(list(stats), ['a', 'missing', 'abc'])
+        self.assertEqual([s and s.size for s in stats.values()], [1, None, 3])
+
+    def test_bucket_set_metadata_many(self):
+        import botocore.exceptions
+        client = MagicMock()
+        aws = AWSStoragePlugin(client, '', '', True, {})
+        aws.bucket.Object.side_effect = lambda key: MagicMock(key=key, bucket_name='bucket')
+        def head_object(Bucket, Key):
+            if Key == 'missing':
+                raise botocore.exceptions.ClientError({'Error': {'Code': '404'}}, 'HeadObject')
+            return {'ContentType': 'text/html', 'CacheControl': 'no-cache'}
+        aws.s3.head_object.side_effect = head_object
+
+        result = aws.setMetadataMany({'index.html': {'v': '2'}, 'missing': {'v': '2'}})
+        self.assertEqual(result.succeeded, ['index.html'])
+        self.assertEqual(list(result.failed), ['missing'])
+        aws.s3.copy_object.assert_called_once_with(Bucket='bucket', Key='index.html',
+            CopySource={'Bucket': 'bucket', 'Key': 'index.html'}, Metadata={'v': '2'}, MetadataDirective='REPLACE',
+            ContentType='text/html', CacheControl='no-cache', ACL='public-read')
+
+    def test_bucket_signed_urls(self):
+        client = MagicMock()
+        aws = AWSStoragePlugin(client, 'ns', 'https://api.host.com', False, {})
+        aws.s3.generate_presigned_url.side_effect = lambda method, Params, ExpiresIn: f'{method}:{Params["Key"]}'
+
+        urls = aws.signedUrls(['a', 'b'], 'GET', 600, 'text/plain')
+        self.assertEqual(urls, {'a': 'get_object:a', 'b': 'get_object:b'})
+        aws.s3.generate_presigned_url.assert_called_with('get_object', Params={'Bucket': aws.bucket_key,
+            'ResponseContentType': 'text/plain', 'Key': 'b'}, ExpiresIn=600)
+
+        aws.signedUrls(['a', 'b'], 'PUT', 600, 'text/plain', cache=True)
+        aws.signedUrls(['a', 'c'], 'PUT', 600, 'text/plain', cache=True)
+        self.assertEqual(aws.s3.generate_presigned_url.call_count, 5)
+        self.assertEqual(aws.signedUrlCache.stats()['hits'], 1)
+
+    def test_file_conditional_download(self):
+        import botocore.exceptions
+        s3_file = MagicMock(key='file.txt')
+        s3_file.get.return_value = {'Body': io.BytesIO(b'data'), 'ETag': '"v2"'}
+        file = S3StorageFile(s3_file, False, MagicMock())
+
+        self.assertEqual(file._download_if_changed('"v1"'), (b'data', '"v2"'))
+        s3_file.get.assert_called_with(IfNoneMatch='"v1"')
+        s3_file.get.side_effect = botocore.exceptions.ClientError({'Error': {'Code': '304'}}, 'GetObject')
+        self.assertIsNone(file._download_if_changed('"v2"'))
@@ -0,0 +1,61 @@
+from nimbella.storage.bulk import BulkResult, chunked, run_batches
+
+import threading
+import unittest
+
+class TestBulk(unittest.TestCase):
+    def test_chunked(self):
+        self.assertEqual(list(chunked(range(7), 3)), [[0, 1, 2], [3, 4, 5], [6]])
+        self.assertEqual(list(chunked([], 3)), [])
+
+    def test_chunked_is_lazy(self):
+        consumed = []
+        def items():
+            for i in range(10):
+                consumed.append(i)
+                yield i
+        chunks = chunked(items(), 2)
+        next(chunks)
+        self.assertEqual(consumed, [0, 1])
+
+    def test_run_batches(self):
+        def fn(chunk):
+            failed = {i: 'odd' for i in chunk if i % 2}
+            return [i for i in chunk if i not in failed], failed
+
+        result = run_batches(chunked(range(100), 7), fn, workers=4)
+        self.assertEqual(sorted(result.succeeded), list(range(0, 100, 2)))
+        self.assertEqual(sorted(result.failed), list(range(1, 100, 2)))
+        self.assertFalse(result.ok)
+        self.assertEqual(len(result), 100)
+
+    def test_run_batches_records_chunk_exceptions(self):
+        def fn(chunk):
+            if 3 in chunk:
+                raise Exception('boom')
+            return chunk, {}
+
+        result = run_batches(chunked(range(6), 2), fn, workers=2, key=str)
+        self.assertEqual(sorted(result.succeeded), [0, 1, 4, 5])
+        self.assertEqual(result.failed, {'2': 'boom', '3': 'boom'})
+
+    def test_run_batches_bounds_concurrency(self):
+        lock = threading.Lock()
+        active = [0, 0]
+        def fn(chunk):
+            with lock:
+                active[0] += 1
+                active[1] = max(active[1], active[0])
+            threading.Event().wait(0.001)
+            with lock:
+                active[0] -= 1
+            return chunk, {}
+
+        result = run_batches(chunked(range(50), 1), fn, workers=3)
+        self.assertEqual(len(result.succeeded), 50)
+        self.assertLessEqual(active[1], 3)
+
+    def test_empty_result(self):
+        result = BulkResult()
+        self.assertTrue(result.ok)
+        self.assertEqual(len(result), 0)
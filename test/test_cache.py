@@ -0,0 +1,141 @@
+from nimbella.storage.cache import DiskCache, CachedStoragePlugin, STALE_TEMP_FILE_AGE
+
+import os
+import time
+import tempfile
+import unittest
+from unittest.mock import MagicMock
+
+# Provider file stand-in with versioned contents & conditional downloads
+class FakeFile:
+    def __init__(self, name, data):
+        self.name = name
+        self.data = data
+        self.version = 1
+        self.fetches = []
+
+    def download(self, start=None, end=None):
+        self.fetches.append(('range', start, end))
+        return self.data[start:end + 1]
+
+    def _download_if_changed(self, validator):
+        self.fetches.append(('conditional', validator))
+        if validator == str(self.version):
+            return None
+        return self.data, str(self.version)
+
+    def save(self, data, contentType):
+        self.data = data
+        self.version += 1
+
+class TestDiskCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.files = {}
+        self.plugin = MagicMock(bucket_key='bucket')
+        self.plugin.id.return_value = '@nimbella/storage-test'
+        self.plugin.file.side_effect = lambda name: self.files.setdefault(name, FakeFile(name, b'contents of ' + name.encode()))
+
+    def cached(self, **kwargs):
+        return CachedStoragePlugin(self.plugin, directory=self.tmp.name, **kwargs)
+
+    def test_hits_within_ttl_skip_provider(self):
+        bucket = self.cached(ttl=60)
+        self.assertEqual(bucket.file('a').download(), b'contents of a')
+        self.assertEqual(bucket.file('a').download(), b'contents of a')
+        self.assertEqual(bytes(bucket.file('a').mmap()), b'contents of a')
+        self.assertEqual(self.files['a'].fetches, [('conditional', None)])
+        stats = bucket.cacheStats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['bytes_saved']), (2, 1, 26))
+
+    def test_revalidation(self):
+        bucket = self.cached(ttl=0)
+        f = bucket.file('a')
+        f.download()
+        self.assertEqual(f.download(), b'contents of a')
+        self.assertEqual(bucket.cacheStats()['revalidations'], 1)
+
+        # changed by another writer
+        self.files['a'].save(b'new contents', 'text/plain')
+        self.assertEqual(f.download(), b'new contents')
+        self.assertEqual(self.files['a'].fetches, [('conditional', None), ('conditional', '1'), ('conditional', '1')])
+
+    def test_ranges(self):
+        bucket = self.cached()
+        f = bucket.file('a')
+        self.assertEqual(f.read_range(0, 8), b'contents')
+        self.assertEqual(self.files['a'].fetches, [('range', 0, 7)])
+        f.download()
+        self.assertEqual(f.read_range(-1, 1), b'a')
+        self.assertEqual(f.download(9, 10), b'of')
+        self.assertEqual(len(self.files['a'].fetches), 2)
+
+    def test_writes_invalidate(self):
+        bucket = self.cached()
+        f = bucket.file('a')
+        f.download()
+        f.save(b'saved', 'text/plain')
+        self.assertEqual(f.download(), b'saved')
+        bucket.deleteFiles('a')
+        self.assertEqual(bucket.cacheStats()['objects'], 0)
+        self.plugin.deleteFiles.assert_called_with('a')
+
+    def test_size_bound_evicts_least_recently_used(self):
+        bucket = self.cached(max_bytes=30)
+        bucket.file('a').download()
+        bucket.file('b').download()
+        bucket.file('c').download()
+        stats = bucket.cacheStats()
+        self.assertEqual((stats['objects'], stats['evictions'], stats['size']), (2, 1, 26))
+        self.assertEqual(len([f for f in os.listdir(bucket.cache.directory)]), 4)
+
+    def test_entries_reused_after_restart(self):
+        self.cached().file('a').download()
+        bucket = self.cached()
+        self.assertEqual(bucket.file('a').download(), b'contents of a')
+        self.assertEqual(self.files['a'].fetches, [('conditional', None), ('conditional', '1')])
+        self.assertEqual(bucket.cacheStats()['revalidations'], 1)
+
+    def test_iter_files_are_cached(self):
+        self.plugin.iterFiles.return_value = MagicMock(continuation_token='b',
+            __next__=MagicMock(side_effect=[self.plugin.file('a'), self.plugin.file('b'), StopIteration]))
+        bucket = self.cached()
+        files = bucket.iterFiles('', page_size=2)
+        self.assertEqual([f.download() for f in files], [b'contents of a', b'contents of b'])
+        self.assertEqual(files.continuation_token, 'b')
+        self.assertEqual(bucket.cacheStats()['objects'], 2)
+
+    def test_streams_and_local_copies_read_cached_files(self):
+        bucket = self.cached()
+        f = bucket.file('a')
+        f.download()
+        with f.open() as stream:
+            self.assertEqual(stream.read(), b'contents of a')
+        self.assertEqual(list(f.iter_chunks(5)), [b'conte', b'nts o', b'f a'])
+        path = os.path.join(self.tmp.name, 'a.copy')
+        self.assertEqual(f.download_to_path(path), path)
+        with open(path, 'rb') as copy:
+            self.assertEqual(copy.read(), b'contents of a')
+        self.assertEqual(self.files['a'].fetches, [('conditional', None)])
+
+        # files not cached yet are read from the provider
+        self.files['b'] = MagicMock()
+        bucket.file('b').open()
+        self.files['b'].open.assert_called_once()
+
+    def test_only_stale_temporary_files_removed(self):
+        directory = os.path.join(self.tmp.name, 'cache')
+        os.makedirs(directory)
+        fresh, stale = os.path.join(directory, 'fresh.tmp'), os.path.join(directory, 'stale.tmp')
+        for path in (fresh, stale):
+            open(path, 'wb').close()
+        old = time.time() - STALE_TEMP_FILE_AGE - 1
+        os.utime(stale, (old, old))
+        DiskCache(directory)
+        self.assertTrue(os.path.exists(fresh))
+        self.assertFalse(os.path.exists(stale))
+
+    def test_invalid_settings(self):
+        with self.assertRaises(ValueError):
+            DiskCache(self.tmp.name, max_bytes=0)
@@ -1,10 +1,16 @@
-from nimbella.storage.plugins.gcs_storage_plugin import GoogleCloudStoragePlugin, GoogleCloudStorageFile
+from nimbella.storage.plugins.gcs_storage_plugin import GoogleCloudStoragePlugin, GoogleCloudStorageFile, upload_retry_args
+from nimbella.storage.transfer import TransferConfig
 
+import io
+import os
+import tempfile
 import unittest
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, ANY
+from types import SimpleNamespace
 from unittest.mock import patch, mock_open
 
 from google.cloud.storage.blob import Blob
+from google.cloud.storage.retry import DEFAULT_RETRY
 
 class TestGoogleCloudStoragePlugin(unittest.TestCase):
     def test_google_storage_plugin_id(self):
@@ -14,7 +20,8 @@ class TestGoogleCloudStoragePlugin(unittest.TestCase):
     def test_constructor(self):
         client = MagicMock()
         gcs = GoogleCloudStoragePlugin(client, '', '', '', '')
-        client.get_bucket.assert_called_with(gcs.bucket_key)
+        client.bucket.assert_called_with(gcs.bucket_key)
+        client.get_bucket.assert_not_called()
 
     def test_bucket_key_property(self):
         client = MagicMock()
@@ -44,21 +51,41 @@ class TestGoogleCloudStoragePlugin(unittest.TestCase):
 
     def test_bucket_delete_files(self):
         prefix = 'folder/'
-        blobs = [
-            Blob(name='folder/a-file', bucket='some-bucket'),
-            Blob(name='folder/b-file', bucket='some-bucket'),
-            Blob(name='folder/c-file', bucket='some-bucket')
-        ]
+        blobs = [Blob(name=f'folder/{i}-file', bucket='some-bucket') for i in range(250)]
         client = MagicMock()
         client.list_blobs = MagicMock(return_value=iter(blobs))
 
         gcs = GoogleCloudStoragePlugin(client, '', '', True, '')
-        gcs.bucket.delete_blobs = MagicMock()
+        gcs.bucket.delete_blob = MagicMock()
 
-        gcs.deleteFiles(prefix)
+        result = gcs.deleteFiles(prefix, workers=2)
 
-        client.list_blobs.assert_called_with(gcs.bucket, prefix=prefix)
-        gcs.bucket.delete_blobs.assert_called_with(blobs)
+        client.list_blobs.assert_called_with(gcs.bucket, prefix=prefix, fields='items(name),nextPageToken')
+        self.assertEqual(client.batch.call_count, 3)
+        self.assertEqual(sorted(result.succeeded), sorted(b.name for b in blobs))
+        self.assertTrue(result.ok)
+
+    def test_bucket_delete_files_batch_failure(self):
+        from google.cloud.exceptions import NotFound, Forbidden
+        blobs = [Blob(name=f'folder/{i}-file', bucket='some-bucket') for i in range(3)]
+        client = MagicMock()
+        client.list_blobs = MagicMock(return_value=iter(blobs))
+        client.batch.return_value.__exit__.side_effect = Forbidden('batch failed')
+
+        gcs = GoogleCloudStoragePlugin(client, '', '', True, '')
+        errors = {'folder/0-file': NotFound('gone'), 'folder/1-file': Forbidden('denied')}
+        calls = []
+        def delete_blob(name):
+            calls.append(name)
+            # first pass is queued in the batch, errors surface on retry
+            if len(calls) > len(blobs) and name in errors:
+                raise errors[name]
+        gcs.bucket.delete_blob = MagicMock(side_effect=delete_blob)
+
+        result = gcs.deleteFiles()
+
+        self.assertEqual(sorted(result.succeeded), ['folder/0-file', 'folder/2-file'])
+        self.assertEqual(list(result.failed.keys()), ['folder/1-file'])
 
     def test_bucket_get_files(self):
         client = MagicMock()
@@ -75,6 +102,29 @@ class TestGoogleCloudStoragePlugin(unittest.TestCase):
         self.assertEqual(file_blobs, blobs)
         client.list_blobs.assert_called_with(gcs.bucket, prefix=prefix)
 
+    def test_bucket_iter_files(self):
+        client = MagicMock()
+        pages = [
+            MagicMock(prefixes=('folder/sub/',), __iter__=lambda _: iter([
+                Blob(name='folder/a-file', bucket='some-bucket'),
+                Blob(name='folder/b-file', bucket='some-bucket')])),
+            MagicMock(prefixes=(), __iter__=lambda _: iter([
+                Blob(name='folder/c-file', bucket='some-bucket')])),
+        ]
+        blobs = SimpleNamespace(pages=iter(pages), extra_params={})
+        client.list_blobs = MagicMock(return_value=blobs)
+        gcs = GoogleCloudStoragePlugin(client, '', '', True, '')
+
+        files = gcs.iterFiles('folder/', page_size=2, start_after='folder/a-file', delimiter='/')
+        client.list_blobs.assert_not_called()
+
+        self.assertEqual([f.name for f in files], ['folder/b-file', 'folder/c-file'])
+        self.assertEqual(files.continuation_token, 'folder/c-file')
+        self.assertEqual(files.prefixes, {'folder/sub/'})
+        client.list_blobs.assert_called_with(gcs.bucket, prefix='folder/', delimiter='/',
+            start_offset='folder/a-file')
+        self.assertEqual(blobs.extra_params, {'maxResults': 2})
+
     def test_bucket_get_file(self):
         client = MagicMock()
         destination = 'folder/file.txt'
@@ -105,10 +155,208 @@ class TestGoogleCloudStoragePlugin(unittest.TestCase):
         blob = Blob(name=destination, bucket='some-bucket')
         gcs = GoogleCloudStoragePlugin(client, '', '', True, '')
         gcs.bucket.blob = MagicMock(return_value=blob)
-        blob.upload_from_file = MagicMock()
-        gcs.upload(path, destination, contentType, cacheControl)
-        gcs.bucket.blob.assert_called_with(destination)
-        blob.upload_from_file.assert_called_with(file_obj=mock_file(path, 'rb'), content_type=contentType)
-        mock_file.assert_called_with(path, 'rb')
+        # autospec keeps the installed library's signature, so unsupported arguments fail
+        with patch.object(Blob, 'upload_from_file', autospec=True) as upload_from_file:
+            with patch('os.path.getsize', return_value=100):
+                gcs.upload(path, destination, contentType, cacheControl)
+            gcs.bucket.blob.assert_called_with(destination)
+            upload_from_file.assert_called_with(blob, file_obj=mock_file(path, 'rb'), content_type=contentType,
+                retry=DEFAULT_RETRY)
+            mock_file.assert_called_with(path, 'rb')
+            self.assertIsNone(blob.chunk_size)
+
+            config = TransferConfig(multipart_threshold=100, resumable_chunk_size=1000 * 1000, max_retries=0)
+            with patch('os.path.getsize', return_value=100):
+                gcs.upload(path, destination, contentType, cacheControl, config)
+            upload_from_file.assert_called_with(blob, file_obj=mock_file(path, 'rb'), content_type=contentType,
+                retry=None)
+            self.assertEqual(blob.chunk_size, 4 * 256 * 1024)
+
+    def test_upload_retries_with_pinned_client(self):
+        with patch('nimbella.storage.plugins.gcs_storage_plugin._UPLOAD_RETRY_POLICY', False):
+            self.assertEqual(upload_retry_args(TransferConfig(max_retries=5)), {'num_retries': 5})
+
+    def test_file_save(self):
+        blob = Blob(name='file.txt', bucket='some-bucket')
+        uploads = []
+        file = GoogleCloudStorageFile(blob)
+        config = TransferConfig(multipart_threshold=10)
+
+        # autospec keeps the installed library's signature, so unsupported arguments fail
+        with patch.object(Blob, 'upload_from_file', autospec=True,
+                side_effect=lambda blob, stream, size, **kwargs: uploads.append((stream.read(), size))) as upload_from_file:
+            file.save('small', 'text/plain', config)
+            upload_from_file.assert_called_with(blob, ANY, size=5, content_type='text/plain', retry=DEFAULT_RETRY)
+            self.assertIsNone(blob.chunk_size)
 
+            file.save(b'large contents', 'text/plain', config)
+            self.assertEqual(blob.chunk_size, config.resumable_chunk_size)
+
+            file.save(memoryview(bytearray(b'buffer')), 'text/plain', config)
+            file.save(io.BytesIO(b'file contents'), 'text/plain', config)
+            file.save((c for c in [b'gen', 'erated']), 'text/plain', config)
+        self.assertEqual(blob.chunk_size, config.resumable_chunk_size)
+        self.assertEqual(uploads, [(b'small', 5), (b'large contents', 14), (b'buffer', 6),
+            (b'file contents', 13), (b'generated', None)])
+
+    def test_file_open(self):
+        contents = b'Hello World!'
+        blob = Blob(name='file.txt', bucket='some-bucket')
+        blob.reload = MagicMock(side_effect=lambda: blob._properties.update(size=str(len(contents))))
+        blob.download_as_bytes = MagicMock(side_effect=lambda start, end: contents[start:end + 1])
+        file = GoogleCloudStorageFile(blob)
+
+        with file.open(buffer_size=4) as f:
+            self.assertEqual(f.read(5), b'Hello')
+            f.seek(-6, 2)
+            self.assertEqual(f.read(), b'World!')
+        blob.reload.assert_called_once()
+        blob.download_as_bytes.assert_any_call(start=0, end=3)
+
+        self.assertEqual(list(file.iter_chunks(5)), [b'Hello', b' Worl', b'd!'])
+
+    def test_file_download_range(self):
+        blob = Blob(name='file.txt', bucket='some-bucket')
+        blob.download_as_bytes = MagicMock(return_value=b'data')
+        file = GoogleCloudStorageFile(blob)
+
+        self.assertEqual(file.download(), b'data')
+        blob.download_as_bytes.assert_called_with()
+        file.read_range(10, 10)
+        blob.download_as_bytes.assert_called_with(start=10, end=19)
+        file.read_range(-100, 100)
+        blob.download_as_bytes.assert_called_with(start=-100, end=None)
+
+    def test_file_download_to_path_pinned_to_generation(self):
+        blob = Blob(name='file.txt', bucket='some-bucket')
+        blob._properties.update({'size': '4', 'generation': '12'})
+        blob.download_as_bytes = MagicMock(return_value=b'data')
+        file = GoogleCloudStorageFile(blob)
+        with tempfile.TemporaryDirectory() as directory:
+            file.download_to_path(os.path.join(directory, 'file.txt'), verify=False)
+        blob.download_as_bytes.assert_called_once_with(start=0, end=3, if_generation_match=12)
+
+    def test_file_stat(self):
+        from google.cloud.exceptions import NotFound
+        blob = Blob(name='file.txt', bucket='some-bucket')
+        properties = {'size': '5', 'etag': 'CAE=', 'md5Hash': 'XUFAKrxLKna5cZ2REBfFkg==',
+            'contentType': 'text/plain', 'cacheControl': 'no-cache', 'metadata': {'a': '1'}}
+        blob.reload = MagicMock(side_effect=lambda: blob._properties.update(properties))
+        file = GoogleCloudStorageFile(blob)
+
+        stat = file.stat()
+        self.assertEqual((stat.size, stat.etag, stat.md5, stat.content_type, stat.cache_control, dict(stat.metadata)),
+            (5, 'CAE=', 'XUFAKrxLKna5cZ2REBfFkg==', 'text/plain', 'no-cache', {'a': '1'}))
+        self.assertIs(file.stat(), stat)
+        blob.reload.assert_called_once()
+
+        blob.reload.side_effect = NotFound('missing')
+        with self.assertRaises(FileNotFoundError):
+            file.stat(refresh=True)
+
+    def test_file_set_metadata_replaces(self):
+        blob = Blob(name='file.txt', bucket='some-bucket')
+        blob.reload = MagicMock(side_effect=lambda: blob._set_properties(
+            {'name': 'file.txt', 'metageneration': '3', 'metadata': {'a': '1', 'b': '2'}}))
+        blob.patch = MagicMock()
+        file = GoogleCloudStorageFile(blob)
+        file.metadata = {'a': '2'}
+        self.assertEqual(blob.metadata, {'a': '2', 'b': None})
+        blob.patch.assert_called_once_with(if_metageneration_match=3)
+
+    def test_bucket_set_metadata_many(self):
+        from google.cloud.exceptions import Forbidden
+        client = MagicMock()
+        gcs = GoogleCloudStoragePlugin(client, '', '', False, '')
+        blobs = {}
+        def blob(name):
+            b = blobs[name] = Blob(name=name, bucket='some-bucket')
+            b.reload = MagicMock(side_effect=lambda: b._set_properties(
+                {'name': name, 'metageneration': '1', 'metadata': {'old': 'x'}}))
+            b.patch = MagicMock()
+            return b
+        gcs.bucket.blob = MagicMock(side_effect=blob)
+
+        result = gcs.setMetadataMany({f'{i}-file': {'v': str(i)} for i in range(150)}, workers=2)
+        self.assertEqual(client.batch.call_count, 4)
+        self.assertEqual(len(result.succeeded), 150)
+        self.assertTrue(result.ok)
+        self.assertEqual(blobs['7-file'].metadata, {'old': None, 'v': '7'})
+        blobs['7-file'].patch.assert_called_once_with(if_metageneration_match=1)
+
+        # a failed batch is retried file by file to find the failures
+        client.batch.return_value.__exit__.side_effect = Forbidden('batch failed')
+        def failing_blob(name):
+            b = blob(name)
+            if name == 'denied' and client.batch.return_value.__exit__.called:
+                b.patch.side_effect = Forbidden('denied')
+            return b
+        gcs.bucket.blob = MagicMock(side_effect=failing_blob)
+        result = gcs.setMetadataMany([('ok', {}), ('denied', {})])
+        self.assertEqual(result.succeeded, ['ok'])
+        self.assertEqual(list(result.failed), ['denied'])
+
+    def test_bucket_signed_urls(self):
+        from google.auth.credentials import Signing
+        from google.cloud.storage.bucket import Bucket
+        client = MagicMock(api_endpoint='https://storage.googleapis.com', universe_domain='googleapis.com')
+        client._credentials = MagicMock(spec=Signing, signer_email='sa@project.iam.gserviceaccount.com',
+            **{'sign_bytes.return_value': b'signature'})
+        gcs = GoogleCloudStoragePlugin(client, '', '', False, '')
+        gcs.bucket = Bucket(client, 'some-bucket')
+
+        with patch('google.cloud.storage._signing.get_v4_now_dtstamps', return_value=('20260101T000000Z', '20260101')):
+            urls = gcs.signedUrls(['a', 'b c'], 'GET', 600, 'text/plain', cache=True)
+            # same urls as the library signs for each blob
+            for name in ('a', 'b c'):
+                self.assertEqual(urls[name], gcs.bucket.blob(name).generate_signed_url(expiration=600, version='v4',
+                    method='GET', response_type='text/plain', client=client))
+        self.assertTrue(urls['b c'].startswith('https://storage.googleapis.com/some-bucket/b%20c?'))
+        self.assertIn('response-content-type=text%2Fplain', urls['a'])
+
+        signatures = client._credentials.sign_bytes.call_count
+        gcs.signedUrls(['a'], 'GET', 600, 'text/plain', cache=True)
+        self.assertEqual(client._credentials.sign_bytes.call_count, signatures)
+
+        # uploads are bound to their content type
+        url = gcs.signedUrls(['a'], 'PUT', 600, 'text/plain')['a']
+        self.assertIn('X-Goog-SignedHeaders=content-type%3Bhost', url)
+        self.assertNotIn('response-content-type', url)
+
+    def test_file_conditional_download(self):
+        from google.api_core.exceptions import NotModified
+        from google.cloud.storage.bucket import Bucket
+        bucket = Bucket(MagicMock(), 'some-bucket')
+        downloads = []
+        def download(blob, **kwargs):
+            downloads.append((blob, kwargs))
+            blob._properties['generation'] = '2'
+            return b'data'
+        file = GoogleCloudStorageFile(bucket.blob('file.txt'))
+
+        with patch.object(Blob, 'download_as_bytes', autospec=True, side_effect=download) as download_as_bytes:
+            self.assertEqual(file._download_if_changed('1'), (b'data', '2'))
+            self.assertEqual(downloads[-1][1], {'if_generation_not_match': 1})
+            download_as_bytes.side_effect = NotModified('unchanged')
+            self.assertIsNone(file._download_if_changed('2'))
+
+    def test_file_conditional_download_after_overwrite(self):
+        from google.cloud.storage.bucket import Bucket
+        client = MagicMock()
+        bucket = Bucket(client, 'some-bucket')
+        # handle reused from a listing, pinned to generation 1 of the object
+        blob = bucket.blob('file.txt')
+        blob._set_properties({'name': 'file.txt', 'generation': '1',
+            'mediaLink': 'https://storage.googleapis.com/download/storage/v1/b/some-bucket/o/file.txt?generation=1&alt=media'})
+        file = GoogleCloudStorageFile(blob)
 
+        urls = []
+        def do_download(blob, transport, file_obj, download_url, *args, **kwargs):
+            urls.append(download_url)
+            file_obj.write(b'new contents')
+            blob._properties['generation'] = '2'
+        with patch.object(Blob, '_do_download', autospec=True, side_effect=do_download):
+            self.assertEqual(file._download_if_changed('1'), (b'new contents', '2'))
+        self.assertIn('ifGenerationNotMatch=1', urls[0])
+        self.assertNotIn('generation=1&', urls[0])
+        self.assertNotIn('&generation=', urls[0])
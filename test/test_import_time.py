@@ -0,0 +1,42 @@
+import os
+import re
+import sys
+import subprocess
+import unittest
+
+# Cold start budget for `import nimbella` in milliseconds (best of RUNS).
+# Override with NIMBELLA_IMPORT_BUDGET_MS on slow machines.
+BUDGET_MS = float(os.getenv('NIMBELLA_IMPORT_BUDGET_MS', '25'))
+RUNS = 5
+
+# Dependencies which must only be imported on first use.
+HEAVY_MODULES = ['redis', 'boto3', 'botocore', 'google.cloud.storage', 'google.oauth2']
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Runs `python -X importtime` in a fresh interpreter and returns the
+# cumulative import time of the top-level package in microseconds.
+def import_time_us(module='nimbella'):
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        cwd=ROOT, capture_output=True, text=True, check=True)
+    pattern = re.compile(r'^import time:\s+\d+ \|\s+(\d+) \| ' + re.escape(module) + '$')
+    for line in result.stderr.splitlines():
+        match = pattern.match(line)
+        if match:
+            return int(match.group(1))
+    raise Exception(f'No import time reported for module: {module}')
+
+class TestImportTime(unittest.TestCase):
+    def test_import_does_not_load_heavy_dependencies(self):
+        script = 'import sys, nimbella; print(",".join(m for m in sys.argv[1:] if m in sys.modules))'
+        result = subprocess.run([sys.executable, '-c', script, *HEAVY_MODULES],
+            cwd=ROOT, capture_output=True, text=True, check=True)
+        self.assertEqual(result.stdout.strip(), '')
+
+    def test_import_within_budget(self):
+        best_ms = min(import_time_us() for _ in range(RUNS)) / 1000
+        self.assertLessEqual(best_ms, BUDGET_MS,
+            f'import nimbella took {best_ms:.1f}ms, budget is {BUDGET_MS:.1f}ms')
+
+if __name__ == '__main__':
+    print(f'import nimbella: {min(import_time_us() for _ in range(RUNS)) / 1000:.1f}ms (budget {BUDGET_MS:.1f}ms)')
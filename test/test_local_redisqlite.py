@@ -0,0 +1,87 @@
+from nimbella.local_redisqlite import LocalRedisqlite
+
+import os
+import sqlite3
+import tempfile
+import unittest
+from unittest.mock import MagicMock, patch
+
+import nimbella
+
+class TestLocalRedisqlite(unittest.TestCase):
+    def setUp(self):
+        self.sql = LocalRedisqlite()
+
+    def test_basic(self):
+        sql = self.sql
+        self.assertEqual(len(sql.exec("create table t(i int)")), 2)
+        self.assertEqual(sql.exec("insert into t(i) values(?),(?),(?)", 1, 2, 3), [3, 3])
+        self.assertEqual(sql.map("select * from t where i>?", 1), [{"i": 2}, {"i": 3}])
+        self.assertEqual(sql.map("select * from t", limit=1), [{"i": 1}])
+        self.assertEqual(sql.arr("select * from t where i<?", 3, limit=1), [[1]])
+
+    def test_prepared(self):
+        sql = self.sql
+        sql.exec("create table t(i int, s varchar)")
+        sel = sql.prep("select s from t where i <?")
+        ins = sql.prep("insert into t(i, s) values(?,?)")
+        for i, s in [(1, 'a'), (2, 'b'), (3, 'c')]:
+            sql.exec(ins, i, s)
+        self.assertEqual(sql.map(sel, 3), [{'s': 'a'}, {'s': 'b'}])
+        self.assertEqual(sql.arr(sel, 3, limit=1), [['a']])
+
+        self.assertEqual(sql.prep(sel), b'OK')
+        with self.assertRaises(Exception) as ctx:
+            sql.prep(sel)
+        self.assertEqual(str(ctx.exception), 'invalid prepared statement index')
+
+    def test_batch_and_helpers(self):
+        sql = self.sql
+        sql.exec("create table t(i int primary key)")
+        self.assertEqual(sql.insert_many("t", ["i"], ([i] for i in range(2000)), transaction=True), 2000)
+        self.assertEqual(sum(1 for _ in sql.cursor("select * from t", page_size=300, key="i")), 2000)
+        self.assertEqual(sql.arr_columns("select i from t where i < ?", 3), {"i": [0, 1, 2]})
+
+        with self.assertRaises(sqlite3.IntegrityError):
+            with sql.batch(transaction=True) as b:
+                b.exec("insert into t(i) values(?)", 5000)
+                b.exec("insert into t(i) values(?)", 0)
+        self.assertEqual(sql.arr("select count(*) from t"), [[2000]])
+
+    def test_snapshot_hydration_and_refresh(self):
+        def snapshot(rows):
+            fd, path = tempfile.mkstemp()
+            os.close(fd)
+            db = sqlite3.connect(path)
+            db.execute("create table t(i int)")
+            db.executemany("insert into t(i) values(?)", [(r,) for r in rows])
+            db.commit()
+            db.close()
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.remove(path)
+            return data
+
+        versions = {'current': ('1', snapshot([1, 2]))}
+        def download_if_changed(validator):
+            version, data = versions['current']
+            return None if validator == version else (data, version)
+        storage = MagicMock()
+        storage.file.return_value._download_if_changed.side_effect = download_if_changed
+
+        sql = LocalRedisqlite(snapshot='ref.db', storage=storage, refresh_interval=0)
+        storage.file.assert_called_with('ref.db')
+        self.assertEqual(sql.arr("select * from t"), [[1], [2]])
+        self.assertFalse(sql.refresh())
+
+        versions['current'] = ('2', snapshot([3]))
+        self.assertEqual(sql.arr("select * from t"), [[3]])
+
+    @patch.dict(os.environ, {'__NIM_ESQL_BACKEND': 'local', '__NIM_ESQL_DATABASE': ':memory:'})
+    def test_esql_backend_selection(self):
+        sql = nimbella.esql()
+        self.assertIsInstance(sql, LocalRedisqlite)
+        self.assertIs(nimbella.esql(), sql)
+        with patch.dict(os.environ, {'__NIM_ESQL_BACKEND': 'other'}):
+            with self.assertRaises(Exception):
+                nimbella.esql()
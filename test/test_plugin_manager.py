@@ -1,8 +1,14 @@
 from nimbella.storage import plugin_manager
 
+import sys
+import subprocess
 import unittest
+from unittest.mock import MagicMock, patch
 
 class TestPluginManager(unittest.TestCase):
+    def tearDown(self):
+        plugin_manager.PLUGINS.pop("@nimbella/storage-custom", None)
+
     def test_finds_google_storage_plugin(self):
         id = "@nimbella/storage-gcs"
         plugin = plugin_manager.find_plugin(id)
@@ -20,3 +26,25 @@ class TestPluginManager(unittest.TestCase):
         id = "@nimbella/storage-missing"
         plugin = plugin_manager.find_plugin(id)
         self.assertIsNone(plugin)
+
+    def test_only_imports_requested_plugin(self):
+        script = ("import sys; from nimbella.storage import plugin_manager; "
+            "plugin_manager.find_plugin('@nimbella/storage-s3'); "
+            "print('nimbella.storage.plugins.gcs_storage_plugin' in sys.modules, "
+            "'nimbella.storage.plugins.aws_storage_plugin' in sys.modules)")
+        result = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True, check=True)
+        self.assertEqual(result.stdout.strip(), 'False True')
+
+    def test_register_plugin_reference(self):
+        plugin_manager.register_plugin("@nimbella/storage-custom", "nimbella.storage.plugins.aws_storage_plugin:AWSStoragePlugin")
+        plugin = plugin_manager.find_plugin("@nimbella/storage-custom")
+        self.assertEqual(plugin.id(), "@nimbella/storage-s3")
+
+    def test_finds_entry_point_plugin(self):
+        plugin = MagicMock()
+        entry_point = MagicMock()
+        entry_point.load.return_value = plugin
+        with patch.object(plugin_manager, 'discover_entry_points', return_value={"@nimbella/storage-custom": entry_point}):
+            self.assertIs(plugin_manager.find_plugin("@nimbella/storage-custom"), plugin)
+            self.assertIs(plugin_manager.find_plugin("@nimbella/storage-custom"), plugin)
+        entry_point.load.assert_called_once()
@@ -0,0 +1,99 @@
+from nimbella import redis_pool
+import nimbella
+
+import os
+import unittest
+import redis as kv
+from unittest.mock import MagicMock, patch
+
+class TestRedisPool(unittest.TestCase):
+    def setUp(self):
+        redis_pool.reset_pools()
+
+    def tearDown(self):
+        redis_pool.reset_pools()
+
+    @patch.dict(os.environ, {'__NIM_REDIS_IP': '10.0.0.1', '__NIM_REDIS_PASSWORD': 'secret'})
+    def test_redis_clients_share_pool(self):
+        first = nimbella.redis()
+        second = nimbella.redis()
+        self.assertIs(first.connection_pool, second.connection_pool)
+        self.assertEqual(first.connection_pool.connection_kwargs['host'], '10.0.0.1')
+        self.assertEqual(first.connection_pool.connection_kwargs['password'], 'secret')
+
+    @patch.dict(os.environ, {'__NIM_REDIS_IP': '10.0.0.1', '__NIM_REDIS_PASSWORD': 'secret'})
+    def test_esql_uses_shared_pool(self):
+        client = nimbella.redis()
+        sql = nimbella.esql()
+        self.assertIs(sql.redis.connection_pool, client.connection_pool)
+
+    def test_pools_keyed_on_host_and_password(self):
+        a = redis_pool.get_pool('10.0.0.1', 'one')
+        b = redis_pool.get_pool('10.0.0.1', 'two')
+        self.assertIsNot(a, b)
+        self.assertIs(a, redis_pool.get_pool('10.0.0.1', 'one'))
+
+    def test_pool_options(self):
+        pool = redis_pool.get_pool('10.0.0.1', 'secret', max_connections=4, health_check_interval=5, idle_timeout=60, timeout=2)
+        self.assertEqual(pool.max_connections, 4)
+        self.assertEqual(pool.connection_kwargs['health_check_interval'], 5)
+        self.assertEqual(pool.idle_timeout, 60)
+        self.assertEqual(pool.timeout, 2)
+
+    def _connections(self, pool, count):
+        pool.connection_class = lambda **kwargs: MagicMock(pid=pool.pid, **{'can_read.return_value': False})
+        return [pool.get_connection('GET') for _ in range(count)]
+
+    def test_waits_for_connection_when_exhausted(self):
+        pool = redis_pool.get_pool('10.0.0.1', 'secret', max_connections=2, timeout=0.01)
+        conns = self._connections(pool, 2)
+        with self.assertRaises(kv.ConnectionError):
+            pool.get_connection('GET')
+        pool.release(conns[0])
+        self.assertIs(pool.get_connection('GET'), conns[0])
+
+    def test_grows_existing_pool(self):
+        pool = redis_pool.get_pool('10.0.0.1', 'secret', max_connections=1, timeout=0.01)
+        first = self._connections(pool, 1)[0]
+        self.assertIs(redis_pool.get_pool('10.0.0.1', 'secret', max_connections=3), pool)
+        self.assertEqual(pool.max_connections, 3)
+        self.assertEqual(len({first, pool.get_connection('GET'), pool.get_connection('GET')}), 3)
+        with self.assertRaises(kv.ConnectionError):
+            pool.get_connection('GET')
+        redis_pool.get_pool('10.0.0.1', 'secret', max_connections=2)
+        self.assertEqual(pool.max_connections, 3)
+
+    def test_reaps_idle_connections(self):
+        pool = redis_pool.get_pool('10.0.0.1', 'secret', idle_timeout=60)
+        conns = self._connections(pool, 3)
+
+        with patch('nimbella.redis_pool.time.monotonic', return_value=0):
+            pool.release(conns[0])
+            pool.release(conns[1])
+        with patch('nimbella.redis_pool.time.monotonic', return_value=100):
+            pool.release(conns[2])
+            pool.reap()
+
+        conns[0].disconnect.assert_called()
+        conns[1].disconnect.assert_called()
+        conns[2].disconnect.assert_not_called()
+        self.assertEqual(pool.stats(), {
+            'max_connections': redis_pool.DEFAULT_MAX_CONNECTIONS,
+            'created': 1,
+            'available': 1,
+            'in_use': 0,
+            'reaped': 2,
+        })
+        # live connection is handed out before new ones are made
+        with patch('nimbella.redis_pool.time.monotonic', return_value=100):
+            self.assertIs(pool.get_connection('GET'), conns[2])
+
+    def test_pool_stats(self):
+        redis_pool.get_pool('10.0.0.1', 'one')
+        redis_pool.get_pool('10.0.0.1', 'two')
+        stats = nimbella.redis_stats()
+        self.assertEqual(len(stats), 2)
+        for (host, digest), pool_stats in stats.items():
+            self.assertEqual(host, '10.0.0.1')
+            self.assertNotIn(digest, ('one', 'two'))
+            self.assertEqual(pool_stats['created'], 0)
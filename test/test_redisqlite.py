@@ -127,3 +127,13 @@ class TestRedisqlite(unittest.TestCase):
         with self.assertRaises(Exception) as ctx:
             self.sql.arr('xxx')
         self.assertEqual(str(ctx.exception), 'near "xxx": syntax error')
+
+    def test_batch(self):
+        sql = self.sql
+        assertEqual = self.assertEqual
+        with sql.batch(transaction=True) as b:
+            b.exec("create table t(i int)")
+            b.exec("insert into t(i) values(?),(?),(?)",1,2,3)
+            b.map("select * from t where i>?",1)
+            b.arr("select * from t",limit=1)
+        assertEqual(b.results[1:], [[3,3], [{"i":2},{"i":3}], [[1]]])
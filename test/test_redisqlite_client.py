@@ -0,0 +1,366 @@
+from nimbella.redisqlite import Redisqlite, _decode
+
+import json
+import time
+import array
+import sqlite3
+import unittest
+from unittest.mock import MagicMock
+
+class TestRedisqliteBatch(unittest.TestCase):
+    def setUp(self):
+        self.redis = MagicMock()
+        self.pipeline = self.redis.pipeline.return_value
+        self.sql = Redisqlite(self.redis)
+
+    def test_batch_sends_one_pipeline(self):
+        self.pipeline.execute.return_value = [[1, 1], [b'{"i":1}'], [b'[1]']]
+
+        with self.sql.batch() as b:
+            b.exec("insert into t(i) values(?)", 1)
+            b.map("select * from t", limit=1)
+            b.arr("select * from t")
+            self.assertEqual(len(b), 3)
+
+        self.assertEqual(b.results, [[1, 1], [{"i": 1}], [[1]]])
+        self.redis.pipeline.assert_called_with(transaction=False)
+        self.assertEqual([c[0] for c in self.pipeline.execute_command.call_args_list], [
+            ("SQLEXEC", "insert into t(i) values(?)", 1),
+            ("SQLMAP", 1, "select * from t"),
+            ("SQLARR", 0, "select * from t"),
+        ])
+        self.pipeline.execute.assert_called_once()
+        self.redis.execute_command.assert_not_called()
+
+    def test_transactional_pipeline(self):
+        self.pipeline.execute.return_value = [[1, 1], [2, 1]]
+        b = self.sql.pipeline(transaction=True)
+        b.exec("insert into t(i) values(1)").exec("insert into t(i) values(2)")
+        self.assertEqual(b.execute(), [[1, 1], [2, 1]])
+        self.redis.pipeline.assert_called_with(transaction=True)
+        self.assertEqual(len(b), 0)
+
+    def test_batch_discarded_on_error(self):
+        with self.assertRaises(ValueError):
+            with self.sql.batch() as b:
+                b.exec("insert into t(i) values(1)")
+                raise ValueError()
+        self.pipeline.execute.assert_not_called()
+        self.pipeline.reset.assert_called()
+
+class TestRedisqlitePrepCache(unittest.TestCase):
+    def setUp(self):
+        self.redis = MagicMock()
+        self.handles = iter(range(1, 100))
+        def execute_command(command, *args):
+            if command == "SQLPREP":
+                return next(self.handles) if isinstance(args[0], str) else b'OK'
+            if command == "SQLEXEC":
+                return [1, 1]
+            return [b'[1]']
+        self.redis.execute_command.side_effect = execute_command
+        self.sql = Redisqlite(self.redis, prep_cache_size=2)
+
+    def commands(self):
+        return [c[0] for c in self.redis.execute_command.call_args_list]
+
+    def test_parameterized_statements_are_prepared_once(self):
+        self.sql.exec("insert into t(i) values(?)", 1)
+        self.sql.exec("insert into t(i) values(?)", 2)
+        self.assertEqual(self.sql.arr("select * from t where i > ?", 0, limit=1), [[1]])
+
+        self.assertEqual(self.commands(), [
+            ("SQLPREP", "insert into t(i) values(?)"),
+            ("SQLEXEC", 1, 1),
+            ("SQLEXEC", 1, 2),
+            ("SQLPREP", "select * from t where i > ?"),
+            ("SQLARR", 1, 2, 0),
+        ])
+        self.assertEqual(self.sql.prep_cache_stats(), {'hits': 1, 'misses': 2, 'size': 2, 'capacity': 2})
+
+    def test_plain_statements_and_handles_bypass_cache(self):
+        self.sql.exec("create table t(i int)")
+        self.sql.map(7, 1)
+        self.assertEqual(self.commands(), [("SQLEXEC", "create table t(i int)"), ("SQLMAP", 0, 7, 1)])
+        self.assertEqual(self.sql.prep_misses, 0)
+
+    def test_least_recently_used_statement_is_closed(self):
+        self.sql.arr("select ?", 1)
+        self.sql.arr("select ?, ?", 1, 2)
+        self.sql.arr("select ?", 1)
+        self.sql.arr("select ?, ?, ?", 1, 2, 3)
+        self.assertIn(("SQLPREP", 2), self.commands())
+        self.assertEqual(self.sql.prep_cache_stats()['size'], 2)
+
+    def test_lost_handle_is_prepared_again(self):
+        from redis.exceptions import ResponseError
+        calls = []
+        def execute_command(command, *args):
+            calls.append((command,) + args)
+            if command == "SQLPREP":
+                return len(calls)
+            if args[0] == 1:
+                raise ResponseError('invalid prepared statement index')
+            return [1, 1]
+        self.redis.execute_command.side_effect = execute_command
+
+        self.assertEqual(self.sql.exec("insert into t(i) values(?)", 1), [1, 1])
+        self.assertEqual(calls, [
+            ("SQLPREP", "insert into t(i) values(?)"),
+            ("SQLEXEC", 1, 1),
+            ("SQLPREP", "insert into t(i) values(?)"),
+            ("SQLEXEC", 3, 1),
+        ])
+
+    def test_failed_statement_handle_is_closed(self):
+        from redis.exceptions import ResponseError
+        calls = []
+        def execute_command(command, *args):
+            calls.append((command,) + args)
+            if command == "SQLPREP":
+                return 7 if isinstance(args[0], str) else b'OK'
+            raise ResponseError('UNIQUE constraint failed: t.i')
+        self.redis.execute_command.side_effect = execute_command
+
+        with self.assertRaises(ResponseError):
+            self.sql.exec("insert into t(i) values(?)", 1)
+        self.assertEqual(calls, [
+            ("SQLPREP", "insert into t(i) values(?)"),
+            ("SQLEXEC", 7, 1),
+            ("SQLPREP", 7),
+        ])
+        self.assertEqual(self.sql.prep_cache_stats()['size'], 0)
+
+    def test_cache_can_be_disabled(self):
+        sql = Redisqlite(self.redis, prep_cache_size=0)
+        sql.exec("insert into t(i) values(?)", 1)
+        self.assertEqual(self.commands(), [("SQLEXEC", "insert into t(i) values(?)", 1)])
+
+# Minimal stand-in for the Redisqlite server commands, backed by sqlite3
+class SqliteRedis:
+    def __init__(self):
+        self.db = sqlite3.connect(':memory:')
+        self.db.row_factory = sqlite3.Row
+        self.db.isolation_level = None
+        self.queries = []
+        self.round_trips = 0
+
+    def pipeline(self, transaction=False):
+        return SqlitePipeline(self)
+
+    def execute_command(self, command, *args):
+        if command == "SQLPREP":
+            return b'OK'
+        if command == "SQLEXEC":
+            cur = self.db.execute(args[0], args[1:])
+            return [cur.lastrowid, cur.rowcount]
+        limit, sql, params = args[0], args[1], args[2:]
+        self.queries.append(sql)
+        rows = self.db.execute(sql, params).fetchall()
+        if limit:
+            rows = rows[:limit]
+        if command == "SQLMAP":
+            return [json.dumps(dict(r)).encode('utf-8') for r in rows]
+        return [json.dumps(list(r)).encode('utf-8') for r in rows]
+
+class SqlitePipeline:
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    def execute_command(self, *command):
+        self.commands.append(command)
+
+    def execute(self):
+        self.redis.round_trips += 1
+        commands, self.commands = self.commands, []
+        return [self.redis.execute_command(*c) for c in commands]
+
+    def reset(self):
+        self.commands = []
+
+class TestRedisqliteCursor(unittest.TestCase):
+    def setUp(self):
+        self.redis = SqliteRedis()
+        self.sql = Redisqlite(self.redis, prep_cache_size=0)
+        self.sql.exec("create table t(i int primary key, s text)")
+        for i in range(1, 11):
+            self.sql.exec("insert into t(i, s) values(?, ?)", i, str(i))
+
+    def test_offset_pages(self):
+        rows = list(self.sql.cursor("select * from t where i > ? order by i", 2, page_size=3))
+        self.assertEqual([r["i"] for r in rows], list(range(3, 11)))
+        self.assertEqual(len(self.redis.queries), 3)
+
+    def test_keyset_pages(self):
+        rows = list(self.sql.cursor("select i, s from t where i > ?;", 2, page_size=4, key="i"))
+        self.assertEqual(rows[0], {"i": 3, "s": "3"})
+        self.assertEqual([r["i"] for r in rows], list(range(3, 11)))
+        self.assertIn("> ?", self.redis.queries[-1])
+
+    def test_keyset_array_rows(self):
+        rows = list(self.sql.cursor("select s, i from t", page_size=5, key="i", arr=True))
+        self.assertEqual(rows[:2], [["1", 1], ["2", 2]])
+        self.assertEqual(len(rows), 10)
+        # An exactly full last page needs one more (empty) page
+        self.assertEqual(len(self.redis.queries), 3)
+
+    def test_stops_early(self):
+        for row in self.sql.cursor("select * from t order by i", page_size=2):
+            break
+        self.assertEqual(row, {"i": 1, "s": "1"})
+        self.assertEqual(len(self.redis.queries), 1)
+
+    def test_invalid_arguments(self):
+        with self.assertRaises(ValueError):
+            next(self.sql.cursor(1))
+        with self.assertRaises(ValueError):
+            next(self.sql.cursor("select * from t", page_size=0))
+
+class TestRedisqliteColumns(unittest.TestCase):
+    def setUp(self):
+        self.redis = SqliteRedis()
+        self.sql = Redisqlite(self.redis, prep_cache_size=0)
+        self.sql.exec("create table t(i int, x real, s text)")
+        for i in range(1, 4):
+            self.sql.exec("insert into t(i, x, s) values(?, ?, ?)", i, i / 2, str(i))
+
+    def test_bulk_decode(self):
+        self.assertEqual(_decode([b'{"i":1}', b'{"i":2}']), [{"i": 1}, {"i": 2}])
+        self.assertEqual(_decode([]), [])
+
+    def test_columns_from_map(self):
+        self.assertEqual(self.sql.arr_columns("select * from t where i > ?", 1),
+            {"i": [2, 3], "x": [1.0, 1.5], "s": ["2", "3"]})
+        self.assertEqual(self.sql.arr_columns("select * from t where i > ?", 9), {})
+
+    def test_columns_from_arr(self):
+        cols = self.sql.arr_columns("select i, s from t", columns=["i", "s"], limit=2)
+        self.assertEqual(cols, {"i": [1, 2], "s": ["1", "2"]})
+        empty = self.sql.arr_columns("select i, s from t where i > 9", columns=["i", "s"])
+        self.assertEqual(empty, {"i": [], "s": []})
+
+    def test_array_columns(self):
+        cols = self.sql.arr_columns("select * from t", numeric='array')
+        self.assertEqual(cols["i"], array.array('q', [1, 2, 3]))
+        self.assertEqual(cols["x"], array.array('d', [0.5, 1.0, 1.5]))
+        self.assertEqual(cols["s"], ["1", "2", "3"])
+        with self.assertRaises(ValueError):
+            self.sql.arr_columns("select * from t", numeric='pandas')
+
+    def test_numpy_columns(self):
+        try:
+            import numpy
+        except ImportError:
+            self.skipTest('numpy is not installed')
+        cols = self.sql.arr_columns("select i, x from t", columns=["i", "x"], numeric='numpy')
+        self.assertEqual(cols["x"].dtype, numpy.float64)
+        self.assertEqual(cols["i"].tolist(), [1, 2, 3])
+
+class TestRedisqliteResultCache(unittest.TestCase):
+    def setUp(self):
+        self.redis = SqliteRedis()
+        self.sql = Redisqlite(self.redis, prep_cache_size=0, result_cache_size=2)
+        self.sql.exec("create table t(i int)")
+        self.sql.exec("create table u(i int)")
+        self.sql.exec("insert into t(i) values(1),(2)")
+
+    def test_repeated_queries_are_cached(self):
+        self.assertEqual(self.sql.map("select * from t where i > ?", 0), [{"i": 1}, {"i": 2}])
+        self.assertEqual(self.sql.map("select * from t where i > ?", 0), [{"i": 1}, {"i": 2}])
+        self.assertEqual(self.sql.map("select * from t where i > ?", 0, limit=1), [{"i": 1}])
+        self.assertEqual(len(self.redis.queries), 2)
+        stats = self.sql.result_cache_stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['size']), (1, 2, 2))
+
+    def test_writes_invalidate_tables_read(self):
+        self.sql.arr("select * from t")
+        self.sql.arr("select * from u")
+        self.sql.exec("insert into t(i) values(?)", 3)
+        self.assertEqual(self.sql.arr("select * from t"), [[1], [2], [3]])
+        self.sql.arr("select * from u")
+        self.assertEqual(len(self.redis.queries), 3)
+        self.assertEqual(self.sql.result_cache_stats()['invalidations'], 1)
+
+    def test_batch_writes_invalidate(self):
+        self.sql.arr("select * from t")
+        with self.sql.batch() as b:
+            b.exec("delete from t")
+        self.assertEqual(self.sql.result_cache_stats()['size'], 0)
+
+    def test_unknown_writes_clear_cache(self):
+        self.sql.arr("select * from t")
+        self.sql.arr("select * from u")
+        self.sql.exec("create index ix on t(i)")
+        self.assertEqual(self.sql.result_cache_stats()['size'], 0)
+
+    def test_result_of_query_racing_a_write_is_not_cached(self):
+        execute = self.sql._execute
+        def racing_execute(command, options, statement):
+            result = execute(command, options, statement)
+            # a concurrent write lands after the query ran, before its result is cached
+            self.sql._execute = execute
+            self.sql.exec("insert into t(i) values(3)")
+            return result
+        self.sql._execute = racing_execute
+        self.assertEqual(self.sql.arr("select * from t"), [[1], [2]])
+        self.assertEqual(self.sql.arr("select * from t"), [[1], [2], [3]])
+
+    def test_queries_without_known_tables_invalidated_by_any_write(self):
+        self.sql.arr("select 1 as one")
+        self.sql.exec("insert into u(i) values(1)")
+        self.assertEqual(self.sql.result_cache_stats()['size'], 0)
+
+    def test_results_expire(self):
+        self.sql.enable_result_cache(size=4, ttl=0.01)
+        self.sql.arr("select * from t")
+        time.sleep(0.02)
+        self.sql.arr("select * from t")
+        self.assertEqual(len(self.redis.queries), 2)
+
+    def test_disabled_by_default(self):
+        sql = Redisqlite(self.redis)
+        self.assertIsNone(sql.result_cache_stats())
+        sql.arr("select * from t")
+        sql.arr("select * from t")
+        self.assertEqual(len(self.redis.queries), 2)
+
+class TestRedisqliteInsertMany(unittest.TestCase):
+    def setUp(self):
+        self.redis = SqliteRedis()
+        self.sql = Redisqlite(self.redis)
+        self.sql.exec("create table t(i int primary key, s text)")
+
+    def count(self):
+        return self.redis.db.execute("select count(*) from t").fetchone()[0]
+
+    def test_inserts_generator_in_pipelined_chunks(self):
+        rows = ((i, str(i)) for i in range(2000))
+        self.assertEqual(self.sql.insert_many("t", ["i", "s"], rows, chunk_size=100, pipeline_size=5), 2000)
+        self.assertEqual(self.count(), 2000)
+        self.assertEqual(self.redis.round_trips, 4)
+
+    def test_chunks_stay_under_variable_limit(self):
+        executed = []
+        pipeline = SqlitePipeline(self.redis)
+        original = pipeline.execute_command
+        pipeline.execute_command = lambda *c: (executed.append(c), original(*c))
+        self.redis.pipeline = lambda transaction=False: pipeline
+        self.sql.insert_many("t", ["i", "s"], [[i, None] for i in range(1000)])
+        self.assertEqual([len(c) - 2 for c in executed], [998, 998, 4])
+
+    def test_dict_rows(self):
+        self.sql.insert_many("t", ["s", "i"], [{"i": 1, "s": "a"}, {"i": 2, "s": "b"}])
+        self.assertEqual(self.sql.arr("select * from t"), [[1, "a"], [2, "b"]])
+
+    def test_transaction_rolls_back_on_error(self):
+        rows = [(1, "a"), (2, "b"), (1, "duplicate")]
+        with self.assertRaises(sqlite3.IntegrityError):
+            self.sql.insert_many("t", ["i", "s"], rows, chunk_size=1, transaction=True)
+        self.assertEqual(self.count(), 0)
+
+    def test_invalid_rows(self):
+        with self.assertRaises(ValueError):
+            self.sql.insert_many("t", ["i", "s"], [(1,)])
+        with self.assertRaises(ValueError):
+            self.sql.insert_many("t", [], [])
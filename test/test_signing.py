@@ -0,0 +1,37 @@
+from nimbella.storage.signing import SignedUrlCache, expires_in
+
+import datetime
+import unittest
+from unittest.mock import patch
+
+class TestSigning(unittest.TestCase):
+    def test_expires_in(self):
+        self.assertEqual(expires_in(60), 60)
+        self.assertEqual(expires_in(datetime.timedelta(minutes=2)), 120)
+        future = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=1)
+        self.assertAlmostEqual(expires_in(future), 3600, delta=5)
+
+    def test_urls_reused_while_lifetime_remains(self):
+        cache = SignedUrlCache(min_remaining=0.25)
+        with patch('nimbella.storage.signing.time.time', return_value=1000):
+            cache.put('a', 'url-a', 100)
+            cache.put('expired', 'url', 0)
+        with patch('nimbella.storage.signing.time.time', return_value=1074):
+            self.assertEqual(cache.get('a'), 'url-a')
+        with patch('nimbella.storage.signing.time.time', return_value=1076):
+            self.assertIsNone(cache.get('a'))
+        self.assertIsNone(cache.get('expired'))
+        self.assertEqual(cache.stats(), {'hits': 1, 'misses': 2, 'size': 0, 'capacity': 10000})
+
+    def test_least_recently_used_urls_evicted(self):
+        cache = SignedUrlCache(size=2)
+        for key in ['a', 'b', 'c']:
+            cache.put(key, key, 60)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get('c'), 'c')
+
+    def test_invalid_settings(self):
+        with self.assertRaises(ValueError):
+            SignedUrlCache(min_remaining=1)
+        with self.assertRaises(ValueError):
+            SignedUrlCache(size=0)
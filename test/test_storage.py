@@ -0,0 +1,52 @@
+import nimbella
+from nimbella.storage import plugin_manager
+
+import os
+import json
+import unittest
+from unittest.mock import MagicMock, patch
+
+ENV = {
+    '__OW_NAMESPACE': 'namespace',
+    '__OW_API_HOST': 'https://api.host.com',
+    '__NIM_STORAGE_KEY': json.dumps({'provider': '@nimbella/storage-test'}),
+}
+
+@patch.dict(os.environ, ENV)
+class TestStorage(unittest.TestCase):
+    def setUp(self):
+        nimbella.invalidate_storage()
+        self.plugin = MagicMock(side_effect=lambda *args: MagicMock())
+        patcher = patch.object(plugin_manager, 'find_plugin', return_value=self.plugin)
+        self.find_plugin = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(nimbella.invalidate_storage)
+
+    def test_storage_instances_are_memoized(self):
+        bucket = nimbella.storage()
+        self.assertIs(nimbella.storage(), bucket)
+        self.plugin.prepare_creds.assert_called_once()
+        self.plugin.create_client.assert_called_once()
+        self.plugin.assert_called_once_with(self.plugin.create_client(), 'namespace', 'https://api.host.com', False, {'provider': '@nimbella/storage-test'})
+
+    def test_web_and_data_buckets_cached_separately(self):
+        data = nimbella.storage()
+        web = nimbella.storage(web=True)
+        self.assertIsNot(data, web)
+        self.assertIs(nimbella.storage(web=True), web)
+
+    def test_credentials_change_creates_new_instance(self):
+        bucket = nimbella.storage()
+        with patch.dict(os.environ, {'__NIM_STORAGE_KEY': json.dumps({'provider': '@nimbella/storage-test', 'v': 2})}):
+            self.assertIsNot(nimbella.storage(), bucket)
+
+    def test_invalidate_storage(self):
+        bucket = nimbella.storage()
+        nimbella.invalidate_storage()
+        self.assertIsNot(nimbella.storage(), bucket)
+        self.assertEqual(self.plugin.create_client.call_count, 2)
+
+    def test_invalid_credentials(self):
+        with patch.dict(os.environ, {'__NIM_STORAGE_KEY': 'not json'}):
+            with self.assertRaises(Exception):
+                nimbella.storage()
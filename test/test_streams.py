@@ -0,0 +1,165 @@
+from nimbella.storage.streams import RangeReader, BufferReader, IterReader, as_stream, coalesce_ranges, range_header
+
+import io
+import unittest
+
+CONTENTS = bytes(range(256)) * 40
+
+class RangeFile:
+    name = 'file.bin'
+
+    def __init__(self, contents, streaming=False):
+        self.contents = contents
+        self.streaming = streaming
+        self.requests = []
+
+    def _content_length(self):
+        return len(self.contents)
+
+    def download(self, start, end):
+        self.requests.append((start, end))
+        return self.contents[start:end + 1]
+
+    def _open_stream(self, start):
+        if not self.streaming:
+            return None
+        self.requests.append((start, None))
+        return io.BytesIO(self.contents[start:])
+
+class TestRangeReader(unittest.TestCase):
+    def test_reads_ranges(self):
+        file = RangeFile(CONTENTS)
+        with io.BufferedReader(RangeReader(file, 1024), 1024) as f:
+            self.assertEqual(f.read(10), CONTENTS[:10])
+            self.assertEqual(f.read(), CONTENTS[10:])
+            self.assertEqual(f.read(), b'')
+        self.assertEqual(file.requests[0], (0, 1023))
+
+    def test_seek_and_tell(self):
+        file = RangeFile(CONTENTS)
+        with io.BufferedReader(RangeReader(file), 1024) as f:
+            f.seek(-100, io.SEEK_END)
+            self.assertEqual(f.tell(), len(CONTENTS) - 100)
+            self.assertEqual(f.read(), CONTENTS[-100:])
+            f.seek(5000)
+            self.assertEqual(f.read(16), CONTENTS[5000:5016])
+            f.seek(10, io.SEEK_CUR)
+            self.assertEqual(f.read(4), CONTENTS[5026:5030])
+
+    def test_small_reads_fetch_min_fetch_bytes(self):
+        file = RangeFile(CONTENTS)
+        reader = RangeReader(file, 4096)
+        chunks = list(iter(lambda: reader.read(100), b''))
+        self.assertEqual(b''.join(chunks), CONTENTS)
+        self.assertEqual(file.requests, [(0, 4095), (4096, 8191), (8192, len(CONTENTS) - 1)])
+
+    def test_readall_uses_single_request(self):
+        file = RangeFile(CONTENTS)
+        with io.BufferedReader(RangeReader(file, 1024), 1024) as f:
+            self.assertEqual(f.read(), CONTENTS)
+        self.assertEqual(file.requests, [(0, len(CONTENTS) - 1)])
+
+    def test_streaming_reads_use_single_request(self):
+        file = RangeFile(CONTENTS, streaming=True)
+        with io.BufferedReader(RangeReader(file), 512) as f:
+            self.assertEqual(f.read(), CONTENTS)
+        self.assertEqual(file.requests, [(0, None)])
+
+    def test_seek_reopens_stream(self):
+        file = RangeFile(CONTENTS, streaming=True)
+        reader = RangeReader(file)
+        self.assertEqual(reader.read(4), CONTENTS[:4])
+        reader.seek(100)
+        self.assertEqual(reader.read(4), CONTENTS[100:104])
+        self.assertEqual(file.requests, [(0, None), (100, None)])
+
+    def test_empty_file(self):
+        file = RangeFile(b'')
+        with io.BufferedReader(RangeReader(file)) as f:
+            self.assertEqual(f.read(), b'')
+        self.assertEqual(file.requests, [])
+
+    def test_invalid_seek(self):
+        reader = RangeReader(RangeFile(CONTENTS))
+        with self.assertRaises(ValueError):
+            reader.seek(-1)
+
+class TestRanges(unittest.TestCase):
+    def test_range_header(self):
+        self.assertEqual(range_header(0, 99), 'bytes=0-99')
+        self.assertEqual(range_header(100), 'bytes=100-')
+        self.assertEqual(range_header(None, 9), 'bytes=0-9')
+        self.assertEqual(range_header(-50), 'bytes=-50')
+        with self.assertRaises(ValueError):
+            range_header(-50, 10)
+
+    def test_coalesce_ranges(self):
+        ranges = [(1000, 10), (0, 10), (16, 5), (5, 10), (5000, 1)]
+        self.assertEqual(coalesce_ranges(ranges, max_gap=10), [
+            (0, 20, [1, 3, 2]),
+            (1000, 1009, [0]),
+            (5000, 5000, [4]),
+        ])
+        self.assertEqual(coalesce_ranges(ranges, max_gap=0), [
+            (0, 14, [1, 3]),
+            (16, 20, [2]),
+            (1000, 1009, [0]),
+            (5000, 5000, [4]),
+        ])
+        self.assertEqual(len(coalesce_ranges(ranges, max_gap=5000)), 1)
+
+class TestReadRanges(unittest.TestCase):
+    def setUp(self):
+        from nimbella.storage.plugins.abstract_storage_plugin import AbstractStorageFile
+        file = RangeFile(CONTENTS)
+        file.read_range = AbstractStorageFile.read_range.__get__(file)
+        file.read_ranges = AbstractStorageFile.read_ranges.__get__(file)
+        self.file = file
+
+    def test_read_range(self):
+        self.assertEqual(self.file.read_range(100, 10), CONTENTS[100:110])
+        self.assertEqual(self.file.read_range(100, 0), b'')
+        self.assertEqual(self.file.requests, [(100, 109)])
+
+    def test_read_ranges_coalesces_requests(self):
+        ranges = [(9000, 100), (0, 16), (32, 16), (-10, 10), (50, 0)]
+        blocks = self.file.read_ranges(ranges, max_gap=1024)
+        self.assertEqual(blocks, [CONTENTS[9000:9100], CONTENTS[0:16], CONTENTS[32:48], CONTENTS[-10:], b''])
+        self.assertEqual(sorted(self.file.requests), [(0, 47), (9000, 9100 - 1), (len(CONTENTS) - 10, len(CONTENTS) - 1)])
+
+class TestUploadStreams(unittest.TestCase):
+    def test_buffer_reader_does_not_copy(self):
+        buffer = bytearray(b'hello world')
+        reader = BufferReader(memoryview(buffer))
+        self.assertEqual(reader.read(5), b'hello')
+        buffer[6:] = b'WORLD'
+        self.assertEqual(reader.read(), b' WORLD')
+        reader.seek(-5, io.SEEK_END)
+        self.assertEqual(reader.read(2), b'WO')
+
+    def test_iter_reader_fills_reads(self):
+        reader = IterReader([b'ab', 'cd', bytearray(b'efg'), memoryview(b'h')])
+        self.assertEqual(reader.read(3), b'abc')
+        self.assertEqual(reader.tell(), 3)
+        self.assertEqual(reader.seek(3), 3)
+        self.assertEqual(reader.read(4), b'defg')
+        self.assertEqual(reader.read(4), b'h')
+        self.assertEqual(reader.read(4), b'')
+        with self.assertRaises(io.UnsupportedOperation):
+            reader.seek(0)
+
+    def test_as_stream(self):
+        stream, size = as_stream('héllo')
+        self.assertEqual((stream.read(), size), ('héllo'.encode('utf-8'), 6))
+
+        f = io.BytesIO(b'0123456789')
+        f.seek(4)
+        stream, size = as_stream(f)
+        self.assertIs(stream, f)
+        self.assertEqual((size, f.tell()), (6, 4))
+
+        stream, size = as_stream(iter([b'a', b'b']))
+        self.assertEqual((stream.read(), size), (b'ab', None))
+
+        with self.assertRaises(TypeError):
+            as_stream(42)
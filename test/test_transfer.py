@@ -0,0 +1,123 @@
+from nimbella.storage.plugins.abstract_storage_plugin import AbstractStorageFile
+from nimbella.storage import transfer
+
+import os
+import base64
+import hashlib
+import tempfile
+import threading
+import unittest
+
+CONTENTS = os.urandom(100 * 1024 + 17)
+
+class MemoryFile(AbstractStorageFile):
+    def __init__(self, contents, checksum=None):
+        self.contents = contents
+        self.checksum = checksum
+        self.requests = []
+        self.lock = threading.Lock()
+
+    name = 'file.bin'
+    metadata = {}
+    exists = lambda self: True
+    delete = lambda self: None
+    save = lambda self, data, contentType: None
+    signed_url = lambda self, *args: ''
+
+    def download(self, start=None, end=None):
+        with self.lock:
+            self.requests.append((start, end))
+        return self.contents[start:end + 1]
+
+    def _content_length(self):
+        return len(self.contents)
+
+    def _checksum(self):
+        return self.checksum
+
+def md5(data):
+    return base64.b64encode(hashlib.md5(data).digest()).decode('ascii')
+
+class TestDownloadToPath(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'file.bin')
+
+    def test_downloads_parts_concurrently(self):
+        file = MemoryFile(CONTENTS, ('md5', md5(CONTENTS)))
+        self.assertEqual(file.download_to_path(self.path, part_size=16 * 1024, workers=4), self.path)
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(), CONTENTS)
+        self.assertEqual(len(file.requests), 7)
+        self.assertIn((96 * 1024, len(CONTENTS) - 1), file.requests)
+
+    def test_returns_mmap(self):
+        file = MemoryFile(CONTENTS)
+        with file.download_to_path(self.path, part_size=32 * 1024, mmap=True) as mm:
+            self.assertEqual(mm[:], CONTENTS)
+            with self.assertRaises(TypeError):
+                mm[0] = 0
+
+    def test_empty_file(self):
+        file = MemoryFile(b'', ('md5', md5(b'')))
+        self.assertEqual(file.download_to_path(self.path, mmap=True), b'')
+        self.assertEqual(os.path.getsize(self.path), 0)
+        self.assertEqual(file.requests, [])
+
+    def test_checksum_mismatch(self):
+        file = MemoryFile(CONTENTS, ('md5', md5(b'other')))
+        with self.assertRaises(Exception):
+            file.download_to_path(self.path)
+        self.assertFalse(os.path.exists(self.path))
+
+        self.assertEqual(file.download_to_path(self.path, verify=False), self.path)
+
+    def test_crc32c_checksum(self):
+        import google_crc32c
+        expected = base64.b64encode(google_crc32c.Checksum(CONTENTS).digest()).decode('ascii')
+        file = MemoryFile(CONTENTS, ('crc32c', expected))
+        self.assertEqual(file.download_to_path(self.path), self.path)
+
+    def test_parts_pinned_to_version(self):
+        class VersionedFile(MemoryFile):
+            def _version(self):
+                return '7'
+
+            def _download_version(self, start, end, version):
+                if version != '7':
+                    raise Exception('Precondition failed')
+                return self.download(start, end)
+
+        file = VersionedFile(CONTENTS)
+        file.download_to_path(self.path, part_size=64 * 1024)
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(), CONTENTS)
+        with self.assertRaises(Exception):
+            transfer.parallel_download(file, self.path, len(CONTENTS), version='6')
+
+    def test_failed_part_removes_partial_file(self):
+        class FailingFile(MemoryFile):
+            def download(self, start=None, end=None):
+                if start > 0:
+                    raise Exception('connection reset')
+                return super().download(start, end)
+
+        with self.assertRaises(Exception):
+            FailingFile(CONTENTS).download_to_path(self.path, part_size=16 * 1024, workers=1)
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_invalid_part_size(self):
+        with self.assertRaises(ValueError):
+            transfer.parallel_download(MemoryFile(CONTENTS), self.path, len(CONTENTS), part_size=0)
+
+class TestTransferConfig(unittest.TestCase):
+    def test_resumable_chunk_size_rounded(self):
+        self.assertEqual(transfer.TransferConfig(resumable_chunk_size=1).resumable_chunk_size, 256 * 1024)
+        self.assertEqual(transfer.TransferConfig(resumable_chunk_size=512 * 1024).resumable_chunk_size, 512 * 1024)
+
+    def test_invalid_config(self):
+        with self.assertRaises(ValueError):
+            transfer.TransferConfig(part_size=0)
+        with self.assertRaises(ValueError):
+            transfer.TransferConfig(max_concurrency=0)